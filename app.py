@@ -1,11 +1,30 @@
 import os
 import base64
+import csv
+import hashlib
 import importlib
+import json
+import multiprocessing
+import queue
+import random
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import heapq
+import unicodedata
+import uuid
+import zipfile
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from decimal import Decimal, ROUND_HALF_UP
 from datetime import datetime, timedelta, date
 from dateutil import tz
-from flask import Flask, jsonify, request, render_template, send_from_directory, abort, make_response, url_for
-from io import BytesIO
+import click
+from flask import Flask, Response, jsonify, request, render_template, send_from_directory, abort, make_response, url_for, stream_with_context
+from io import BytesIO, StringIO, TextIOWrapper
 import smtplib
 from email.message import EmailMessage
 from email.utils import formataddr
@@ -44,12 +63,28 @@ try:
     WEASYPRINT_AVAILABLE = True
 except (ImportError, OSError):
     print("WeasyPrint no esta disponible. Se usara el generador basico de PDF.")
+
+PYARROW_AVAILABLE = False
+try:
+    import pyarrow  # type: ignore
+    import pyarrow.parquet  # type: ignore  # noqa: F401
+    PYARROW_AVAILABLE = True
+except ImportError:
+    pass  # opcional: solo habilita format=parquet en /api/export
+
+PYPDF_AVAILABLE = False
+try:
+    from pypdf import PdfWriter  # type: ignore
+    PYPDF_AVAILABLE = True
+except ImportError:
+    pass  # opcional: solo habilita format=pdf (un solo PDF unido) en la exportación de documentos
 from sqlalchemy import (
-    create_engine, Column, Integer, String, DateTime, Date, ForeignKey, Numeric, Text, UniqueConstraint
+    create_engine, Column, Integer, String, DateTime, Date, Float, ForeignKey, Numeric, Text, UniqueConstraint, Index
 )
-from sqlalchemy import inspect
-from sqlalchemy.orm import declarative_base, relationship, sessionmaker, scoped_session
+from sqlalchemy import inspect, select, insert, update, delete, func, union_all, event, tuple_, text, case, or_, and_, literal, bindparam
+from sqlalchemy.orm import declarative_base, relationship, sessionmaker, scoped_session, selectinload, joinedload, aliased
 from sqlalchemy.exc import IntegrityError, OperationalError
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 
 # --------------------
 # Configuración básica
@@ -75,7 +110,44 @@ else:
         os.makedirs(db_dir, exist_ok=True)
         db_connection_url = f"sqlite:///{DB_PATH}"
 
-engine = create_engine(db_connection_url, echo=False, future=True)
+# Ajustes de SQLite para varios workers escribiendo a la vez (SQLITE_TUNING=false deja los valores de SQLite)
+SQLITE_TUNING = os.getenv("SQLITE_TUNING", "true").lower() != "false"
+SQLITE_JOURNAL_MODE = os.getenv("SQLITE_JOURNAL_MODE", "WAL").strip().upper()  # WAL no sirve en discos de red
+SQLITE_SYNCHRONOUS = os.getenv("SQLITE_SYNCHRONOUS", "NORMAL").strip().upper()
+SQLITE_BUSY_TIMEOUT_MS = int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", "10000") or 0)
+SQLITE_CACHE_SIZE_KB = int(os.getenv("SQLITE_CACHE_SIZE_KB", "16384") or 0)  # por conexión
+SQLITE_MMAP_SIZE_MB = int(os.getenv("SQLITE_MMAP_SIZE_MB", "256") or 0)
+SQLITE_TEMP_STORE = os.getenv("SQLITE_TEMP_STORE", "MEMORY").strip().upper()
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5") or 5)  # conexiones por worker
+DB_POOL_MAX_OVERFLOW = int(os.getenv("DB_POOL_MAX_OVERFLOW", "5") or 0)
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30") or 30)
+
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    """Se ejecuta en cada conexión nueva del pool."""
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA journal_mode={SQLITE_JOURNAL_MODE}")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        cursor.execute(f"PRAGMA cache_size={-SQLITE_CACHE_SIZE_KB}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE_MB * 1024 * 1024}")
+        cursor.execute(f"PRAGMA temp_store={SQLITE_TEMP_STORE}")
+    finally:
+        cursor.close()
+
+def create_app_engine(url, tuned=SQLITE_TUNING):
+    """Crea el motor; en SQLite en archivo aplica los pragmas y un pool acotado por worker."""
+    is_sqlite = url.startswith("sqlite")
+    in_memory = is_sqlite and (":memory:" in url or url.rstrip("/") == "sqlite:")
+    options = {}
+    if tuned and not in_memory:
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_POOL_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT)
+    new_engine = create_engine(url, echo=False, future=True, **options)
+    if tuned and is_sqlite and not in_memory:
+        event.listen(new_engine, "connect", apply_sqlite_pragmas)
+    return new_engine
+
+engine = create_app_engine(db_connection_url)
 SessionLocal = scoped_session(sessionmaker(bind=engine, autoflush=False, autocommit=False, future=True))
 
 Base = declarative_base()
@@ -87,6 +159,22 @@ SMTP_PORT = int(os.getenv("SMTP_PORT", "587") or 587)
 SMTP_USERNAME = os.getenv("SMTP_USERNAME", "").strip()
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD", "").strip()
 SMTP_USE_TLS = (os.getenv("SMTP_USE_TLS", "true").lower() != "false")
+# starttls, ssl o none (none: servidor local sin cifrado ni login, p.ej. aiosmtpd para pruebas)
+SMTP_SECURITY = os.getenv("SMTP_SECURITY", "").strip().lower() or ("starttls" if SMTP_USE_TLS else "ssl")
+SMTP_TIMEOUT = float(os.getenv("SMTP_TIMEOUT", "30") or 30)
+# Pool de sesiones SMTP autenticadas
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", "4") or 4)
+SMTP_POOL_IDLE_SECONDS = float(os.getenv("SMTP_POOL_IDLE_SECONDS", "60") or 60)  # muchos servidores cortan antes de 5 min
+SMTP_POOL_MAX_MESSAGES = int(os.getenv("SMTP_POOL_MAX_MESSAGES", "100") or 100)  # mensajes por sesión antes de reconectar
+MAINTENANCE_REMINDER_LEAD_DAYS = int(os.getenv("MAINTENANCE_REMINDER_LEAD_DAYS", "3") or 0)
+# Despachador periódico de recordatorios (correo y WhatsApp vía la bandeja de salida)
+MAINTENANCE_REMINDERS_AUTO = os.getenv("MAINTENANCE_REMINDERS_AUTO", "false").lower() == "true"
+MAINTENANCE_REMINDER_INTERVAL_SECONDS = float(os.getenv("MAINTENANCE_REMINDER_INTERVAL_SECONDS", "3600") or 3600)
+MAINTENANCE_REMINDER_BATCH = int(os.getenv("MAINTENANCE_REMINDER_BATCH", "100") or 100)
+# Cierres mensuales del ledger de stock (stock_checkpoints)
+STOCK_CHECKPOINTS_AUTO = os.getenv("STOCK_CHECKPOINTS_AUTO", "true").lower() == "true"
+STOCK_CHECKPOINT_INTERVAL_SECONDS = float(os.getenv("STOCK_CHECKPOINT_INTERVAL_SECONDS", "21600") or 21600)
+STOCK_CHECKPOINT_GRACE_HOURS = float(os.getenv("STOCK_CHECKPOINT_GRACE_HOURS", "1") or 0)  # espera tras fin de mes
 SMTP_FROM_NAME = os.getenv("SMTP_FROM_NAME", "Ciclo Variedades Sisi").strip()
 SMTP_FROM_EMAIL = os.getenv("SMTP_FROM_EMAIL", SMTP_USERNAME).strip()
 
@@ -96,6 +184,49 @@ TWILIO_WHATSAPP_FROM = os.getenv("TWILIO_WHATSAPP_FROM", "").strip()
 TWILIO_SEND_MEDIA = os.getenv("TWILIO_SEND_MEDIA", "false").lower() == "true"
 DEFAULT_COUNTRY_CODE = os.getenv("DEFAULT_COUNTRY_CODE", "57").lstrip("+")
 
+# Caché en disco de PDFs renderizados
+PDF_CACHE_DIR = os.getenv("PDF_CACHE_DIR", "").strip() or os.path.join(BASE_DIR, "pdf_cache")
+PDF_CACHE_MAX_MB = float(os.getenv("PDF_CACHE_MAX_MB", "200") or 0)  # 0 desactiva la caché
+# Pre-renderizado en segundo plano de PDFs recién creados
+PDF_PRERENDER = os.getenv("PDF_PRERENDER", "true").lower() != "false"
+PDF_PRERENDER_THREADS = int(os.getenv("PDF_PRERENDER_THREADS", "1") or 1)
+PDF_PRERENDER_POLL_SECONDS = float(os.getenv("PDF_PRERENDER_POLL_SECONDS", "10") or 10)
+PDF_RENDER_JOB_TIMEOUT = int(os.getenv("PDF_RENDER_JOB_TIMEOUT", "300") or 300)  # segundos antes de reintentar un trabajo huérfano
+PDF_RENDER_MAX_ATTEMPTS = 3
+# Renderizado con WeasyPrint en procesos dedicados
+PDF_RENDER_POOL_SIZE = int(os.getenv("PDF_RENDER_POOL_SIZE", "0") or 0)  # 0 = renderiza en el mismo proceso
+PDF_RENDER_TIMEOUT = float(os.getenv("PDF_RENDER_TIMEOUT", "60") or 60)  # segundos por documento
+PDF_RENDER_SERVICE = os.getenv("PDF_RENDER_SERVICE", "false").lower() == "true"  # delega en `flask pdf-renderer`
+PDF_RENDER_WAIT_SECONDS = float(os.getenv("PDF_RENDER_WAIT_SECONDS", "15") or 15)
+# Exportación masiva de PDFs
+PDF_EXPORT_WORKERS = int(os.getenv("PDF_EXPORT_WORKERS", "4") or 4)
+PDF_EXPORT_MERGE_MAX = int(os.getenv("PDF_EXPORT_MERGE_MAX", "300") or 300)  # el PDF unido se arma completo antes de enviarlo
+PDF_EXPORT_SPOOL_BYTES = 8 * 1024 * 1024  # el PDF unido pasa a un archivo temporal por encima de este tamaño
+# Exportación de historial (movimientos y líneas de documentos) por lotes desde un cursor
+DATA_EXPORT_BATCH_SIZE = int(os.getenv("DATA_EXPORT_BATCH_SIZE", "2000") or 2000)
+
+# Códigos de compra reservados por bloques en cada worker (0 = numeración estricta en la transacción)
+PURCHASE_CODE_BLOCK_SIZE = int(os.getenv("PURCHASE_CODE_BLOCK_SIZE", "0") or 0)
+# Cola de notificaciones salientes (correo y WhatsApp)
+NOTIFY_TRANSPORT = os.getenv("NOTIFY_TRANSPORT", "live").strip().lower()  # live o fake (solo registra, para pruebas)
+NOTIFY_DISPATCH_THREADS = int(os.getenv("NOTIFY_DISPATCH_THREADS", "1") or 1)
+NOTIFY_POLL_SECONDS = float(os.getenv("NOTIFY_POLL_SECONDS", "10") or 10)
+NOTIFY_MAX_ATTEMPTS = int(os.getenv("NOTIFY_MAX_ATTEMPTS", "5") or 5)
+NOTIFY_RETRY_BASE_SECONDS = float(os.getenv("NOTIFY_RETRY_BASE_SECONDS", "30") or 30)  # se duplica en cada intento
+NOTIFY_SEND_TIMEOUT = int(os.getenv("NOTIFY_SEND_TIMEOUT", "300") or 300)  # segundos antes de reintentar un envío huérfano
+
+# Importación masiva de productos
+PRODUCT_IMPORT_BATCH_SIZE = int(os.getenv("PRODUCT_IMPORT_BATCH_SIZE", "500") or 500)
+
+# Borrado definitivo de productos archivados (hilo en segundo plano, por lotes)
+PRODUCT_PURGE_BATCH_SIZE = int(os.getenv("PRODUCT_PURGE_BATCH_SIZE", "1000") or 1000)  # filas por transacción
+PRODUCT_PURGE_POLL_SECONDS = float(os.getenv("PRODUCT_PURGE_POLL_SECONDS", "30") or 30)
+PRODUCT_PURGE_JOB_TIMEOUT = 300  # segundos sin avance antes de que otro worker retome el trabajo
+
+# Autocompletado de productos en memoria (opcional)
+PRODUCT_AUTOCOMPLETE = os.getenv("PRODUCT_AUTOCOMPLETE", "false").lower() == "true"
+PRODUCT_AUTOCOMPLETE_MAX_AGE = float(os.getenv("PRODUCT_AUTOCOMPLETE_MAX_AGE", "2") or 2)  # segundos
+
 # Helpers de decimales
 def D(x):
     if isinstance(x, Decimal):
@@ -106,8 +237,127 @@ def money(x):
     return D(x).quantize(Decimal("0.01"), rounding=ROUND_HALF_UP)
 
 def smtp_configured():
+    if SMTP_SECURITY == "none":
+        return all([SMTP_HOST, SMTP_FROM_EMAIL])
     return all([SMTP_HOST, SMTP_USERNAME, SMTP_PASSWORD, SMTP_FROM_EMAIL])
 
+class _SmtpSession:
+    def __init__(self, server):
+        self.server = server
+        self.last_used = time.monotonic()
+        self.sent = 0
+
+class SmtpConnectionPool:
+    """
+    Sesiones SMTP ya autenticadas que se reutilizan entre mensajes y entre
+    hilos. Cada hilo toma una sesión libre (o abre una nueva hasta `size`),
+    envía y la devuelve; si el servidor cortó la conexión se reconecta y
+    reintenta una vez.
+    """
+    RECONNECT_ERRORS = (smtplib.SMTPServerDisconnected, smtplib.SMTPConnectError, ConnectionError, TimeoutError)
+
+    def __init__(self, size, idle_seconds, max_messages):
+        self.size = max(1, size)
+        self.idle_seconds = idle_seconds
+        self.max_messages = max_messages
+        self._lock = threading.Lock()
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(self.size)
+        self._ssl_context = None
+        self.stats = {"connects": 0, "reconnects": 0, "sent": 0}
+
+    def _check_fork(self):
+        # Las conexiones heredadas de un fork no se pueden compartir
+        if self._pid != os.getpid():
+            with self._lock:
+                if self._pid != os.getpid():
+                    self._reset()
+
+    def _connect(self):
+        if self._ssl_context is None:
+            self._ssl_context = ssl.create_default_context()
+        if SMTP_SECURITY == "ssl":
+            server = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=self._ssl_context, timeout=SMTP_TIMEOUT)
+        else:
+            server = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=SMTP_TIMEOUT)
+            if SMTP_SECURITY == "starttls":
+                server.starttls(context=self._ssl_context)
+        if SMTP_SECURITY != "none":
+            server.login(SMTP_USERNAME, SMTP_PASSWORD)
+        self.stats["connects"] += 1
+        return _SmtpSession(server)
+
+    @staticmethod
+    def _close(session):
+        try:
+            session.server.quit()
+        except Exception:
+            session.server.close()
+
+    def _acquire(self):
+        self._slots.acquire()
+        try:
+            while True:
+                try:
+                    session = self._idle.get_nowait()
+                except queue.Empty:
+                    return self._connect()
+                if time.monotonic() - session.last_used <= self.idle_seconds:
+                    return session
+                self._close(session)
+        except Exception:
+            self._slots.release()
+            raise
+
+    def _release(self, session, broken=False):
+        try:
+            if broken or session.sent >= self.max_messages:
+                self._close(session)
+            else:
+                session.last_used = time.monotonic()
+                self._idle.put(session)
+        finally:
+            self._slots.release()
+
+    def send(self, msg):
+        self._check_fork()
+        for attempt in (1, 2):
+            session = self._acquire()
+            try:
+                session.server.send_message(msg)
+            except self.RECONNECT_ERRORS:
+                self._release(session, broken=True)
+                if attempt == 2:
+                    raise
+                # Si el servidor cortó una sesión, las demás ociosas probablemente también
+                self.close_all()
+                self.stats["reconnects"] += 1
+            except smtplib.SMTPResponseException:
+                # El servidor respondió (p.ej. destinatario rechazado): la sesión sigue sirviendo
+                self._release(session)
+                raise
+            except Exception:
+                self._release(session, broken=True)
+                raise
+            else:
+                session.sent += 1
+                self.stats["sent"] += 1
+                self._release(session)
+                return
+
+    def close_all(self):
+        while True:
+            try:
+                self._close(self._idle.get_nowait())
+            except queue.Empty:
+                return
+
+smtp_pool = SmtpConnectionPool(SMTP_POOL_SIZE, SMTP_POOL_IDLE_SECONDS, SMTP_POOL_MAX_MESSAGES)
+
 def send_email_with_pdf(to_email, subject, body, pdf_bytes, filename):
     if not smtp_configured():
         raise RuntimeError("La configuración SMTP no está completa. Define SMTP_HOST, SMTP_USERNAME, SMTP_PASSWORD y SMTP_FROM_EMAIL.")
@@ -117,23 +367,14 @@ def send_email_with_pdf(to_email, subject, body, pdf_bytes, filename):
     msg["From"] = formataddr((SMTP_FROM_NAME, SMTP_FROM_EMAIL))
     msg["To"] = to_email
     msg.set_content(body)
-    msg.add_attachment(
-        pdf_bytes,
-        maintype="application",
-        subtype="pdf",
-        filename=filename,
-    )
-
-    context = ssl.create_default_context()
-    if SMTP_USE_TLS:
-        with smtplib.SMTP(SMTP_HOST, SMTP_PORT) as server:
-            server.starttls(context=context)
-            server.login(SMTP_USERNAME, SMTP_PASSWORD)
-            server.send_message(msg)
-    else:
-        with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, context=context) as server:
-            server.login(SMTP_USERNAME, SMTP_PASSWORD)
-            server.send_message(msg)
+    if pdf_bytes:
+        msg.add_attachment(
+            pdf_bytes,
+            maintype="application",
+            subtype="pdf",
+            filename=filename,
+        )
+    smtp_pool.send(msg)
 
 def _sanitize_whatsapp_sender(sender_raw:str|None) -> str|None:
     """Normaliza el remitente de Twilio aceptando formatos con o sin 'whatsapp:'."""
@@ -174,10 +415,19 @@ def normalize_phone_number(raw_phone:str):
         return f"+{country}{digits}"
     return f"+{digits}"
 
+_twilio_client = None
+
+def get_twilio_client():
+    """Un solo cliente por proceso: reutiliza la sesión HTTP (y su conexión) entre mensajes."""
+    global _twilio_client
+    if _twilio_client is None:
+        _twilio_client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    return _twilio_client
+
 def send_whatsapp_message(to_phone:str, body:str, media_url:str|None=None):
     if not twilio_configured():
         raise RuntimeError("La configuración de Twilio no está completa.")
-    client = Client(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    client = get_twilio_client()
     from_number = _sanitize_whatsapp_sender(TWILIO_WHATSAPP_FROM)
     if not from_number:
         raise RuntimeError("El n�mero remitente de Twilio no es v�lido. Usa un formato como '+573001234567'.")
@@ -192,7 +442,8 @@ def send_whatsapp_message(to_phone:str, body:str, media_url:str|None=None):
             message_kwargs["media_url"] = [media_url]
         else:
             print(f"[Twilio] Se ignoro media_url no valida: {media_url}")
-    client.messages.create(**message_kwargs)
+    message = client.messages.create(**message_kwargs)
+    return getattr(message, "sid", None)
 
 def number_to_spanish_words(value):
     """Convierte un número a su representación en letras (solo parte entera)."""
@@ -269,6 +520,28 @@ def number_to_spanish_words(value):
             partes_finales.append(convertir(resto_miles))
     return " ".join(p for p in partes_finales if p).strip()
 
+PDF_LOGO_PATH = os.path.join(BASE_DIR, "static", "img", "ciclovariedadessisi.jpg")
+_pdf_logo_cache = {}
+
+def pdf_logo_data_uri():
+    """Logo en base64 para incrustar en el PDF; solo se relee del disco si el archivo cambia."""
+    try:
+        mtime = os.path.getmtime(PDF_LOGO_PATH)
+    except OSError:
+        return None
+    cached = _pdf_logo_cache.get(PDF_LOGO_PATH)
+    if cached and cached[0] == mtime:
+        return cached[1]
+    try:
+        with open(PDF_LOGO_PATH, "rb") as logo_file:
+            encoded = base64.b64encode(logo_file.read()).decode("ascii")
+    except OSError as exc:
+        print(f"No fue posible cargar el logo para el PDF: {exc}")
+        return None
+    data_uri = f"data:image/jpeg;base64,{encoded}"
+    _pdf_logo_cache[PDF_LOGO_PATH] = (mtime, data_uri)
+    return data_uri
+
 def build_invoice_template_context(invoice, *, for_pdf=False):
     """Prepara el contexto común usado por la plantilla de facturas."""
     total_amount = invoice.total if invoice.total is not None else invoice.subtotal_excl_vat
@@ -304,14 +577,7 @@ def build_invoice_template_context(invoice, *, for_pdf=False):
     }
 
     if for_pdf:
-        logo_path = os.path.join(BASE_DIR, "static", "img", "ciclovariedadessisi.jpg")
-        if os.path.exists(logo_path):
-            try:
-                with open(logo_path, "rb") as logo_file:
-                    encoded = base64.b64encode(logo_file.read()).decode("ascii")
-                    context["logo_data_uri"] = f"data:image/jpeg;base64,{encoded}"
-            except OSError as exc:
-                print(f"No fue posible cargar el logo para el PDF: {exc}")
+        context["logo_data_uri"] = pdf_logo_data_uri()
     return context
 
 def build_remission_template_context(remission, *, for_pdf=False):
@@ -349,14 +615,7 @@ def build_remission_template_context(remission, *, for_pdf=False):
     }
 
     if for_pdf:
-        logo_path = os.path.join(BASE_DIR, "static", "img", "ciclovariedadessisi.jpg")
-        if os.path.exists(logo_path):
-            try:
-                with open(logo_path, "rb") as logo_file:
-                    encoded = base64.b64encode(logo_file.read()).decode("ascii")
-                    context["logo_data_uri"] = f"data:image/jpeg;base64,{encoded}"
-            except OSError as exc:
-                print(f"No fue posible cargar el logo para el PDF: {exc}")
+        context["logo_data_uri"] = pdf_logo_data_uri()
     return context
 
 # --------------------
@@ -368,22 +627,107 @@ class Sequence(Base):
     name = Column(String, primary_key=True)
     next_value = Column(Integer, default=1, nullable=False)
 
-def next_sequence(name, start_at=1):
-    db = SessionLocal()
+def reserve_sequence_range(db, name, count=1, start_at=1):
+    """
+    Reserva `count` números consecutivos con un UPDATE ... RETURNING en la
+    transacción del llamador y devuelve el primero. La fila queda bloqueada
+    hasta el commit, así que dos workers nunca leen el mismo valor, y si la
+    transacción se revierte el número vuelve a estar disponible.
+    """
+    end = db.execute(
+        update(Sequence)
+        .where(Sequence.name == name)
+        .values(next_value=Sequence.next_value + count)
+        .returning(Sequence.next_value)
+    ).scalar()
+    if end is not None:
+        return end - count
     try:
-        seq = db.get(Sequence, name)
-        if not seq:
-            seq = Sequence(name=name, next_value=start_at)
-            db.add(seq)
+        with db.begin_nested():
+            db.execute(insert(Sequence).values(name=name, next_value=start_at + count))
+        return start_at
+    except IntegrityError:
+        # Otro worker creó la secuencia al mismo tiempo
+        return reserve_sequence_range(db, name, count, start_at)
+
+def next_sequence(db, name, start_at=1):
+    return reserve_sequence_range(db, name, 1, start_at)
+
+class SequenceBlockAllocator:
+    """
+    Reparte números desde bloques reservados por proceso (una transacción
+    corta por bloque), para secuencias de mucho tráfico donde no importan
+    los huecos. Nunca hay duplicados, pero los números no siguen el orden
+    de creación entre workers y lo que sobra de un bloque al reiniciar se pierde.
+    """
+    def __init__(self, name, block_size, start_at=1, bind=None):
+        self.name = name
+        self.block_size = max(1, block_size)
+        self.start_at = start_at
+        self.bind = bind
+        self._lock = threading.Lock()
+        self._pid = None
+        self._next = self._end = 0
+
+    def _reserve_block(self):
+        db = sessionmaker(bind=self.bind or engine, future=True)()
+        try:
+            first = reserve_sequence_range(db, self.name, self.block_size, self.start_at)
             db.commit()
-            db.refresh(seq)
-        val = seq.next_value
-        seq.next_value = val + 1
-        db.add(seq)
-        db.commit()
-        return val
-    finally:
-        db.close()
+        finally:
+            db.close()
+        self._pid = os.getpid()
+        self._next, self._end = first, first + self.block_size
+
+    def next(self):
+        with self._lock:
+            # Tras un fork, el hijo no puede reutilizar el bloque del padre
+            if self._pid != os.getpid() or self._next >= self._end:
+                self._reserve_block()
+            value = self._next
+            self._next += 1
+            return value
+
+purchase_code_allocator = SequenceBlockAllocator("purchase", PURCHASE_CODE_BLOCK_SIZE, start_at=1001) if PURCHASE_CODE_BLOCK_SIZE else None
+
+def next_purchase_number(db):
+    if purchase_code_allocator is not None:
+        return purchase_code_allocator.next()
+    return next_sequence(db, "purchase", start_at=1001)
+
+# Condición de stock bajo; las consultas deben usar exactamente este texto para aprovechar el índice parcial
+LOW_STOCK_SQL = "coalesce(current_stock, 0) <= coalesce(low_stock_threshold, 0)"
+
+CATALOG_VERSION_KEY = "catalog_version"  # productos y stock
+PRODUCT_INDEX_VERSION_KEY = "product_index_version"  # datos de los productos (no el stock)
+MAINTENANCE_VERSION_KEY = "maintenance_version"  # recordatorios de mantenimiento y datos de sus clientes
+
+def bump_version(db, key):
+    """Incrementa un contador de versión dentro de la transacción del llamador."""
+    result = db.execute(
+        update(Sequence)
+        .where(Sequence.name == key)
+        .values(next_value=Sequence.next_value + 1)
+    )
+    if result.rowcount == 0:
+        db.add(Sequence(name=key, next_value=2))
+        db.flush()
+
+def get_versions(db, keys):
+    """Lee varios contadores de versión en una consulta; 1 si aún no existen."""
+    found = dict(db.execute(select(Sequence.name, Sequence.next_value).where(Sequence.name.in_(keys))).all())
+    return tuple(found.get(key) or 1 for key in keys)
+
+def bump_catalog_version(db):
+    bump_version(db, CATALOG_VERSION_KEY)
+
+def get_catalog_version(db):
+    return get_versions(db, (CATALOG_VERSION_KEY,))[0]
+
+def bump_product_index_version(db):
+    """Para cambios de los datos del producto (no de su stock): el autocompletado reindexa solo con estos."""
+    bump_catalog_version(db)
+    bump_version(db, PRODUCT_INDEX_VERSION_KEY)
 
 class Supplier(Base):
     __tablename__ = "suppliers"
@@ -406,6 +750,13 @@ class Customer(Base):
     address = Column(String, default="")
     created_at = Column(DateTime, default=datetime.utcnow)
 
+    __table_args__ = (
+        # ensure_customer busca por documento, teléfono o nombre en cada venta
+        Index("ix_customers_document_number", "document_number"),
+        Index("ix_customers_phone", "phone"),
+        Index("ix_customers_name", "name"),
+    )
+
 class Product(Base):
     __tablename__ = "products"
     id = Column(Integer, primary_key=True)
@@ -416,9 +767,21 @@ class Product(Base):
     low_stock_threshold = Column(Integer, default=5)
     current_stock = Column(Integer, default=0)
     created_at = Column(DateTime, default=datetime.utcnow)
+    archived_at = Column(DateTime, nullable=True)  # archivado: fuera del catálogo, con su historial intacto
+
+    __table_args__ = (
+        Index("ix_products_name_id", "name", "id"),  # paginación por cursor (name, id)
+        # índice parcial: solo contiene los productos en alerta de stock bajo
+        Index("ix_products_low_stock", "id", sqlite_where=text(LOW_STOCK_SQL), postgresql_where=text(LOW_STOCK_SQL)),
+    )
 
 class Purchase(Base):
     __tablename__ = "purchases"
+    __table_args__ = (
+        # historial por cursor (date, id), también filtrado por proveedor
+        Index("ix_purchases_date_id", "date", "id"),
+        Index("ix_purchases_supplier_date_id", "supplier_id", "date", "id"),
+    )
     id = Column(Integer, primary_key=True)
     code = Column(String, unique=True, nullable=False)  # código de compra
     supplier_id = Column(Integer, ForeignKey("suppliers.id"))
@@ -446,8 +809,19 @@ class PurchaseItem(Base):
     purchase = relationship("Purchase", back_populates="items")
     product = relationship("Product")
 
+    __table_args__ = (
+        Index("ix_purchase_items_purchase_id", "purchase_id"),
+        Index("ix_purchase_items_product_id", "product_id"),
+    )
+
 class Invoice(Base):
     __tablename__ = "invoices"
+    __table_args__ = (
+        # historial por cursor (date, id), también filtrado por cliente o método de pago
+        Index("ix_invoices_date_id", "date", "id"),
+        Index("ix_invoices_customer_date_id", "customer_id", "date", "id"),
+        Index("ix_invoices_payment_date_id", "payment_method", "date", "id"),
+    )
     id = Column(Integer, primary_key=True)
     number = Column(String, unique=True, nullable=False)  # número de factura
     date = Column(DateTime, default=datetime.utcnow)
@@ -472,11 +846,24 @@ class InvoiceItem(Base):
     vat_amount = Column(Numeric(12, 2), default=0)
     total_incl_vat = Column(Numeric(12, 2), default=0)
 
+    unit_cost = Column(Numeric(12, 4), nullable=True)  # costo promedio al momento de la venta (para márgenes)
+
     invoice = relationship("Invoice", back_populates="items")
     product = relationship("Product")
 
+    __table_args__ = (
+        Index("ix_invoice_items_invoice_id", "invoice_id"),
+        Index("ix_invoice_items_product_id", "product_id"),
+    )
+
 class Remission(Base):
     __tablename__ = "remissions"
+    __table_args__ = (
+        # historial por cursor (date, id), también filtrado por cliente o método de pago
+        Index("ix_remissions_date_id", "date", "id"),
+        Index("ix_remissions_customer_date_id", "customer_id", "date", "id"),
+        Index("ix_remissions_payment_date_id", "payment_method", "date", "id"),
+    )
     id = Column(Integer, primary_key=True)
     number = Column(String, unique=True, nullable=False)  # número de remisión
     date = Column(DateTime, default=datetime.utcnow)
@@ -501,9 +888,16 @@ class RemissionItem(Base):
     vat_amount = Column(Numeric(12, 2), default=0)
     total_incl_vat = Column(Numeric(12, 2), default=0)
 
+    unit_cost = Column(Numeric(12, 4), nullable=True)  # costo promedio al momento de la venta (para márgenes)
+
     remission = relationship("Remission", back_populates="items")
     product = relationship("Product")
 
+    __table_args__ = (
+        Index("ix_remission_items_remission_id", "remission_id"),
+        Index("ix_remission_items_product_id", "product_id"),
+    )
+
 class StockMovement(Base):
     __tablename__ = "stock_movements"
     id = Column(Integer, primary_key=True)
@@ -513,10 +907,86 @@ class StockMovement(Base):
     note = Column(String, default="")
     reference_type = Column(String, default="")  # e.g. purchase, invoice
     reference_id = Column(Integer, nullable=True)
+    unit_cost = Column(Numeric(12, 4), nullable=True)  # costo de entrada del inventario inicial; fijo, a diferencia de last_purchase_cost
     created_at = Column(DateTime, default=datetime.utcnow)
 
     product = relationship("Product")
 
+    __table_args__ = (
+        # movimientos de un producto en orden cronológico (y borrado por producto)
+        Index("ix_stock_movements_product_created", "product_id", "created_at"),
+        Index("ix_stock_movements_created_at", "created_at"),  # cierres mensuales y exportaciones por fecha
+    )
+
+class StockCheckpoint(Base):
+    """Saldo de un producto al cierre de un mes: suma de sus movimientos con created_at < period_end."""
+    __tablename__ = "stock_checkpoints"
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    period_end = Column(DateTime, nullable=False)  # primer instante del mes siguiente
+    balance = Column(Integer, nullable=False, default=0)
+    movements = Column(Integer, nullable=False, default=0)  # movimientos del mes cerrado
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        # también sirve para buscar el último cierre de un producto antes de una fecha
+        UniqueConstraint("product_id", "period_end", name="uq_stock_checkpoints_product_period"),
+    )
+
+class SalesDailyProduct(Base):
+    """Ventas de un producto en un día por tipo de documento; se suma al vender y se reconstruye desde las líneas."""
+    __tablename__ = "sales_daily_products"
+    __table_args__ = (
+        UniqueConstraint("day", "kind", "product_id", name="uq_sales_daily_products_day_kind_product"),
+    )
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    kind = Column(String, nullable=False)  # invoice | remission
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    documents = Column(Integer, nullable=False, default=0)
+    lines = Column(Integer, nullable=False, default=0)
+    units = Column(Integer, nullable=False, default=0)
+    revenue = Column(Numeric(14, 2), nullable=False, default=0)  # sin IVA
+    vat = Column(Numeric(14, 2), nullable=False, default=0)
+    total = Column(Numeric(14, 2), nullable=False, default=0)
+    cost = Column(Numeric(14, 4), nullable=False, default=0)  # costo promedio guardado en las líneas
+
+class SalesMonthlyProduct(Base):
+    """Lo mismo que SalesDailyProduct por mes (day = primer día del mes), para rangos largos."""
+    __tablename__ = "sales_monthly_products"
+    __table_args__ = (
+        UniqueConstraint("day", "kind", "product_id", name="uq_sales_monthly_products_day_kind_product"),
+    )
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    kind = Column(String, nullable=False)
+    product_id = Column(Integer, ForeignKey("products.id"), nullable=False)
+    documents = Column(Integer, nullable=False, default=0)
+    lines = Column(Integer, nullable=False, default=0)
+    units = Column(Integer, nullable=False, default=0)
+    revenue = Column(Numeric(14, 2), nullable=False, default=0)
+    vat = Column(Numeric(14, 2), nullable=False, default=0)
+    total = Column(Numeric(14, 2), nullable=False, default=0)
+    cost = Column(Numeric(14, 4), nullable=False, default=0)
+
+class SalesDailyPayment(Base):
+    """Ventas de un día por tipo de documento y método de pago (mismas medidas que SalesDailyProduct)."""
+    __tablename__ = "sales_daily_payments"
+    __table_args__ = (
+        UniqueConstraint("day", "kind", "payment_method", name="uq_sales_daily_payments_day_kind_payment"),
+    )
+    id = Column(Integer, primary_key=True)
+    day = Column(Date, nullable=False)
+    kind = Column(String, nullable=False)
+    payment_method = Column(String, nullable=False, default="")
+    documents = Column(Integer, nullable=False, default=0)
+    lines = Column(Integer, nullable=False, default=0)
+    units = Column(Integer, nullable=False, default=0)
+    revenue = Column(Numeric(14, 2), nullable=False, default=0)
+    vat = Column(Numeric(14, 2), nullable=False, default=0)
+    total = Column(Numeric(14, 2), nullable=False, default=0)
+    cost = Column(Numeric(14, 4), nullable=False, default=0)
+
 class MaintenanceReminder(Base):
     __tablename__ = "maintenance_reminders"
     id = Column(Integer, primary_key=True)
@@ -530,25 +1000,279 @@ class MaintenanceReminder(Base):
 
     customer = relationship("Customer")
 
+    __table_args__ = (
+        # El despachador solo recorre la franja pendiente y vencida
+        Index("ix_maintenance_reminders_notified_due", "notified", "due_date"),
+        Index("ix_maintenance_reminders_due_date", "due_date"),
+        Index("ix_maintenance_reminders_customer_id", "customer_id"),
+    )
+
+class ProductStats(Base):
+    """Resumen por producto mantenido en cada escritura (ventas y compras)."""
+    __tablename__ = "product_stats"
+    product_id = Column(Integer, ForeignKey("products.id"), primary_key=True)
+    units_sold = Column(Integer, default=0, nullable=False)  # facturas + remisiones
+    last_supplier_id = Column(Integer, ForeignKey("suppliers.id"), nullable=True)
+    last_purchase_cost = Column(Numeric(10, 2), nullable=True)  # sin IVA
+    avg_cost = Column(Numeric(12, 4), nullable=True)  # costo promedio ponderado móvil, sin IVA
+    last_sale_date = Column(DateTime, nullable=True)
+    updated_at = Column(DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+
+    last_supplier = relationship("Supplier")
+
+class PdfRenderJob(Base):
+    """Cola persistente de PDFs por generar; sobrevive a reinicios de los workers."""
+    __tablename__ = "pdf_render_jobs"
+    id = Column(Integer, primary_key=True)
+    kind = Column(String, nullable=False)  # invoice, remission
+    document_id = Column(Integer, nullable=False)
+    status = Column(String, default="pending", nullable=False)  # pending, running, failed
+    attempts = Column(Integer, default=0, nullable=False)
+    last_error = Column(Text, default="")
+    claimed_at = Column(DateTime, nullable=True)
+    created_at = Column(DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        Index("ix_pdf_render_jobs_status_id", "status", "id"),
+    )
+
+class ProductPurgeJob(Base):
+    """Borrado definitivo de un producto archivado; lo hace un hilo en segundo plano por lotes."""
+    __tablename__ = "product_purge_jobs"
+    id = Column(Integer, primary_key=True)
+    product_id = Column(Integer, nullable=False)  # sin llave foránea: el producto desaparece al terminar
+    sku = Column(String, default="")
+    status = Column(String, default="pending", nullable=False)  # pending, running, done, failed, cancelled
+    step = Column(String, default="")  # tabla que se está limpiando
+    total = Column(Integer, default=0)  # líneas y movimientos por borrar
+    done = Column(Integer, default=0)
+    documents_updated = Column(Integer, default=0)
+    first_sale_date = Column(Date, nullable=True)  # días de ventas afectados (para los resúmenes)
+    last_sale_date = Column(Date, nullable=True)
+    error = Column(Text, default="")
+    claimed_at = Column(DateTime, nullable=True)  # se renueva con cada lote
+    created_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_product_purge_jobs_status_id", "status", "id"),
+    )
+
+class ExportJob(Base):
+    """Progreso de una exportación masiva de PDFs, consultable desde cualquier worker."""
+    __tablename__ = "export_jobs"
+    id = Column(String, primary_key=True)  # uuid
+    kind = Column(String, nullable=False)  # invoice, remission
+    export_format = Column(String, default="zip")  # zip, pdf
+    total = Column(Integer, default=0)
+    done = Column(Integer, default=0)
+    bytes_sent = Column(Integer, default=0)
+    status = Column(String, default="running")  # running, done, failed, cancelled
+    error = Column(Text, default="")
+    started_at = Column(DateTime, default=datetime.utcnow)
+    finished_at = Column(DateTime, nullable=True)
+
+class OutboundMessage(Base):
+    """Bandeja de salida: correos y WhatsApp que entrega el despachador en segundo plano."""
+    __tablename__ = "outbound_messages"
+    id = Column(Integer, primary_key=True)
+    channel = Column(String, nullable=False)  # email, whatsapp
+    idempotency_key = Column(String, unique=True, nullable=False)
+    recipient = Column(String, nullable=False)
+    subject = Column(String, default="")
+    body = Column(Text, default="")
+    media_url = Column(String, default="")
+    document_kind = Column(String, nullable=True)  # invoice, remission: se adjunta su PDF al enviar
+    document_id = Column(Integer, nullable=True)
+    attachment_name = Column(String, default="")
+    status = Column(String, default="pending")  # pending, sending, sent, failed
+    attempts = Column(Integer, default=0)
+    next_attempt_at = Column(DateTime, default=datetime.utcnow)
+    claimed_at = Column(DateTime, nullable=True)
+    last_error = Column(Text, default="")
+    provider_id = Column(String, default="")
+    created_at = Column(DateTime, default=datetime.utcnow)
+    sent_at = Column(DateTime, nullable=True)
+
+    __table_args__ = (
+        Index("ix_outbound_messages_status_next", "status", "next_attempt_at"),
+    )
+
 # --------------
 # Inicialización
 # --------------
 Base.metadata.create_all(bind=engine)
-inspector = inspect(engine)
-try:
-    customer_columns = [col["name"] for col in inspector.get_columns("customers")]
-except OperationalError:
-    customer_columns = []
-if "email" not in customer_columns:
-    try:
-        with engine.begin() as conn:
-            conn.exec_driver_sql("ALTER TABLE customers ADD COLUMN email VARCHAR DEFAULT """)
-    except OperationalError:
-        pass
+
+def ensure_indexes(bind=engine):
+    """Crea los índices declarados en los modelos que falten en tablas ya existentes. Devuelve los creados."""
+    inspector = inspect(bind)
+    created = []
+    for table in Base.metadata.sorted_tables:
+        try:
+            existing = {ix["name"] for ix in inspector.get_indexes(table.name)}
+        except OperationalError:
+            existing = set()
+        for index in table.indexes:
+            if index.name in existing:
+                continue
+            try:
+                index.create(bind=bind, checkfirst=True)
+                created.append(index.name)
+            except OperationalError as exc:
+                print(f"No fue posible crear el índice {index.name}: {exc}")
+    return created
+
+# (tabla, columna, tipo SQL) agregadas después de la primera versión del esquema
+SCHEMA_COLUMN_UPGRADES = (
+    ("customers", "email", "VARCHAR DEFAULT ''"),
+    ("product_stats", "avg_cost", "NUMERIC(12, 4)"),
+    ("invoice_items", "unit_cost", "NUMERIC(12, 4)"),
+    ("remission_items", "unit_cost", "NUMERIC(12, 4)"),
+    ("stock_movements", "unit_cost", "NUMERIC(12, 4)"),
+    ("products", "archived_at", "DATETIME"),
+)
+
+def upgrade_schema(bind=engine):
+    """
+    Pasos idempotentes para bases creadas con versiones anteriores: agrega
+    columnas nuevas y los índices que falten (llaves foráneas y columnas de
+    búsqueda). Corre en cada arranque; si no hay nada que hacer solo
+    inspecciona el esquema. Devuelve lo agregado ("tabla.columna" e índices).
+    """
+    inspector = inspect(bind)
+    added = []
+    for table, column, ddl in SCHEMA_COLUMN_UPGRADES:
+        try:
+            columns = [col["name"] for col in inspector.get_columns(table)]
+        except OperationalError:
+            columns = []
+        if columns and column not in columns:
+            try:
+                with bind.begin() as conn:
+                    conn.exec_driver_sql(f"ALTER TABLE {table} ADD COLUMN {column} {ddl}")
+                added.append(f"{table}.{column}")
+            except OperationalError:
+                pass  # otro worker la agregó al mismo tiempo
+    created = ensure_indexes(bind)
+    if created:
+        print(f"Índices creados: {', '.join(created)}")
+        if bind.dialect.name == "sqlite":
+            # estadísticas para que el planificador elija bien entre los índices nuevos
+            with bind.begin() as conn:
+                conn.exec_driver_sql("PRAGMA optimize")
+    return added + created
+
+schema_upgrades = upgrade_schema()
+
+# Índice de búsqueda de productos (SQLite FTS5 con tokenizador trigram).
+# Es una tabla de contenido externo sobre products; los triggers la mantienen
+# sincronizada y solo reindexan cuando cambian name o sku (no con el stock).
+PRODUCT_SEARCH_MIN_CHARS = 3  # trigram no puede buscar textos más cortos
+PRODUCT_FTS_TRIGGERS = (
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ai AFTER INSERT ON products BEGIN
+        INSERT INTO products_fts(rowid, name, sku) VALUES (new.id, new.name, new.sku);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_ad AFTER DELETE ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, sku) VALUES ('delete', old.id, old.name, old.sku);
+    END""",
+    """CREATE TRIGGER IF NOT EXISTS products_fts_au AFTER UPDATE OF name, sku ON products BEGIN
+        INSERT INTO products_fts(products_fts, rowid, name, sku) VALUES ('delete', old.id, old.name, old.sku);
+        INSERT INTO products_fts(rowid, name, sku) VALUES (new.id, new.name, new.sku);
+    END""",
+)
+
+def ensure_product_search_index(bind):
+    """Crea products_fts y sus triggers si la base es SQLite con FTS5. Devuelve True si quedó disponible."""
+    if bind.dialect.name != "sqlite":
+        return False
+    # remove_diacritics para trigram existe desde SQLite 3.45 ("bicicleta" encuentra "bicícleta")
+    tokenizer = "trigram remove_diacritics 1" if sqlite3.sqlite_version_info >= (3, 45, 0) else "trigram"
+    try:
+        with bind.begin() as conn:
+            exists = conn.exec_driver_sql(
+                "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'products_fts'"
+            ).first()
+            if not exists:
+                conn.exec_driver_sql(
+                    "CREATE VIRTUAL TABLE products_fts USING fts5("
+                    f"name, sku, content='products', content_rowid='id', tokenize='{tokenizer}')"
+                )
+                conn.exec_driver_sql("INSERT INTO products_fts(products_fts) VALUES ('rebuild')")
+            for ddl in PRODUCT_FTS_TRIGGERS:
+                conn.exec_driver_sql(ddl)
+    except OperationalError as exc:
+        print(f"Búsqueda FTS5 no disponible, se usará LIKE: {exc}")
+        return False
+    return True
+
+PRODUCT_FTS_AVAILABLE = ensure_product_search_index(engine)
 
 # --------------------
 # Funciones de PDF
 # --------------------
+def _pdf_render_worker_init():
+    """Arranque de cada proceso renderizador: carga WeasyPrint y las fuentes una sola vez."""
+    if WEASYPRINT_AVAILABLE:
+        HTML(string="<p style='font-family: Arial, Helvetica, sans-serif'>.</p>").write_pdf()
+
+def _render_html_in_worker(html_content, base_url):
+    return HTML(string=html_content, base_url=base_url).write_pdf()
+
+class PdfRenderPool:
+    """
+    Pool de procesos renderizadores de larga vida (spawn, con fuentes ya cargadas).
+
+    Cada trabajo tiene un tiempo máximo; si se excede, el pool se recicla para
+    matar el proceso bloqueado y el llamador recibe un error.
+    """
+    def __init__(self, size, timeout):
+        self.size = size
+        self.timeout = timeout
+        self._pool = None
+        self._lock = threading.Lock()
+        self.stats = {"jobs": 0, "timeouts": 0, "restarts": 0}
+
+    def _get_pool(self):
+        with self._lock:
+            if self._pool is None:
+                context = multiprocessing.get_context("spawn")
+                self._pool = context.Pool(self.size, initializer=_pdf_render_worker_init)
+            return self._pool
+
+    def submit(self, html_content):
+        """Envía el HTML al pool y devuelve un AsyncResult (se puede esperar o consultar con ready())."""
+        self.stats["jobs"] += 1
+        return self._get_pool().apply_async(_render_html_in_worker, (html_content, BASE_DIR))
+
+    def render(self, html_content):
+        pending = self.submit(html_content)
+        try:
+            return pending.get(self.timeout)
+        except multiprocessing.TimeoutError:
+            self.stats["timeouts"] += 1
+            self.restart()
+            raise RuntimeError(f"El renderizado del PDF superó {self.timeout:.0f} s")
+
+    def restart(self):
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            self.stats["restarts"] += 1
+            pool.terminate()
+
+    def summary(self):
+        return dict(self.stats, size=self.size, timeout=self.timeout, running=self._pool is not None)
+
+pdf_render_pool = None
+if PDF_RENDER_POOL_SIZE > 0 and WEASYPRINT_AVAILABLE:
+    pdf_render_pool = PdfRenderPool(PDF_RENDER_POOL_SIZE, PDF_RENDER_TIMEOUT)
+
+def render_html_to_pdf(html_content):
+    """Convierte HTML a PDF con WeasyPrint, en el pool de procesos si está configurado."""
+    if pdf_render_pool is not None:
+        return pdf_render_pool.render(html_content)
+    return HTML(string=html_content, base_url=BASE_DIR).write_pdf()
+
 def generate_invoice_pdf(invoice):
     """Genera un PDF de factura reutilizando la misma plantilla mostrada en pantalla."""
     context = build_invoice_template_context(invoice, for_pdf=True)
@@ -557,7 +1281,7 @@ def generate_invoice_pdf(invoice):
     if WEASYPRINT_AVAILABLE:
         try:
             html_content = render_template("invoice.html", **context)
-            return HTML(string=html_content, base_url=BASE_DIR).write_pdf()
+            return render_html_to_pdf(html_content)
         except Exception as exc:
             print(f"Error generando PDF con WeasyPrint: {exc}. Se intentará con ReportLab.")
 
@@ -747,7 +1471,7 @@ def generate_remission_pdf(remission):
     if WEASYPRINT_AVAILABLE:
         try:
             html_content = render_template("remission.html", **context)
-            return HTML(string=html_content, base_url=BASE_DIR).write_pdf()
+            return render_html_to_pdf(html_content)
         except Exception as exc:
             print(f"Error generando PDF de remisión con WeasyPrint: {exc}. Se intentará con ReportLab.")
 
@@ -969,188 +1693,1095 @@ def generate_remission_pdf(remission):
     except Exception as exc:
         print(f"Error generando PDF de remisión: {exc}")
         return None
-def adjust_stock(db, product_id:int, delta:int, movement_type:str, note:str="", reference_type:str="", reference_id:int=None):
-    product = db.get(Product, product_id)
-    if not product:
-        raise ValueError("Producto no encontrado")
-    product.current_stock = int(product.current_stock or 0) + int(delta)
-    move = StockMovement(
-        product_id=product_id,
-        movement_type=movement_type,
-        quantity_change=delta,
-        note=note,
-        reference_type=reference_type,
-        reference_id=reference_id
-    )
-    db.add(move)
-    db.add(product)
-    db.flush()  # Solo flush, no commit
-    return product.current_stock
+class PdfCache:
+    """
+    Caché LRU en disco para PDFs de facturas y remisiones.
 
-def recalc_totals_from_items(target, items):
-    """Recalcula subtotales, IVA y total a partir de un conjunto de items."""
-    subtotal = Decimal("0.00")
-    vat_total = Decimal("0.00")
-    total = Decimal("0.00")
+    La llave combina tipo y id del documento con un hash de su contenido y de
+    la fecha de modificación de la plantilla y el logo, así un cambio en el
+    documento o en el diseño genera un PDF nuevo. El LRU usa el mtime de cada
+    archivo, que se actualiza en cada acierto.
+    """
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "stores": 0, "evictions": 0}
 
-    for item in items:
-        subtotal += D(getattr(item, "total_excl_vat", 0) or 0)
-        vat_total += D(getattr(item, "vat_amount", 0) or 0)
-        total += D(getattr(item, "total_incl_vat", 0) or 0)
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
 
-    target.subtotal_excl_vat = money(subtotal)
-    target.vat_total = money(vat_total)
-    target.total = money(total)
-    return target
+    def _count(self, key):
+        with self._lock:
+            self.stats[key] += 1
 
-def delete_product_associations(db, product_id:int):
-    """
-    Elimina los registros asociados a un producto (compras, facturas y remisiones)
-    y recalcula los totales de los documentos afectados.
-    """
-    summary = {
-        "purchase_items_removed": 0,
-        "invoice_items_removed": 0,
-        "remission_items_removed": 0,
-    }
+    def _path(self, kind, doc_id, digest):
+        return os.path.join(self.directory, f"{kind}-{doc_id}-{digest}.pdf")
 
-    purchase_items = db.query(PurchaseItem).filter(PurchaseItem.product_id == product_id).all()
-    affected_purchases = {item.purchase_id for item in purchase_items if item.purchase_id}
-    for item in purchase_items:
-        db.delete(item)
-    summary["purchase_items_removed"] = len(purchase_items)
-    if purchase_items:
-        db.flush()
-        for purchase_id in affected_purchases:
-            purchase = db.get(Purchase, purchase_id)
-            if not purchase:
+    def get(self, kind, doc_id, digest):
+        path = self._path(kind, doc_id, digest)
+        try:
+            with open(path, "rb") as fh:
+                data = fh.read()
+            os.utime(path)
+        except OSError:
+            self._count("misses")
+            return None
+        self._count("hits")
+        return data
+
+    def wait_for(self, kind, doc_id, digest, timeout, interval=0.2):
+        """Espera a que otro proceso deje el PDF en la caché; None si no llega a tiempo."""
+        path = self._path(kind, doc_id, digest)
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if os.path.exists(path):
+                return self.get(kind, doc_id, digest)
+            time.sleep(interval)
+        return None
+
+    def put(self, kind, doc_id, digest, data):
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            prefix = f"{kind}-{doc_id}-"
+            for name in os.listdir(self.directory):
+                if name.startswith(prefix) and name.endswith(".pdf"):
+                    os.remove(os.path.join(self.directory, name))  # versiones anteriores del documento
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix=".tmp")
+            with os.fdopen(fd, "wb") as fh:
+                fh.write(data)
+            os.replace(tmp_path, self._path(kind, doc_id, digest))
+        except OSError as exc:
+            print(f"No fue posible guardar el PDF en caché: {exc}")
+            return
+        self._count("stores")
+        self.evict()
+
+    def _files(self):
+        files = []
+        if not os.path.isdir(self.directory):
+            return files
+        for name in os.listdir(self.directory):
+            if not name.endswith(".pdf"):
                 continue
-            remaining_items = db.query(PurchaseItem).filter(PurchaseItem.purchase_id == purchase_id).all()
-            recalc_totals_from_items(purchase, remaining_items)
-            db.add(purchase)
-
-    invoice_items = db.query(InvoiceItem).filter(InvoiceItem.product_id == product_id).all()
-    affected_invoices = {item.invoice_id for item in invoice_items if item.invoice_id}
-    for item in invoice_items:
-        db.delete(item)
-    summary["invoice_items_removed"] = len(invoice_items)
-    if invoice_items:
-        db.flush()
-        for invoice_id in affected_invoices:
-            invoice = db.get(Invoice, invoice_id)
-            if not invoice:
+            try:
+                info = os.stat(os.path.join(self.directory, name))
+            except OSError:
                 continue
-            remaining_items = db.query(InvoiceItem).filter(InvoiceItem.invoice_id == invoice_id).all()
-            recalc_totals_from_items(invoice, remaining_items)
-            db.add(invoice)
-
-    remission_items = db.query(RemissionItem).filter(RemissionItem.product_id == product_id).all()
-    affected_remissions = {item.remission_id for item in remission_items if item.remission_id}
-    for item in remission_items:
-        db.delete(item)
-    summary["remission_items_removed"] = len(remission_items)
-    if remission_items:
-        db.flush()
-        for remission_id in affected_remissions:
-            remission = db.get(Remission, remission_id)
-            if not remission:
+            files.append((info.st_mtime, info.st_size, name))
+        return files
+
+    def evict(self):
+        """Elimina los PDFs usados hace más tiempo hasta quedar bajo el límite."""
+        files = sorted(self._files())
+        total = sum(size for _, size, _ in files)
+        for _, size, name in files:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(os.path.join(self.directory, name))
+            except OSError:
                 continue
-            remaining_items = db.query(RemissionItem).filter(RemissionItem.remission_id == remission_id).all()
-            recalc_totals_from_items(remission, remaining_items)
-            db.add(remission)
-
-    return summary
+            total -= size
+            self._count("evictions")
+
+    def summary(self):
+        files = self._files()
+        with self._lock:
+            out = dict(self.stats)
+        out.update({
+            "enabled": self.enabled,
+            "files": len(files),
+            "bytes": sum(size for _, size, _ in files),
+            "max_bytes": self.max_bytes,
+            "pid": os.getpid(),
+        })
+        return out
+
+pdf_cache = PdfCache(PDF_CACHE_DIR, int(PDF_CACHE_MAX_MB * 1024 * 1024))
+
+def document_pdf_digest(kind, document):
+    """Hash del contenido que muestra el PDF (cabecera, cliente, ítems) y de la plantilla usada."""
+    customer = document.customer
+    payload = {
+        "number": document.number,
+        "date": document.date.isoformat() if document.date else None,
+        "payment_method": document.payment_method,
+        "totals": [str(document.subtotal_excl_vat), str(document.vat_total), str(document.total)],
+        "customer": [customer.name, customer.address, customer.document_number, customer.phone,
+                     getattr(customer, "email", "")] if customer else None,
+        "items": [
+            [it.product.sku, it.product.name, it.quantity, str(it.total_incl_vat)]
+            for it in document.items
+        ],
+        "renderer": "weasyprint" if WEASYPRINT_AVAILABLE else "reportlab",
+    }
+    for path in (
+        os.path.join(BASE_DIR, "templates", f"{kind}.html"),
+        os.path.join(BASE_DIR, "static", "img", "ciclovariedadessisi.jpg"),
+    ):
+        try:
+            payload[os.path.basename(path)] = os.path.getmtime(path)
+        except OSError:
+            pass
+    raw = json.dumps(payload, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(raw).hexdigest()[:32]
 
-def ensure_customer(db, payload):
-    name = (payload.get("name") or "").strip()
-    if not name:
-        raise ValueError("Nombre del cliente es obligatorio")
-    doc = (payload.get("document_number") or "").strip()
-    phone = (payload.get("phone") or "").strip()
-    email = (payload.get("email") or "").strip()
-    address = (payload.get("address") or "").strip()
+class PdfRenderPending(Exception):
+    """El servicio renderizador aún no entrega el PDF; el cliente debe reintentar."""
 
-    # Busca uno existente por documento+teléfono, si aplica
-    q = db.query(Customer)
-    if doc:
-        q = q.filter(Customer.document_number == doc)
-    elif phone:
-        q = q.filter(Customer.phone == phone)
-    else:
-        q = q.filter(Customer.name == name)
-    existing = q.first()
-    if existing:
-        # Actualiza datos básicos
-        existing.name = name or existing.name
-        existing.phone = phone or existing.phone
-        if hasattr(existing, "email"):
-            existing.email = email or existing.email
-        existing.address = address or existing.address
-        db.add(existing)
-        db.flush()
-        db.refresh(existing)
-        return existing
-    kwargs = dict(name=name, document_number=doc, phone=phone, address=address)
-    if "email" in Customer.__table__.c:
-        kwargs["email"] = email
-    c = Customer(**kwargs)
-    db.add(c)
-    db.flush()
-    db.refresh(c)
-    return c
+def cached_document_pdf(kind, document, render, *, delegate=None):
+    """
+    Devuelve el PDF desde la caché o lo genera con render(document) y lo guarda.
+    Con PDF_RENDER_SERVICE los workers web no renderizan: encolan el trabajo,
+    esperan hasta PDF_RENDER_WAIT_SECONDS y si no llega lanzan PdfRenderPending.
+    """
+    if delegate is None:
+        delegate = PDF_RENDER_SERVICE
+    if not pdf_cache.enabled:
+        return render(document)
+    digest = document_pdf_digest(kind, document)
+    pdf_bytes = pdf_cache.get(kind, document.id, digest)
+    if pdf_bytes is None and delegate:
+        request_pdf_render(kind, document.id)
+        pdf_bytes = pdf_cache.wait_for(kind, document.id, digest, PDF_RENDER_WAIT_SECONDS)
+        if pdf_bytes is None:
+            raise PdfRenderPending(f"El PDF de {kind} {document.id} aún se está generando.")
+        return pdf_bytes
+    if pdf_bytes is None:
+        pdf_bytes = render(document)
+        if pdf_bytes:
+            pdf_cache.put(kind, document.id, digest, pdf_bytes)
+    return pdf_bytes
+
+def cached_invoice_pdf(invoice):
+    return cached_document_pdf("invoice", invoice, generate_invoice_pdf)
+
+def cached_remission_pdf(remission):
+    return cached_document_pdf("remission", remission, generate_remission_pdf)
 
 # --------------------
-# Serializadores simples
+# Pre-renderizado de PDFs en segundo plano
 # --------------------
-def product_to_dict(p: Product):
-    # Calcular precio con IVA
-    price_with_vat = float(p.price or 0) * (1 + float(p.vat_rate or 0))
-    
-    # Calcular valor del IVA en pesos
-    vat_amount = float(p.price or 0) * float(p.vat_rate or 0)
-    
-    return {
-        "id": p.id,
-        "name": p.name,
-        "sku": p.sku,
-        "price": float(p.price or 0),
-        "price_with_vat": price_with_vat,
-        "vat_rate": float(p.vat_rate or 0),
-        "vat_amount": vat_amount,
-        "low_stock_threshold": p.low_stock_threshold,
-        "current_stock": p.current_stock,
-        "created_at": p.created_at.isoformat() if p.created_at else None
-    }
+PDF_DOCUMENT_TYPES = {
+    "invoice": (Invoice, generate_invoice_pdf),
+    "remission": (Remission, generate_remission_pdf),
+}
+
+_pdf_prerender_wakeup = threading.Event()
+_pdf_prerender_lock = threading.Lock()
+_pdf_prerender_threads = []
+
+def enqueue_pdf_render(db, kind:str, document_id:int):
+    """Agrega el trabajo en la transacción del documento: si el commit falla, no queda trabajo huérfano."""
+    if PDF_PRERENDER and pdf_cache.enabled:
+        db.add(PdfRenderJob(kind=kind, document_id=document_id))
+
+def request_pdf_render(kind:str, document_id:int):
+    """Encola el PDF para el servicio renderizador si no hay ya un trabajo activo."""
+    db = SessionLocal.session_factory()
+    try:
+        active = db.query(PdfRenderJob.id).filter(
+            PdfRenderJob.kind == kind,
+            PdfRenderJob.document_id == document_id,
+            PdfRenderJob.status.in_(("pending", "running")),
+        ).first()
+        if active is None:
+            db.add(PdfRenderJob(kind=kind, document_id=document_id))
+            db.commit()
+    finally:
+        db.close()
 
-def product_to_dict_with_details(p: Product, db_session):
-    """Función avanzada que incluye información del proveedor y unidades vendidas"""
-    # Calcular precio con IVA
-    price_with_vat = float(p.price or 0) * (1 + float(p.vat_rate or 0))
-    
-    # Calcular valor del IVA en pesos
-    vat_amount = float(p.price or 0) * float(p.vat_rate or 0)
-    
-    # Obtener el último proveedor que vendió este producto
-    last_purchase_item = db_session.query(PurchaseItem).filter(
-        PurchaseItem.product_id == p.id
-    ).order_by(PurchaseItem.id.desc()).first()
-    
-    supplier_name = "Sin proveedor"
-    if last_purchase_item and last_purchase_item.purchase and last_purchase_item.purchase.supplier:
-        supplier_name = last_purchase_item.purchase.supplier.name
-    
-    # Calcular unidades vendidas (facturas + remisiones)
-    invoice_sales = db_session.query(InvoiceItem).filter(
-        InvoiceItem.product_id == p.id
-    ).with_entities(InvoiceItem.quantity).all()
-    
-    remission_sales = db_session.query(RemissionItem).filter(
-        RemissionItem.product_id == p.id
-    ).with_entities(RemissionItem.quantity).all()
-    
-    total_sold = sum([item.quantity for item in invoice_sales]) + sum([item.quantity for item in remission_sales])
-    
-    return {
+def _claimable_job_filter(now):
+    stale_before = now - timedelta(seconds=PDF_RENDER_JOB_TIMEOUT)
+    return or_(
+        PdfRenderJob.status == "pending",
+        and_(PdfRenderJob.status == "running", PdfRenderJob.claimed_at < stale_before),
+    )
+
+def claim_pdf_render_job(db):
+    """Reclama un trabajo con un UPDATE condicional; varios workers pueden competir sin duplicarlo."""
+    while True:
+        now = datetime.utcnow()
+        job_id = db.execute(
+            select(PdfRenderJob.id).where(_claimable_job_filter(now)).order_by(PdfRenderJob.id).limit(1)
+        ).scalar()
+        if job_id is None:
+            db.commit()
+            return None
+        claimed = db.execute(
+            update(PdfRenderJob)
+            .where(PdfRenderJob.id == job_id, _claimable_job_filter(now))
+            .values(status="running", claimed_at=now, attempts=PdfRenderJob.attempts + 1)
+        ).rowcount
+        db.commit()
+        if claimed:
+            return db.get(PdfRenderJob, job_id)
+
+def render_document_pdf(kind:str, document_id:int, delegate=False):
+    """
+    Genera (o lee de la caché) el PDF de un documento con una sesión propia;
+    se puede usar desde hilos. delegate como en cached_document_pdf.
+    """
+    model, render = PDF_DOCUMENT_TYPES[kind]
+    db = SessionLocal.session_factory()
+    try:
+        document = db.get(model, document_id)
+        if document is None:
+            return None
+        with app.test_request_context():
+            return cached_document_pdf(kind, document, render, delegate=delegate)
+    finally:
+        db.close()
+
+def run_pdf_render_job(db, job):
+    model, render = PDF_DOCUMENT_TYPES[job.kind]
+    document = db.get(model, job.document_id)
+    if document is not None:
+        with app.test_request_context():
+            if not cached_document_pdf(job.kind, document, render, delegate=False):
+                raise RuntimeError("El generador de PDF no devolvió contenido.")
+    db.delete(job)
+    db.commit()
+
+def run_pending_pdf_render_jobs(limit=None):
+    """Procesa trabajos pendientes hasta vaciar la cola (o hasta limit). Devuelve cuántos procesó."""
+    processed = 0
+    db = SessionLocal()
+    try:
+        while limit is None or processed < limit:
+            job = claim_pdf_render_job(db)
+            if job is None:
+                break
+            try:
+                run_pdf_render_job(db, job)
+            except Exception as exc:
+                db.rollback()
+                job = db.get(PdfRenderJob, job.id)
+                if job is not None:
+                    job.status = "failed" if job.attempts >= PDF_RENDER_MAX_ATTEMPTS else "pending"
+                    job.last_error = str(exc)
+                    db.commit()
+                print(f"Error pre-renderizando PDF: {exc}")
+            processed += 1
+    finally:
+        db.close()
+    return processed
+
+def _pdf_prerender_loop(poll_seconds=PDF_PRERENDER_POLL_SECONDS):
+    while True:
+        try:
+            processed = run_pending_pdf_render_jobs()
+        except Exception as exc:
+            print(f"Error en la cola de PDFs: {exc}")
+            processed = 0
+        if not processed:
+            _pdf_prerender_wakeup.wait(poll_seconds)
+            _pdf_prerender_wakeup.clear()
+
+def ensure_pdf_prerender_workers():
+    """Arranca los hilos del proceso actual (también tras un fork de gunicorn)."""
+    if not (PDF_PRERENDER and pdf_cache.enabled) or PDF_RENDER_SERVICE:
+        # Con el servicio renderizador, los workers web solo encolan
+        return
+    if len(_pdf_prerender_threads) >= PDF_PRERENDER_THREADS and all(t.is_alive() for t in _pdf_prerender_threads):
+        return
+    with _pdf_prerender_lock:
+        _pdf_prerender_threads[:] = [t for t in _pdf_prerender_threads if t.is_alive()]
+        while len(_pdf_prerender_threads) < PDF_PRERENDER_THREADS:
+            worker = threading.Thread(target=_pdf_prerender_loop, name="pdf-prerender", daemon=True)
+            worker.start()
+            _pdf_prerender_threads.append(worker)
+
+def notify_pdf_prerender():
+    ensure_pdf_prerender_workers()
+    _pdf_prerender_wakeup.set()
+
+# --------------
+# Cola de notificaciones salientes
+# --------------
+class PermanentDeliveryError(Exception):
+    """Error que no se arregla reintentando (destinatario rechazado, número inválido...)."""
+
+class FakeTransport:
+    """Transporte de pruebas: registra los mensajes en memoria y puede fallar las primeras N veces."""
+    def __init__(self, channel, fail_times=0):
+        self.channel = channel
+        self.fail_times = fail_times
+        self.sent = []
+
+    def __call__(self, message, attachment):
+        if self.fail_times > 0:
+            self.fail_times -= 1
+            raise RuntimeError(f"Fallo simulado de {self.channel}")
+        self.sent.append({
+            "id": message.id,
+            "recipient": message.recipient,
+            "subject": message.subject,
+            "body": message.body,
+            "attachment_bytes": len(attachment or b""),
+        })
+        print(f"[{self.channel}:fake] mensaje {message.id} para {message.recipient}")
+        return f"fake-{self.channel}-{len(self.sent)}"
+
+def deliver_email(message, attachment):
+    try:
+        send_email_with_pdf(
+            to_email=message.recipient,
+            subject=message.subject,
+            body=message.body,
+            pdf_bytes=attachment,
+            filename=message.attachment_name,
+        )
+    except (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused) as exc:
+        raise PermanentDeliveryError(str(exc)) from exc
+    return ""
+
+def deliver_whatsapp(message, attachment):
+    try:
+        return send_whatsapp_message(
+            to_phone=message.recipient,
+            body=message.body,
+            media_url=message.media_url or None,
+        ) or ""
+    except Exception as exc:
+        status = getattr(exc, "status", None)
+        if isinstance(status, int) and 400 <= status < 500 and status != 429:
+            raise PermanentDeliveryError(str(exc)) from exc
+        raise
+
+if NOTIFY_TRANSPORT == "fake":
+    NOTIFICATION_TRANSPORTS = {"email": FakeTransport("email"), "whatsapp": FakeTransport("whatsapp")}
+else:
+    NOTIFICATION_TRANSPORTS = {"email": deliver_email, "whatsapp": deliver_whatsapp}
+
+def notification_channel_ready(channel:str):
+    if NOTIFY_TRANSPORT == "fake":
+        return True
+    return smtp_configured() if channel == "email" else twilio_configured()
+
+def enqueue_notification(db, channel:str, recipient:str, *, idempotency_key:str|None=None, subject:str="", body:str="",
+                         media_url:str="", document_kind:str|None=None, document_id:int|None=None, attachment_name:str=""):
+    """
+    Registra el mensaje en la bandeja de salida y hace commit. Con la misma
+    idempotency_key devuelve el mensaje ya registrado en lugar de duplicarlo.
+    Devuelve (mensaje, creado).
+    """
+    key = (idempotency_key or "").strip() or uuid.uuid4().hex
+    existing = db.query(OutboundMessage).filter(OutboundMessage.idempotency_key == key).first()
+    if existing is not None:
+        return existing, False
+    message = OutboundMessage(
+        channel=channel,
+        idempotency_key=key,
+        recipient=recipient,
+        subject=subject,
+        body=body,
+        media_url=media_url or "",
+        document_kind=document_kind,
+        document_id=document_id,
+        attachment_name=attachment_name,
+    )
+    db.add(message)
+    try:
+        db.commit()
+    except IntegrityError:
+        # Otra petición con la misma llave ganó la carrera
+        db.rollback()
+        return db.query(OutboundMessage).filter(OutboundMessage.idempotency_key == key).one(), False
+    return message, True
+
+def outbound_message_to_dict(message):
+    return {
+        "id": message.id,
+        "channel": message.channel,
+        "recipient": message.recipient,
+        "status": message.status,
+        "attempts": message.attempts,
+        "next_attempt_at": message.next_attempt_at.isoformat() if message.status == "pending" and message.next_attempt_at else None,
+        "last_error": message.last_error or "",
+        "provider_id": message.provider_id or "",
+        "created_at": message.created_at.isoformat() if message.created_at else None,
+        "sent_at": message.sent_at.isoformat() if message.sent_at else None,
+    }
+
+def _claimable_message_filter(now):
+    stale_before = now - timedelta(seconds=NOTIFY_SEND_TIMEOUT)
+    return or_(
+        and_(OutboundMessage.status == "pending", OutboundMessage.next_attempt_at <= now),
+        and_(OutboundMessage.status == "sending", OutboundMessage.claimed_at < stale_before),
+    )
+
+def claim_outbound_message(db):
+    """Igual que claim_pdf_render_job: UPDATE condicional para que dos despachadores no envíen lo mismo."""
+    while True:
+        now = datetime.utcnow()
+        message_id = db.execute(
+            select(OutboundMessage.id).where(_claimable_message_filter(now))
+            .order_by(OutboundMessage.next_attempt_at, OutboundMessage.id).limit(1)
+        ).scalar()
+        if message_id is None:
+            db.commit()
+            return None
+        claimed = db.execute(
+            update(OutboundMessage)
+            .where(OutboundMessage.id == message_id, _claimable_message_filter(now))
+            .values(status="sending", claimed_at=now, attempts=OutboundMessage.attempts + 1)
+        ).rowcount
+        db.commit()
+        if claimed:
+            return db.get(OutboundMessage, message_id)
+
+def notification_retry_delay(attempts:int):
+    """Backoff exponencial con jitter: base, 2*base, 4*base... (máximo 1 hora)."""
+    delay = min(NOTIFY_RETRY_BASE_SECONDS * (2 ** max(attempts - 1, 0)), 3600)
+    return delay * random.uniform(0.8, 1.2)
+
+def deliver_outbound_message(db, message):
+    attachment = None
+    if message.document_kind:
+        attachment = render_document_pdf(message.document_kind, message.document_id)
+        if not attachment:
+            raise RuntimeError("No fue posible generar el PDF adjunto.")
+    provider_id = NOTIFICATION_TRANSPORTS[message.channel](message, attachment)
+    message.status = "sent"
+    message.sent_at = datetime.utcnow()
+    message.provider_id = provider_id or ""
+    message.last_error = ""
+    db.commit()
+
+def run_pending_notifications(limit=None):
+    """Envía los mensajes vencidos hasta vaciar la cola (o hasta limit). Devuelve cuántos intentó."""
+    processed = 0
+    db = SessionLocal.session_factory()
+    try:
+        while limit is None or processed < limit:
+            message = claim_outbound_message(db)
+            if message is None:
+                break
+            try:
+                deliver_outbound_message(db, message)
+            except Exception as exc:
+                db.rollback()
+                message = db.get(OutboundMessage, message.id)
+                if message is not None:
+                    permanent = isinstance(exc, PermanentDeliveryError)
+                    if permanent or message.attempts >= NOTIFY_MAX_ATTEMPTS:
+                        message.status = "failed"
+                    else:
+                        message.status = "pending"
+                        message.next_attempt_at = datetime.utcnow() + timedelta(seconds=notification_retry_delay(message.attempts))
+                    message.last_error = str(exc)
+                    db.commit()
+                print(f"Error enviando notificación: {exc}")
+            processed += 1
+    finally:
+        db.close()
+    return processed
+
+_notify_wakeup = threading.Event()
+_notify_lock = threading.Lock()
+_notify_threads = []
+
+def _notification_dispatch_loop(poll_seconds=NOTIFY_POLL_SECONDS):
+    while True:
+        try:
+            processed = run_pending_notifications()
+        except Exception as exc:
+            print(f"Error en la cola de notificaciones: {exc}")
+            processed = 0
+        if not processed:
+            _notify_wakeup.wait(poll_seconds)
+            _notify_wakeup.clear()
+
+def ensure_notification_dispatchers():
+    """Arranca los despachadores del proceso actual (también tras un fork de gunicorn)."""
+    if len(_notify_threads) >= NOTIFY_DISPATCH_THREADS and all(t.is_alive() for t in _notify_threads):
+        return
+    with _notify_lock:
+        _notify_threads[:] = [t for t in _notify_threads if t.is_alive()]
+        while len(_notify_threads) < NOTIFY_DISPATCH_THREADS:
+            worker = threading.Thread(target=_notification_dispatch_loop, name="notify-dispatch", daemon=True)
+            worker.start()
+            _notify_threads.append(worker)
+
+def notify_dispatchers():
+    ensure_notification_dispatchers()
+    _notify_wakeup.set()
+
+def maintenance_reminder_email(customer_name, due_date, notes):
+    subject = f"Recordatorio de mantenimiento - {SMTP_FROM_NAME}"
+    body = (
+        f"Hola {customer_name or 'cliente'},\n\n"
+        f"Te recordamos que el mantenimiento de tu bicicleta está programado para el {due_date.strftime('%d/%m/%Y')}.\n"
+        + (f"Notas: {notes}\n" if notes else "")
+        + "\nEscríbenos o visítanos para agendarlo.\n\n"
+        f"{SMTP_FROM_NAME}"
+    )
+    return subject, body
+
+def maintenance_reminder_whatsapp(customer_name, due_date, notes):
+    return (
+        f"Hola {customer_name or 'cliente'}!\n\n"
+        f"Te recordamos que el mantenimiento de tu bicicleta está programado para el {due_date.strftime('%d/%m/%Y')}.\n"
+        + (f"Notas: {notes}\n" if notes else "")
+        + f"\n{SMTP_FROM_NAME}"
+    )
+
+def _reminder_contact_filter(email=True, whatsapp=True):
+    """Solo se reclaman recordatorios que se puedan enviar por algún canal configurado."""
+    conditions = []
+    if email and notification_channel_ready("email"):
+        conditions.append(and_(Customer.email.isnot(None), Customer.email != ""))
+    if whatsapp and notification_channel_ready("whatsapp"):
+        conditions.append(and_(Customer.phone.isnot(None), Customer.phone != ""))
+    return or_(*conditions) if conditions else None
+
+def claim_due_reminders(db, horizon, limit, contact_filter):
+    """
+    Marca notified=1 en un solo UPDATE ... RETURNING sobre la franja
+    (notified, due_date) del índice; lo que otro worker ya reclamó no vuelve.
+    """
+    due = (
+        select(MaintenanceReminder.id)
+        .join(Customer, MaintenanceReminder.customer_id == Customer.id)
+        .where(MaintenanceReminder.notified == 0, MaintenanceReminder.due_date <= horizon, contact_filter)
+        .order_by(MaintenanceReminder.due_date, MaintenanceReminder.id)
+    )
+    if limit:
+        due = due.limit(limit)
+    claimed = db.execute(
+        update(MaintenanceReminder)
+        .where(MaintenanceReminder.id.in_(due.scalar_subquery()), MaintenanceReminder.notified == 0)
+        .values(notified=1)
+        .returning(MaintenanceReminder.id)
+    ).scalars().all()
+    if claimed:
+        bump_version(db, MAINTENANCE_VERSION_KEY)
+    return claimed
+
+def _claimed_reminder_rows(db, ids):
+    return (
+        db.query(MaintenanceReminder.id, MaintenanceReminder.due_date, MaintenanceReminder.notes,
+                 Customer.name, Customer.email, Customer.phone)
+        .join(Customer, MaintenanceReminder.customer_id == Customer.id)
+        .filter(MaintenanceReminder.id.in_(ids))
+        .order_by(MaintenanceReminder.due_date, MaintenanceReminder.id)
+        .all()
+    )
+
+def queue_reminder_messages(db, ids, email=True, whatsapp=True):
+    """
+    Deja en la bandeja de salida los mensajes de los recordatorios reclamados,
+    dentro de la transacción del reclamo. Devuelve las idempotency_key.
+    """
+    messages = []
+    for row in _claimed_reminder_rows(db, ids):
+        if email and (row.email or "").strip():
+            subject, body = maintenance_reminder_email(row.name, row.due_date, row.notes)
+            messages.append(OutboundMessage(
+                channel="email", idempotency_key=f"maintenance:{row.id}:{row.due_date}:email",
+                recipient=row.email.strip(), subject=subject, body=body,
+            ))
+        phone = normalize_phone_number(row.phone or "") if whatsapp else None
+        if phone:
+            messages.append(OutboundMessage(
+                channel="whatsapp", idempotency_key=f"maintenance:{row.id}:{row.due_date}:whatsapp",
+                recipient=phone, body=maintenance_reminder_whatsapp(row.name, row.due_date, row.notes),
+            ))
+    keys = [m.idempotency_key for m in messages]
+    # Un recordatorio devuelto a pendiente puede tener ya su mensaje en la bandeja
+    existing = set(db.execute(
+        select(OutboundMessage.idempotency_key).where(OutboundMessage.idempotency_key.in_(keys))
+    ).scalars()) if keys else set()
+    db.add_all([m for m in messages if m.idempotency_key not in existing])
+    return keys
+
+def queue_due_maintenance_emails(lead_days=MAINTENANCE_REMINDER_LEAD_DAYS, limit=None, dry_run=False):
+    """
+    Encola por correo los recordatorios no notificados que vencen en los
+    próximos lead_days días (o ya vencidos), en la misma transacción que los
+    marca como notificados. No envía: devuelve {"due", "queued",
+    "idempotency_keys"} y el envío queda a cargo de la bandeja de salida.
+    """
+    horizon = date.today() + timedelta(days=lead_days)
+    contact_filter = _reminder_contact_filter(whatsapp=False)
+    result = {"due": 0, "queued": 0, "idempotency_keys": []}
+    if contact_filter is None:
+        return result
+
+    db = SessionLocal.session_factory()
+    try:
+        if dry_run:
+            result["due"] = db.query(func.count(MaintenanceReminder.id)).join(
+                Customer, MaintenanceReminder.customer_id == Customer.id
+            ).filter(MaintenanceReminder.notified == 0, MaintenanceReminder.due_date <= horizon, contact_filter).scalar()
+            if limit:
+                result["due"] = min(result["due"], limit)
+            return result
+        ids = claim_due_reminders(db, horizon, limit, contact_filter)
+        keys = queue_reminder_messages(db, ids, whatsapp=False) if ids else []
+        db.commit()
+    finally:
+        db.close()
+    result.update(due=len(ids), queued=len(keys), idempotency_keys=keys)
+    return result
+
+def send_due_maintenance_reminders(lead_days=MAINTENANCE_REMINDER_LEAD_DAYS, limit=None, dry_run=False):
+    """
+    Para la línea de comandos: encola como queue_due_maintenance_emails y
+    vacía la bandeja ahí mismo con SMTP_POOL_SIZE despachadores en paralelo
+    sobre el pool SMTP. Los que fallan quedan en la bandeja con sus
+    reintentos (queued).
+    """
+    queued = queue_due_maintenance_emails(lead_days, limit=limit, dry_run=dry_run)
+    summary = {"due": queued["due"], "sent": 0, "failed": 0, "queued": 0, "errors": []}
+    keys = queued["idempotency_keys"]
+    if not keys:
+        return summary
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=SMTP_POOL_SIZE, thread_name_prefix="smtp-bulk") as executor:
+        for future in [executor.submit(run_pending_notifications) for _ in range(SMTP_POOL_SIZE)]:
+            future.result()
+
+    db = SessionLocal.session_factory()
+    try:
+        for i in range(0, len(keys), 500):
+            rows = db.query(OutboundMessage.status, OutboundMessage.recipient, OutboundMessage.last_error).filter(
+                OutboundMessage.idempotency_key.in_(keys[i:i + 500])
+            ).all()
+            for status, recipient, last_error in rows:
+                if status == "sent":
+                    summary["sent"] += 1
+                    continue
+                summary["failed" if status == "failed" else "queued"] += 1
+                if last_error:
+                    summary["errors"].append({"email": recipient, "status": status, "error": last_error})
+    finally:
+        db.close()
+
+    elapsed = time.perf_counter() - started
+    summary["seconds"] = round(elapsed, 2)
+    print(f"[mantenimiento] {summary['sent']} recordatorios enviados, {summary['failed']} fallidos, "
+          f"{summary['queued']} en cola en {elapsed:.1f} s")
+    return summary
+
+def dispatch_due_maintenance_reminders(lead_days=MAINTENANCE_REMINDER_LEAD_DAYS, batch_size=MAINTENANCE_REMINDER_BATCH):
+    """
+    Reclama por lotes los recordatorios pendientes y deja sus mensajes
+    (correo y/o WhatsApp) en la bandeja de salida en la misma transacción,
+    así un recordatorio reclamado siempre queda encolado. Devuelve cuántos.
+    """
+    contact_filter = _reminder_contact_filter()
+    if contact_filter is None:
+        return 0
+    email_ready = notification_channel_ready("email")
+    whatsapp_ready = notification_channel_ready("whatsapp")
+    horizon = date.today() + timedelta(days=lead_days)
+    total = 0
+    db = SessionLocal.session_factory()
+    try:
+        while True:
+            ids = claim_due_reminders(db, horizon, batch_size, contact_filter)
+            if not ids:
+                db.commit()
+                break
+            queue_reminder_messages(db, ids, email=email_ready, whatsapp=whatsapp_ready)
+            db.commit()
+            total += len(ids)
+    finally:
+        db.close()
+    if total:
+        print(f"[mantenimiento] {total} recordatorios encolados")
+        notify_dispatchers()
+    return total
+
+_maintenance_scheduler_lock = threading.Lock()
+_maintenance_scheduler_threads = []
+
+def _maintenance_scheduler_loop(interval_seconds=MAINTENANCE_REMINDER_INTERVAL_SECONDS):
+    while True:
+        try:
+            dispatch_due_maintenance_reminders()
+        except Exception as exc:
+            print(f"Error despachando recordatorios de mantenimiento: {exc}")
+        time.sleep(interval_seconds)
+
+def ensure_maintenance_scheduler():
+    """Un hilo por proceso; el reclamo atómico evita duplicados entre workers."""
+    if not MAINTENANCE_REMINDERS_AUTO:
+        return
+    if _maintenance_scheduler_threads and _maintenance_scheduler_threads[0].is_alive():
+        return
+    with _maintenance_scheduler_lock:
+        _maintenance_scheduler_threads[:] = [t for t in _maintenance_scheduler_threads if t.is_alive()]
+        if not _maintenance_scheduler_threads:
+            worker = threading.Thread(target=_maintenance_scheduler_loop, name="maintenance-scheduler", daemon=True)
+            worker.start()
+            _maintenance_scheduler_threads.append(worker)
+
+def adjust_stock(db, product_id:int, delta:int, movement_type:str, note:str="", reference_type:str="", reference_id:int=None, sold_at=None):
+    product = db.get(Product, product_id)
+    if not product:
+        raise ValueError("Producto no encontrado")
+    product.current_stock = int(product.current_stock or 0) + int(delta)
+    move = StockMovement(
+        product_id=product_id,
+        movement_type=movement_type,
+        quantity_change=delta,
+        note=note,
+        reference_type=reference_type,
+        reference_id=reference_id
+    )
+    db.add(move)
+    db.add(product)
+    if movement_type in SALE_MOVEMENT_TYPES and int(delta) < 0:
+        record_sale_stats(db, product_id, -int(delta), sold_at)
+    bump_catalog_version(db)
+    db.flush()  # Solo flush, no commit
+    return product.current_stock
+
+SALE_MOVEMENT_TYPES = ("invoice", "remission")
+
+def get_product_stats(db, product_id:int):
+    """Obtiene (o crea dentro de la transacción actual) el resumen de un producto."""
+    stats = db.get(ProductStats, product_id)
+    if stats is None:
+        stats = ProductStats(product_id=product_id, units_sold=0)
+        db.add(stats)
+    return stats
+
+def latest_sale_date(sold_at):
+    """last_sale_date es la fecha del documento más reciente, aunque llegue uno con fecha anterior."""
+    return case(
+        (or_(ProductStats.last_sale_date.is_(None), ProductStats.last_sale_date < sold_at), sold_at),
+        else_=ProductStats.last_sale_date,
+    )
+
+def record_sale_stats(db, product_id:int, quantity:int, sold_at=None):
+    """sold_at: fecha del documento (por defecto ahora)."""
+    sold_at = sold_at or datetime.utcnow()
+    stats = get_product_stats(db, product_id)
+    if stats.units_sold is None:
+        stats.units_sold = int(quantity)
+    else:
+        stats.units_sold = ProductStats.units_sold + int(quantity)
+    stats.last_sale_date = latest_sale_date(sold_at) if inspect(stats).persistent else sold_at
+    db.add(stats)
+
+def _expire_loaded(db, model, ids, attributes):
+    """Los UPDATE por lotes no tocan los objetos ya cargados; se expiran para que relean."""
+    for obj in list(db.identity_map.values()):
+        identity = inspect(obj).identity
+        if isinstance(obj, model) and identity and identity[0] in ids:
+            db.expire(obj, attributes)
+
+def ensure_product_stats_rows(db, product_ids):
+    existing = set(db.execute(
+        select(ProductStats.product_id).where(ProductStats.product_id.in_(product_ids))
+    ).scalars())
+    missing = [pid for pid in product_ids if pid not in existing]
+    if missing:
+        db.execute(insert(ProductStats), [{"product_id": pid, "units_sold": 0} for pid in missing])
+
+class InsufficientStockError(ValueError):
+    pass
+
+def apply_stock_deltas(db, deltas, movement_type:str, note:str="", reference_type:str="", reference_id:int=None, guard:bool=False, sold_at=None):
+    """
+    Versión por lotes de adjust_stock para documentos con muchas líneas:
+    un INSERT múltiple de movimientos y un solo UPDATE ... CASE de
+    existencias (y de product_stats). deltas: [(product_id, delta)] en orden.
+
+    Con guard=True las salidas solo se aplican si alcanza el stock
+    (WHERE current_stock >= cantidad en el mismo UPDATE); si algún producto
+    no alcanza se lanza InsufficientStockError y el llamador revierte.
+    sold_at es la fecha del documento de venta (por defecto ahora).
+    """
+    if not deltas:
+        return
+    db.flush()
+    now = datetime.utcnow()
+    db.execute(insert(StockMovement), [
+        {
+            "product_id": product_id,
+            "movement_type": movement_type,
+            "quantity_change": int(delta),
+            "note": note,
+            "reference_type": reference_type,
+            "reference_id": reference_id,
+            "created_at": now,
+        }
+        for product_id, delta in deltas
+    ])
+    net = {}
+    for product_id, delta in deltas:
+        net[product_id] = net.get(product_id, 0) + int(delta)
+    stmt = (
+        update(Product)
+        .where(Product.id.in_(net))
+        .values(current_stock=func.coalesce(Product.current_stock, 0) + case(net, value=Product.id, else_=0))
+    )
+    needed = {pid: -delta for pid, delta in net.items() if delta < 0} if guard else {}
+    if needed:
+        stmt = stmt.where(or_(
+            Product.id.notin_(needed),
+            func.coalesce(Product.current_stock, 0) >= case(needed, value=Product.id),
+        ))
+        updated = set(db.execute(stmt.returning(Product.id), execution_options={"synchronize_session": False}).scalars())
+        short = [pid for pid, _ in deltas if pid not in updated]
+        if short:
+            name = db.execute(select(Product.name).where(Product.id == short[0])).scalar()
+            raise InsufficientStockError(f"Stock insuficiente para {name}")
+    else:
+        db.execute(stmt, execution_options={"synchronize_session": False})
+    _expire_loaded(db, Product, net, ["current_stock"])
+    if movement_type in SALE_MOVEMENT_TYPES:
+        sold = {pid: -delta for pid, delta in net.items() if delta < 0}
+        if sold:
+            ensure_product_stats_rows(db, list(sold))
+            db.execute(
+                update(ProductStats)
+                .where(ProductStats.product_id.in_(sold))
+                .values(
+                    units_sold=func.coalesce(ProductStats.units_sold, 0) + case(sold, value=ProductStats.product_id, else_=0),
+                    last_sale_date=latest_sale_date(sold_at or now),
+                ),
+                execution_options={"synchronize_session": False},
+            )
+            _expire_loaded(db, ProductStats, sold, None)
+    bump_catalog_version(db)
+
+def record_purchase_stats_bulk(db, supplier_id:int|None, unit_costs:dict):
+    """unit_costs: {product_id: costo}; gana la última línea de cada producto, como en el recorrido por líneas."""
+    if not unit_costs:
+        return
+    ensure_product_stats_rows(db, list(unit_costs))
+    costs = {pid: money(cost or 0) for pid, cost in unit_costs.items()}
+    db.execute(
+        update(ProductStats)
+        .where(ProductStats.product_id.in_(costs))
+        .values(last_supplier_id=supplier_id, last_purchase_cost=case(costs, value=ProductStats.product_id)),
+        execution_options={"synchronize_session": False},
+    )
+    _expire_loaded(db, ProductStats, costs, None)
+
+AVG_COST_QUANT = Decimal("0.0001")
+
+def weighted_average_cost(on_hand, avg_cost, quantity, unit_cost):
+    """
+    Promedio ponderado móvil al recibir quantity unidades a unit_cost.
+    Sin existencias positivas o sin costo previo el promedio arranca en el
+    costo de la entrada (el faltante no se valora a un costo anterior).
+    """
+    on_hand = int(on_hand or 0)
+    unit_cost = Decimal(unit_cost or 0)
+    if avg_cost is None or on_hand <= 0:
+        return unit_cost.quantize(AVG_COST_QUANT)
+    total = (Decimal(avg_cost) * on_hand + unit_cost * int(quantity)) / (on_hand + int(quantity))
+    return total.quantize(AVG_COST_QUANT)
+
+def apply_purchase_average_cost(db, lines):
+    """
+    Actualiza product_stats.avg_cost con las líneas de una compra. Debe
+    llamarse antes de apply_stock_deltas: usa las existencias previas a la
+    entrada. Cuesta un SELECT y un UPDATE ... CASE por compra sin importar el
+    historial; el INSERT de la compra ya tomó el candado de escritura, así que
+    otra compra simultánea no puede leer el mismo promedio.
+    """
+    received = {}
+    for line in lines:
+        qty, value = received.get(line["product_id"], (0, Decimal("0")))
+        received[line["product_id"]] = (qty + line["quantity"], value + Decimal(line["unit_cost"]) * line["quantity"])
+    if not received:
+        return
+    stmt = (
+        select(Product.id, Product.current_stock, ProductStats.avg_cost)
+        .outerjoin(ProductStats, ProductStats.product_id == Product.id)
+        .where(Product.id.in_(received))
+    )
+    averages = {}
+    for product_id, on_hand, avg_cost in db.execute(stmt):
+        qty, value = received[product_id]
+        averages[product_id] = weighted_average_cost(on_hand, avg_cost, qty, value / qty)
+    ensure_product_stats_rows(db, list(averages))
+    db.execute(
+        update(ProductStats)
+        .where(ProductStats.product_id.in_(averages))
+        .values(avg_cost=case(averages, value=ProductStats.product_id)),
+        execution_options={"synchronize_session": False},
+    )
+    _expire_loaded(db, ProductStats, averages, None)
+
+def build_document_lines(db, items, price_key:str, vat_rate_for, with_cost:bool=False):
+    """
+    Valida las líneas en el orden recibido (mismos mensajes que el recorrido
+    línea por línea) con todos los productos consultados en un solo IN.
+    Lanza ValueError con el primer error; devuelve las filas listas para insertar.
+    El stock no se revisa aquí: lo garantiza el UPDATE condicional de apply_stock_deltas.
+    Con with_cost=True (ventas) cada línea lleva el costo promedio vigente en unit_cost.
+    """
+    product_ids = set()
+    for it in items:
+        try:
+            product_ids.add(int(it.get("product_id")))
+        except (TypeError, ValueError):
+            pass
+    costs = {}
+    archived = set()
+    if product_ids:
+        stmt = (
+            select(Product.id, ProductStats.avg_cost, Product.archived_at)
+            .outerjoin(ProductStats, ProductStats.product_id == Product.id)
+            .where(Product.id.in_(product_ids))
+        )
+        for product_id, avg_cost, archived_at in db.execute(stmt):
+            costs[product_id] = avg_cost
+            if archived_at is not None:
+                archived.add(product_id)
+    existing = set(costs)
+
+    lines = []
+    for it in items:
+        product_id = int(it.get("product_id"))
+        qty = int(it.get("quantity"))
+        price = money(it.get(price_key))
+        vat_rate = vat_rate_for(it)
+        if qty <= 0:
+            raise ValueError("Cantidad debe ser > 0")
+        if product_id not in existing:
+            raise ValueError(f"Producto {product_id} no existe")
+        if product_id in archived:
+            raise ValueError(f"Producto {product_id} está archivado")
+        total_excl = money(price * qty)
+        vat_amount = money(total_excl * vat_rate)
+        lines.append({
+            "product_id": product_id,
+            "quantity": qty,
+            price_key: price,
+            "vat_rate": vat_rate,
+            "total_excl_vat": total_excl,
+            "vat_amount": vat_amount,
+            "total_incl_vat": money(total_excl + vat_amount),
+        })
+        if with_cost:
+            lines[-1]["unit_cost"] = costs[product_id]
+    return lines
+
+def sum_document_lines(target, lines):
+    target.subtotal_excl_vat = money(sum((line["total_excl_vat"] for line in lines), Decimal("0.00")))
+    target.vat_total = money(sum((line["vat_amount"] for line in lines), Decimal("0.00")))
+    target.total = money(sum((line["total_incl_vat"] for line in lines), Decimal("0.00")))
+
+def document_totals_from_items(item_model, fk:str, document_model):
+    """
+    Valores para un UPDATE de documentos que recalcula subtotal, IVA y total
+    con la suma de sus líneas restantes (subconsultas correlacionadas).
+    """
+    def line_sum(column):
+        subtotal = select(func.sum(column)).where(getattr(item_model, fk) == document_model.id).scalar_subquery()
+        return func.round(func.coalesce(subtotal, 0), 2)
+    return {
+        "subtotal_excl_vat": line_sum(item_model.total_excl_vat),
+        "vat_total": line_sum(item_model.vat_amount),
+        "total": line_sum(item_model.total_incl_vat),
+    }
+
+def ensure_customer(db, payload):
+    name = (payload.get("name") or "").strip()
+    if not name:
+        raise ValueError("Nombre del cliente es obligatorio")
+    doc = (payload.get("document_number") or "").strip()
+    phone = (payload.get("phone") or "").strip()
+    email = (payload.get("email") or "").strip()
+    address = (payload.get("address") or "").strip()
+
+    # Busca uno existente por documento+teléfono, si aplica
+    q = db.query(Customer)
+    if doc:
+        q = q.filter(Customer.document_number == doc)
+    elif phone:
+        q = q.filter(Customer.phone == phone)
+    else:
+        q = q.filter(Customer.name == name)
+    existing = q.first()
+    if existing:
+        # Actualiza datos básicos
+        before = (existing.name, existing.phone, getattr(existing, "email", None), existing.address)
+        existing.name = name or existing.name
+        existing.phone = phone or existing.phone
+        if hasattr(existing, "email"):
+            existing.email = email or existing.email
+        existing.address = address or existing.address
+        if (existing.name, existing.phone, getattr(existing, "email", None), existing.address) != before:
+            bump_version(db, MAINTENANCE_VERSION_KEY)  # las alertas muestran nombre y contacto
+        db.add(existing)
+        db.flush()
+        db.refresh(existing)
+        return existing
+    kwargs = dict(name=name, document_number=doc, phone=phone, address=address)
+    if "email" in Customer.__table__.c:
+        kwargs["email"] = email
+    c = Customer(**kwargs)
+    db.add(c)
+    db.flush()
+    db.refresh(c)
+    return c
+
+# --------------------
+# Serializadores simples
+# --------------------
+def product_to_dict(p: Product):
+    # Calcular precio con IVA
+    price_with_vat = float(p.price or 0) * (1 + float(p.vat_rate or 0))
+    
+    # Calcular valor del IVA en pesos
+    vat_amount = float(p.price or 0) * float(p.vat_rate or 0)
+    
+    return {
+        "id": p.id,
+        "name": p.name,
+        "sku": p.sku,
+        "price": float(p.price or 0),
+        "price_with_vat": price_with_vat,
+        "vat_rate": float(p.vat_rate or 0),
+        "vat_amount": vat_amount,
+        "low_stock_threshold": p.low_stock_threshold,
+        "current_stock": p.current_stock,
+        "created_at": p.created_at.isoformat() if p.created_at else None
+    }
+
+def product_to_dict_with_details(p: Product, db_session):
+    """Función avanzada que incluye información del proveedor y unidades vendidas"""
+    # Calcular precio con IVA
+    price_with_vat = float(p.price or 0) * (1 + float(p.vat_rate or 0))
+    
+    # Calcular valor del IVA en pesos
+    vat_amount = float(p.price or 0) * float(p.vat_rate or 0)
+    
+    # Obtener el último proveedor que vendió este producto
+    last_purchase_item = db_session.query(PurchaseItem).filter(
+        PurchaseItem.product_id == p.id
+    ).order_by(PurchaseItem.id.desc()).first()
+    
+    supplier_name = "Sin proveedor"
+    if last_purchase_item and last_purchase_item.purchase and last_purchase_item.purchase.supplier:
+        supplier_name = last_purchase_item.purchase.supplier.name
+    
+    # Calcular unidades vendidas (facturas + remisiones)
+    invoice_sales = db_session.query(InvoiceItem).filter(
+        InvoiceItem.product_id == p.id
+    ).with_entities(InvoiceItem.quantity).all()
+    
+    remission_sales = db_session.query(RemissionItem).filter(
+        RemissionItem.product_id == p.id
+    ).with_entities(RemissionItem.quantity).all()
+    
+    total_sold = sum([item.quantity for item in invoice_sales]) + sum([item.quantity for item in remission_sales])
+    
+    return {
         "id": p.id,
         "name": p.name,
         "sku": p.sku,
@@ -1165,24 +2796,1534 @@ def product_to_dict_with_details(p: Product, db_session):
         "created_at": p.created_at.isoformat() if p.created_at else None
     }
 
-def supplier_to_dict(s: Supplier):
+def _sales_summary_subquery():
+    """Unidades vendidas y última venta por producto (facturas + remisiones) en un solo GROUP BY."""
+    sales = union_all(
+        select(
+            InvoiceItem.product_id.label("product_id"),
+            InvoiceItem.quantity.label("quantity"),
+            Invoice.date.label("sold_at"),
+        ).join(Invoice, Invoice.id == InvoiceItem.invoice_id),
+        select(RemissionItem.product_id, RemissionItem.quantity, Remission.date)
+        .join(Remission, Remission.id == RemissionItem.remission_id),
+    ).subquery()
+    return (
+        select(
+            sales.c.product_id,
+            func.sum(sales.c.quantity).label("total_sold"),
+            func.max(sales.c.sold_at).label("last_sale_date"),
+        )
+        .group_by(sales.c.product_id)
+        .subquery()
+    )
+
+def _last_purchase_subquery():
+    """Último ítem de compra de cada producto con su proveedor (ventana ROW_NUMBER)."""
+    ranked = (
+        select(
+            PurchaseItem.product_id.label("product_id"),
+            PurchaseItem.unit_cost.label("unit_cost"),
+            Supplier.id.label("supplier_id"),
+            func.row_number().over(
+                partition_by=PurchaseItem.product_id,
+                order_by=PurchaseItem.id.desc(),
+            ).label("rn"),
+        )
+        .select_from(PurchaseItem)
+        .outerjoin(Purchase, Purchase.id == PurchaseItem.purchase_id)
+        .outerjoin(Supplier, Supplier.id == Purchase.supplier_id)
+        .subquery()
+    )
+    return (
+        select(ranked.c.product_id, ranked.c.unit_cost, ranked.c.supplier_id)
+        .where(ranked.c.rn == 1)
+        .subquery()
+    )
+
+def product_stats_from_history(db_session):
+    """Recalcula el resumen de todos los productos a partir del historial completo."""
+    sales = _sales_summary_subquery()
+    last_purchase = _last_purchase_subquery()
+    stmt = (
+        select(
+            Product.id,
+            sales.c.total_sold,
+            sales.c.last_sale_date,
+            last_purchase.c.supplier_id,
+            last_purchase.c.unit_cost,
+        )
+        .outerjoin(sales, sales.c.product_id == Product.id)
+        .outerjoin(last_purchase, last_purchase.c.product_id == Product.id)
+    )
+    return {
+        product_id: {
+            "units_sold": int(total_sold or 0),
+            "last_sale_date": last_sale_date,
+            "last_supplier_id": supplier_id,
+            "last_purchase_cost": money(unit_cost) if unit_cost is not None else None,
+        }
+        for product_id, total_sold, last_sale_date, supplier_id, unit_cost in db_session.execute(stmt)
+    }
+
+def rebuild_product_stats(db_session, apply=True):
+    """
+    Compara product_stats con el historial y, si apply=True, reescribe la tabla.
+    Devuelve la lista de productos con diferencias (drift).
+    """
+    expected = product_stats_from_history(db_session)
+    current = {row.product_id: row for row in db_session.query(ProductStats).all()}
+    drift = []
+    for product_id, values in expected.items():
+        row = current.get(product_id)
+        actual = {
+            "units_sold": row.units_sold if row else None,
+            "last_sale_date": row.last_sale_date if row else None,
+            "last_supplier_id": row.last_supplier_id if row else None,
+            "last_purchase_cost": money(row.last_purchase_cost) if row and row.last_purchase_cost is not None else None,
+        }
+        diffs = {
+            key: {"expected": value, "actual": actual[key]}
+            for key, value in values.items()
+            if value != actual[key]
+        }
+        if diffs:
+            drift.append({"product_id": product_id, "fields": diffs})
+    orphaned = set(current) - set(expected)
+    drift.extend({"product_id": product_id, "fields": "sin producto"} for product_id in sorted(orphaned))
+
+    if apply:
+        # avg_cost no sale de esta comparación (tiene su propio rebuild); se conserva
+        avg_costs = {product_id: row.avg_cost for product_id, row in current.items()}
+        db_session.query(ProductStats).delete()
+        if expected:
+            db_session.execute(insert(ProductStats), [
+                dict(values, product_id=product_id, avg_cost=avg_costs.get(product_id), updated_at=datetime.utcnow())
+                for product_id, values in expected.items()
+            ])
+        bump_catalog_version(db_session)
+        db_session.flush()
+    return drift
+
+PRODUCT_DETAIL_FIELDS = ("supplier_name", "total_sold")
+PRODUCT_FIELDS = (
+    "id", "name", "sku", "price", "price_with_vat", "vat_rate", "vat_amount",
+    "low_stock_threshold", "current_stock", "created_at",
+) + PRODUCT_DETAIL_FIELDS
+
+def encode_product_cursor(name, product_id):
+    raw = json.dumps([name, product_id], ensure_ascii=False).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_product_cursor(cursor):
+    """Devuelve (name, id) a partir del cursor opaco; ValueError si no es válido."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        name, product_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return str(name), int(product_id)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("cursor inválido")
+
+def products_with_details(db_session, fields=None, after=None, limit=None, archived=False):
+    """
+    Equivalente a aplicar product_to_dict_with_details a todo el catálogo,
+    leyendo el resumen de product_stats en una sola consulta.
+
+    fields limita las llaves devueltas (sin supplier_name/total_sold no se
+    consulta product_stats); after=(name, id) y limit paginan por cursor.
+    archived=True lista solo los archivados en lugar del catálogo activo.
+    """
+    wanted = set(fields or PRODUCT_FIELDS)
+    with_details = bool(wanted & set(PRODUCT_DETAIL_FIELDS))
+    if with_details:
+        stmt = (
+            select(Product, ProductStats.units_sold, Supplier.name)
+            .outerjoin(ProductStats, ProductStats.product_id == Product.id)
+            .outerjoin(Supplier, Supplier.id == ProductStats.last_supplier_id)
+        )
+    else:
+        stmt = select(Product)
+    stmt = stmt.where(Product.archived_at.is_not(None) if archived else Product.archived_at.is_(None))
+    if after is not None:
+        stmt = stmt.where(tuple_(Product.name, Product.id) > tuple_(*after))
+    stmt = stmt.order_by(Product.name.asc(), Product.id.asc())
+    if limit is not None:
+        stmt = stmt.limit(limit)
+
+    out = []
+    for row in db_session.execute(stmt):
+        p = row[0]
+        data = product_to_dict(p)
+        if with_details:
+            data["supplier_name"] = row[2] or "Sin proveedor"
+            data["total_sold"] = int(row[1] or 0)
+        if fields:
+            data = {key: data[key] for key in PRODUCT_FIELDS if key in wanted}
+        out.append(data)
+    return out
+
+def search_products(db_session, query, limit=20, use_fts=None):
+    """
+    Busca productos por nombre o SKU (subcadena, sin distinguir mayúsculas).
+    Con FTS5 usa el índice trigram; las coincidencias exactas de SKU van primero.
+    """
+    if use_fts is None:
+        use_fts = PRODUCT_FTS_AVAILABLE
+    if use_fts and len(query) >= PRODUCT_SEARCH_MIN_CHARS:
+        # Frase entre comillas: con trigram equivale a buscar la subcadena completa
+        phrase = '"' + query.replace('"', '""') + '"'
+        stmt = select(Product).from_statement(text(
+            "SELECT products.* FROM products_fts "
+            "JOIN products ON products.id = products_fts.rowid "
+            "WHERE products_fts MATCH :phrase AND products.archived_at IS NULL "
+            "ORDER BY lower(products.sku) = lower(:query) DESC, bm25(products_fts) "
+            "LIMIT :limit"
+        ).bindparams(phrase=phrase, query=query, limit=limit))
+        return list(db_session.scalars(stmt))
+
+    return (
+        db_session.query(Product)
+        .filter(Product.name.ilike(f'%{query}%') | Product.sku.ilike(f'%{query}%'), Product.archived_at.is_(None))
+        .order_by(case((func.lower(Product.sku) == query.lower(), 0), else_=1))
+        .limit(limit)
+        .all()
+    )
+
+def normalize_search_text(value):
+    """Minúsculas y sin tildes, para comparar nombres en español ("Piñón" == "pinon")."""
+    decomposed = unicodedata.normalize("NFKD", value or "")
+    return "".join(ch for ch in decomposed if not unicodedata.combining(ch)).casefold()
+
+class ProductAutocompleteIndex:
+    """
+    Índice invertido en memoria de n-gramas (2 y 3 caracteres) sobre SKU y nombre.
+
+    Responde búsquedas por subcadena sin abrir sesión. Como máximo cada
+    max_age segundos un hilo aparte compara las versiones con la base, así
+    los cambios hechos por otros workers de gunicorn también se reflejan:
+    product_index_version (cambios en los datos de los productos) relee el
+    catálogo; si solo cambió catalog_version (ventas, compras, ajustes) se
+    releen únicamente los productos con movimientos de stock nuevos.
+    """
+    GRAM_SIZES = (2, 3)
+
+    def __init__(self, bind, max_age=2.0):
+        self.bind = bind
+        self.max_age = max_age
+        self._lock = threading.RLock()
+        self._entries = {}  # id -> (texto normalizado, sku normalizado, dict del producto)
+        self._grams = {}    # n-grama -> set de ids
+        self._sync_lock = threading.Lock()     # una sincronización a la vez
+        self._refresh_lock = threading.Lock()  # tomado mientras corre el hilo de ensure_fresh
+        self._version = None
+        self._catalog_version = None
+        self._movement_id = 0  # último stock_movements.id aplicado
+        self._checked_at = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _grams_of(self, value):
+        return {value[i:i + n] for n in self.GRAM_SIZES for i in range(len(value) - n + 1)}
+
+    def _unindex(self, product_id):
+        entry = self._entries.pop(product_id, None)
+        if entry is None:
+            return
+        for gram in self._grams_of(entry[0]):
+            ids = self._grams.get(gram)
+            if ids is not None:
+                ids.discard(product_id)
+                if not ids:
+                    del self._grams[gram]
+
+    def _index(self, data):
+        self._unindex(data["id"])
+        sku = normalize_search_text(data["sku"])
+        # El salto de línea separa SKU y nombre: ninguna búsqueda lo contiene
+        haystack = f"{sku}\n{normalize_search_text(data['name'])}"
+        self._entries[data["id"]] = (haystack, sku, data)
+        for gram in self._grams_of(haystack):
+            self._grams.setdefault(gram, set()).add(data["id"])
+
+    def add(self, data):
+        with self._lock:
+            self._index(data)
+
+    def remove(self, product_id):
+        with self._lock:
+            self._unindex(product_id)
+
+    def sync(self):
+        """
+        Relee el catálogo si cambió product_index_version (solo reindexa
+        productos nuevos o renombrados); si solo cambió catalog_version,
+        actualiza los productos con movimientos posteriores al último visto.
+        """
+        with self._sync_lock:
+            with self.bind.connect() as conn:
+                versions = dict(conn.execute(
+                    select(Sequence.name, Sequence.next_value)
+                    .where(Sequence.name.in_((PRODUCT_INDEX_VERSION_KEY, CATALOG_VERSION_KEY)))
+                ).all())
+                version = versions.get(PRODUCT_INDEX_VERSION_KEY) or 1
+                catalog_version = versions.get(CATALOG_VERSION_KEY) or 1
+                if version == self._version and catalog_version == self._catalog_version:
+                    return False
+                # misma transacción de lectura: el corte de movimientos corresponde a las filas leídas.
+                # SQLite puede reusar ids que un borrado definitivo liberó; ese borrado termina
+                # subiendo product_index_version y la relectura completa corrige lo que faltara.
+                movement_id = conn.execute(select(func.max(StockMovement.id))).scalar() or 0
+                full = version != self._version
+                if full:
+                    rows = conn.execute(select(Product.__table__).where(Product.archived_at.is_(None))).all()
+                else:
+                    moved = (
+                        select(StockMovement.product_id).distinct()
+                        .where(StockMovement.id > self._movement_id, StockMovement.id <= movement_id)
+                    )
+                    rows = conn.execute(
+                        select(Product.__table__).where(Product.id.in_(moved), Product.archived_at.is_(None))
+                    ).all()
+            with self._lock:
+                seen = set()
+                for row in rows:
+                    data = product_to_dict(row)
+                    seen.add(row.id)
+                    entry = self._entries.get(row.id)
+                    if entry and entry[2]["sku"] == data["sku"] and entry[2]["name"] == data["name"]:
+                        self._entries[row.id] = (entry[0], entry[1], data)
+                    elif full:
+                        self._index(data)
+                if full:
+                    for product_id in set(self._entries) - seen:
+                        self._unindex(product_id)
+                self._version = version
+                self._catalog_version = catalog_version
+                self._movement_id = movement_id
+        return True
+
+    def _refresh(self):
+        try:
+            self.sync()
+        except Exception as exc:
+            print(f"Error sincronizando el autocompletado: {exc}")
+        finally:
+            self._refresh_lock.release()
+
+    def ensure_fresh(self, force=False):
+        """
+        Lanza como mucho una sincronización a la vez fuera de la petición;
+        mientras, se responde con lo que hay. force no espera a max_age.
+        """
+        if not force and time.monotonic() - self._checked_at < self.max_age:
+            return
+        if not self._refresh_lock.acquire(blocking=False):
+            return
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.max_age:
+            self._refresh_lock.release()
+            return
+        self._checked_at = now
+        try:
+            threading.Thread(target=self._refresh, name="autocomplete-sync", daemon=True).start()
+        except Exception:
+            self._refresh_lock.release()
+            raise
+
+    def search(self, query, limit=20):
+        self.ensure_fresh()
+        needle = normalize_search_text(query.strip())
+        if not needle:
+            return []
+        with self._lock:
+            size = min(len(needle), max(self.GRAM_SIZES))
+            if size >= min(self.GRAM_SIZES):
+                postings = sorted(
+                    (self._grams.get(needle[i:i + size], set()) for i in range(len(needle) - size + 1)),
+                    key=len,
+                )
+                candidates = set(postings[0]).intersection(*postings[1:])
+            else:
+                candidates = self._entries.keys()
+            matches = (self._entries[pid] for pid in candidates if needle in self._entries[pid][0])
+            # SKU exacto, luego SKU que empieza por la búsqueda, luego por nombre
+            best = heapq.nsmallest(
+                limit, matches,
+                key=lambda e: (e[1] != needle, not e[1].startswith(needle), e[2]["name"], e[2]["id"]),
+            )
+        return [entry[2] for entry in best]
+
+def supplier_to_dict(s: Supplier):
+    return {
+        "id": s.id, "name": s.name, "phone": s.phone, "email": s.email, "address": s.address
+    }
+
+def customer_to_dict(c: Customer):
+    return {
+        "id": c.id,
+        "name": c.name,
+        "document_number": c.document_number,
+        "phone": c.phone,
+        "email": (getattr(c, "email", None) or ""),
+        "address": c.address
+    }
+
+# --------------------
+# Importación masiva de productos
+# --------------------
+PRODUCT_IMPORT_MAX_REPORTED_ERRORS = 1000
+
+def iter_import_rows(stream, fmt:str):
+    """Lee filas de CSV o JSONL sin cargar el archivo completo. Entrega (línea, dict o error)."""
+    text_stream = TextIOWrapper(stream, encoding="utf-8-sig", newline="")
+    if fmt == "csv":
+        reader = csv.DictReader(text_stream)
+        for row in reader:
+            yield reader.line_num, {(k or "").strip().lower(): v for k, v in row.items()}
+        return
+    for line_number, line in enumerate(text_stream, start=1):
+        if not line.strip():
+            continue
+        try:
+            row = json.loads(line)
+        except ValueError as exc:
+            yield line_number, ValueError(f"JSON inválido: {exc}")
+            continue
+        if not isinstance(row, dict):
+            yield line_number, ValueError("Cada línea debe ser un objeto JSON")
+            continue
+        yield line_number, {str(k).strip().lower(): v for k, v in row.items()}
+
+def _import_text(row, key):
+    value = row.get(key)
+    return "" if value is None else str(value).strip()
+
+def parse_import_row(row):
+    """Valida una fila de importación; ValueError con un mensaje para el reporte."""
+    sku = _import_text(row, "sku")
+    name = _import_text(row, "name")
+    if not sku or not name:
+        raise ValueError("name y sku son obligatorios")
+    try:
+        price = money(_import_text(row, "price") or 0)
+        vat_rate = money(_import_text(row, "vat_rate") or Decimal("0.19"))
+        cost = _import_text(row, "cost")
+        cost = money(cost) if cost else None
+    except ArithmeticError:
+        raise ValueError("price, vat_rate y cost deben ser números")
+    try:
+        threshold = int(_import_text(row, "low_stock_threshold") or 5)
+        stock = int(_import_text(row, "stock") or _import_text(row, "initial_stock") or 0)
+    except ValueError:
+        raise ValueError("low_stock_threshold y stock deben ser enteros")
+    if price < 0 or (cost is not None and cost < 0):
+        raise ValueError("price y cost no pueden ser negativos")
+    if not (0 <= vat_rate <= 1):
+        raise ValueError("vat_rate debe estar entre 0 y 1")
+    if threshold < 0 or stock < 0:
+        raise ValueError("low_stock_threshold y stock no pueden ser negativos")
+    return {
+        "sku": sku,
+        "name": name,
+        "price": price,
+        "vat_rate": vat_rate,
+        "low_stock_threshold": threshold,
+        "stock": stock,
+        "supplier": _import_text(row, "supplier"),
+        "cost": cost,
+    }
+
+class ProductImporter:
+    """
+    Importa productos por lotes: upsert por sku, proveedores por nombre y
+    stock inicial como StockMovement "initial" (solo para productos nuevos,
+    así repetir la importación no duplica existencias). Cada lote es una
+    transacción; si un lote falla se reporta y se sigue con el siguiente.
+    """
+    def __init__(self, db, batch_size=PRODUCT_IMPORT_BATCH_SIZE, dry_run=False, on_batch=None):
+        self.db = db
+        self.batch_size = max(1, batch_size)
+        self.dry_run = dry_run
+        self.on_batch = on_batch
+        self.suppliers = {}
+        self.summary = {"rows": 0, "created": 0, "updated": 0, "error_count": 0, "errors": [], "batches": 0}
+
+    def _error(self, line, sku, message):
+        self.summary["error_count"] += 1
+        if len(self.summary["errors"]) < PRODUCT_IMPORT_MAX_REPORTED_ERRORS:
+            self.summary["errors"].append({"line": line, "sku": sku, "error": message})
+
+    def run(self, rows):
+        started = time.perf_counter()
+        batch = {}
+        for line, row in rows:
+            self.summary["rows"] += 1
+            if isinstance(row, Exception):
+                self._error(line, "", str(row))
+                continue
+            try:
+                parsed = parse_import_row(row)
+            except ValueError as exc:
+                self._error(line, _import_text(row, "sku"), str(exc))
+                continue
+            parsed["line"] = line
+            batch[parsed["sku"]] = parsed  # si el sku se repite en el lote, gana la última fila
+            if len(batch) >= self.batch_size:
+                self._flush(batch)
+                batch = {}
+        if batch:
+            self._flush(batch)
+        elapsed = time.perf_counter() - started
+        self.summary["seconds"] = round(elapsed, 3)
+        self.summary["rows_per_second"] = round(self.summary["rows"] / elapsed, 1) if elapsed else None
+        return self.summary
+
+    def _supplier_ids(self, names):
+        missing = [n for n in names if n and n not in self.suppliers]
+        if missing:
+            for supplier_id, name in self.db.execute(select(Supplier.id, Supplier.name).where(Supplier.name.in_(missing))):
+                self.suppliers.setdefault(name, supplier_id)
+            new_names = [n for n in missing if n not in self.suppliers]
+            if new_names:
+                created = self.db.execute(
+                    insert(Supplier).returning(Supplier.id, Supplier.name),
+                    [{"name": n} for n in new_names],
+                )
+                for supplier_id, name in created:
+                    self.suppliers[name] = supplier_id
+
+    def _flush(self, batch):
+        db = self.db
+        self.summary["batches"] += 1
+        known_suppliers = dict(self.suppliers)
+        try:
+            existing = {
+                sku: product_id for product_id, sku in
+                db.execute(select(Product.id, Product.sku).where(Product.sku.in_(list(batch))))
+            }
+            # Como la restauración manual: cancela los borrados pendientes y no toca los que ya empezaron
+            purging = cancel_pending_product_purges(db, list(existing.values()))
+            for sku, product_id in existing.items():
+                if product_id in purging:
+                    self._error(batch[sku]["line"], sku, "El borrado definitivo del producto está en curso")
+            self._supplier_ids({row["supplier"] for row in batch.values()})
+            new_rows = [row for sku, row in batch.items() if sku not in existing]
+            updated_rows = [row for sku, row in batch.items() if sku in existing and existing[sku] not in purging]
+            now = datetime.utcnow()
+
+            created_ids = {}
+            if new_rows:
+                for product_id, sku in db.execute(
+                    insert(Product).returning(Product.id, Product.sku),
+                    [{
+                        "sku": row["sku"], "name": row["name"], "price": row["price"], "vat_rate": row["vat_rate"],
+                        "low_stock_threshold": row["low_stock_threshold"], "current_stock": row["stock"], "created_at": now,
+                    } for row in new_rows],
+                ):
+                    created_ids[sku] = product_id
+                db.execute(insert(ProductStats), [{
+                    "product_id": created_ids[row["sku"]],
+                    "units_sold": 0,
+                    "last_supplier_id": self.suppliers.get(row["supplier"]),
+                    "last_purchase_cost": row["cost"],
+                    "avg_cost": row["cost"],  # el inventario inicial entra al costo importado
+                } for row in new_rows])
+                opening = [row for row in new_rows if row["stock"] > 0]
+                if opening:
+                    db.execute(insert(StockMovement), [{
+                        "product_id": created_ids[row["sku"]],
+                        "movement_type": "initial",
+                        "quantity_change": row["stock"],
+                        "note": "Inventario inicial (importación)",
+                        "reference_type": "import",
+                        "unit_cost": row["cost"],
+                        "created_at": now,
+                    } for row in opening])
+
+            if updated_rows:
+                db.execute(update(Product), [{
+                    "id": existing[row["sku"]], "name": row["name"], "price": row["price"],
+                    "vat_rate": row["vat_rate"], "low_stock_threshold": row["low_stock_threshold"],
+                    "archived_at": None,  # volver a importar un SKU archivado lo restaura
+                } for row in updated_rows])
+                with_supplier = [row for row in updated_rows if row["supplier"] or row["cost"] is not None]
+                if with_supplier:
+                    ensure_product_stats_rows(db, [existing[row["sku"]] for row in with_supplier])
+                    for row in with_supplier:
+                        values = {}
+                        if row["supplier"]:
+                            values["last_supplier_id"] = self.suppliers[row["supplier"]]
+                        if row["cost"] is not None:
+                            values["last_purchase_cost"] = row["cost"]
+                        db.execute(update(ProductStats).where(ProductStats.product_id == existing[row["sku"]]).values(**values))
+
+            bump_product_index_version(db)
+            if self.dry_run:
+                db.rollback()
+                self.suppliers = known_suppliers
+            else:
+                db.commit()
+            self.summary["created"] += len(new_rows)
+            self.summary["updated"] += len(updated_rows)
+        except Exception as exc:
+            db.rollback()
+            self.suppliers = known_suppliers
+            for row in batch.values():
+                self._error(row["line"], row["sku"], f"Lote no importado: {exc}")
+        if self.on_batch:
+            self.on_batch(self.summary)
+
+def import_format_for(name:str, content_type:str="") -> str:
+    name = (name or "").lower()
+    content_type = (content_type or "").lower()
+    if name in ("csv", "jsonl"):
+        return name
+    if name.endswith((".jsonl", ".ndjson")) or "ndjson" in content_type or "jsonl" in content_type:
+        return "jsonl"
+    return "csv"
+
+# --------------------
+# Cierres mensuales del ledger de stock
+# --------------------
+STOCK_CHECKPOINT_KEY = "stock_checkpoint_month"  # en sequences: inicio del mes siguiente al último cerrado (año*12 + mes-1)
+LEDGER_EPOCH = datetime(1900, 1, 1)
+
+def month_start(moment):
+    return datetime(moment.year, moment.month, 1)
+
+def next_month_start(moment):
+    return datetime(moment.year + moment.month // 12, moment.month % 12 + 1, 1)
+
+def _month_number(moment):
+    return moment.year * 12 + moment.month - 1
+
+def _month_from_number(number):
+    return datetime(number // 12, number % 12 + 1, 1)
+
+def last_closed_month(db):
+    """Inicio del mes siguiente al último cierre (period_end del último mes cerrado), o None."""
+    number = db.scalar(select(Sequence.next_value).where(Sequence.name == STOCK_CHECKPOINT_KEY))
+    return _month_from_number(number) if number is not None else None
+
+def close_stock_checkpoints(db, until=None):
+    """
+    Cierra, uno por uno, los meses completos que aún no tienen cierre.
+
+    Solo se escribe fila para los productos con movimientos en el mes; su
+    saldo es el cierre anterior del producto más los movimientos del mes.
+    Un mes se cierra cuando terminó hace más de STOCK_CHECKPOINT_GRACE_HOURS,
+    para no dejar fuera ventas que hacían commit justo al cambio de mes. El
+    avance vive en sequences y se mueve con un UPDATE condicional en la misma
+    transacción del mes: si otro worker ya lo cerró, este se detiene.
+    Devuelve las filas escritas.
+    """
+    limit = month_start(until or (datetime.utcnow() - timedelta(hours=STOCK_CHECKPOINT_GRACE_HOURS)))
+    closed = last_closed_month(db)
+    if closed is None:
+        first = db.scalar(select(func.min(StockMovement.created_at)))
+        if first is None:
+            return 0
+        closed = month_start(first)
+        try:
+            db.add(Sequence(name=STOCK_CHECKPOINT_KEY, next_value=_month_number(closed)))
+            db.commit()
+        except IntegrityError:
+            db.rollback()
+            closed = last_closed_month(db)
+
+    written = 0
+    while next_month_start(closed) <= limit:
+        start, end = closed, next_month_start(closed)
+        claimed = db.execute(
+            update(Sequence)
+            .where(Sequence.name == STOCK_CHECKPOINT_KEY, Sequence.next_value == _month_number(start))
+            .values(next_value=_month_number(end))
+        ).rowcount
+        if not claimed:
+            db.rollback()
+            break
+        month = (
+            select(
+                StockMovement.product_id,
+                func.sum(StockMovement.quantity_change).label("delta"),
+                func.count(StockMovement.id).label("moves"),
+            )
+            .where(StockMovement.created_at >= start, StockMovement.created_at < end, StockMovement.product_id.is_not(None))
+            .group_by(StockMovement.product_id)
+            .subquery()
+        )
+        previous = (
+            select(StockCheckpoint.balance)
+            .where(StockCheckpoint.product_id == month.c.product_id, StockCheckpoint.period_end <= start)
+            .order_by(StockCheckpoint.period_end.desc())
+            .limit(1)
+            .scalar_subquery()
+        )
+        now = datetime.utcnow()
+        result = db.execute(
+            insert(StockCheckpoint).from_select(
+                ["product_id", "period_end", "balance", "movements", "created_at"],
+                select(
+                    month.c.product_id,
+                    literal(end, DateTime),
+                    func.coalesce(previous, 0) + month.c.delta,
+                    month.c.moves,
+                    literal(now, DateTime),
+                ),
+            )
+        )
+        db.commit()
+        written += max(result.rowcount or 0, 0)
+        closed = end
+    return written
+
+def rebuild_stock_checkpoints(db):
+    """Borra los cierres y los recalcula desde el primer movimiento."""
+    db.execute(delete(StockCheckpoint))
+    db.execute(delete(Sequence).where(Sequence.name == STOCK_CHECKPOINT_KEY))
+    db.commit()
+    return close_stock_checkpoints(db)
+
+def ledger_balance_select(at=None, product_ids=None):
+    """
+    Consulta (id, sku, name, current_stock, ledger): el stock según el ledger
+    al instante `at` (movimientos con created_at < at; sin `at`, todos). Por
+    producto toma el último cierre <= at y suma solo la cola de movimientos
+    posteriores con el índice (product_id, created_at).
+    """
+    def latest(column):
+        stmt = select(column).where(StockCheckpoint.product_id == Product.id)
+        if at is not None:
+            stmt = stmt.where(StockCheckpoint.period_end <= at)
+        return stmt.order_by(StockCheckpoint.period_end.desc()).limit(1).correlate(Product).scalar_subquery()
+
+    checkpoint_end = func.coalesce(latest(StockCheckpoint.period_end), literal(LEDGER_EPOCH, DateTime))
+    tail = select(func.sum(StockMovement.quantity_change)).where(
+        StockMovement.product_id == Product.id,
+        StockMovement.created_at >= checkpoint_end,
+    )
+    if at is not None:
+        tail = tail.where(StockMovement.created_at < at)
+    ledger = func.coalesce(latest(StockCheckpoint.balance), 0) + func.coalesce(tail.correlate(Product).scalar_subquery(), 0)
+    stmt = select(Product.id, Product.sku, Product.name, Product.current_stock, ledger.label("ledger"))
+    if product_ids:
+        stmt = stmt.where(Product.id.in_(product_ids))
+    return stmt.order_by(Product.id.asc())
+
+def stock_at(db, at, product_ids=None):
+    """{product_id: stock} al instante `at` según el ledger."""
+    return {row.id: int(row.ledger) for row in db.execute(ledger_balance_select(at, product_ids))}
+
+def reconcile_stock(db, product_ids=None):
+    """Compara current_stock con el ledger (último cierre + movimientos posteriores). Devuelve las diferencias."""
+    stmt = ledger_balance_select(None, product_ids)
+    mismatches = []
+    checked = 0
+    for row in db.execute(stmt):
+        checked += 1
+        if int(row.current_stock or 0) != int(row.ledger):
+            mismatches.append({
+                "product_id": row.id,
+                "sku": row.sku,
+                "name": row.name,
+                "current_stock": int(row.current_stock or 0),
+                "ledger": int(row.ledger),
+                "difference": int(row.current_stock or 0) - int(row.ledger),
+            })
+    return checked, mismatches
+
+_stock_checkpoint_lock = threading.Lock()
+_stock_checkpoint_threads = []
+
+def _stock_checkpoint_loop(interval_seconds=STOCK_CHECKPOINT_INTERVAL_SECONDS):
+    while True:
+        db = SessionLocal.session_factory()
+        try:
+            written = close_stock_checkpoints(db)
+            if written:
+                print(f"[stock] {written} cierres mensuales escritos")
+        except Exception as exc:
+            db.rollback()
+            print(f"Error cerrando meses de stock: {exc}")
+        finally:
+            db.close()
+        time.sleep(interval_seconds)
+
+def ensure_stock_checkpoint_scheduler():
+    """Un hilo por proceso; el UPDATE condicional del avance evita cierres duplicados entre workers."""
+    if not STOCK_CHECKPOINTS_AUTO:
+        return
+    if _stock_checkpoint_threads and _stock_checkpoint_threads[0].is_alive():
+        return
+    with _stock_checkpoint_lock:
+        _stock_checkpoint_threads[:] = [t for t in _stock_checkpoint_threads if t.is_alive()]
+        if not _stock_checkpoint_threads:
+            worker = threading.Thread(target=_stock_checkpoint_loop, name="stock-checkpoints", daemon=True)
+            worker.start()
+            _stock_checkpoint_threads.append(worker)
+
+# --------------------
+# Costo promedio ponderado, valorización y márgenes
+# --------------------
+AVG_COST_REBUILD_BATCH = 5000
+SALE_ITEM_MODELS = {"invoice": (InvoiceItem, "invoice_id"), "remission": (RemissionItem, "remission_id")}
+
+def _write_sale_line_costs(db, pending):
+    """pending: {tipo: [(documento, producto, costo)]}; un executemany por tabla."""
+    for kind, rows in pending.items():
+        if not rows:
+            continue
+        model, fk = SALE_ITEM_MODELS[kind]
+        table = model.__table__
+        db.execute(
+            update(table)
+            .where(table.c[fk] == bindparam("b_doc"), table.c.product_id == bindparam("b_pid"))
+            .values(unit_cost=bindparam("b_cost")),
+            [{"b_doc": doc, "b_pid": pid, "b_cost": cost} for doc, pid, cost in rows],
+        )
+        rows.clear()
+
+def rebuild_average_costs(db):
+    """
+    Recalcula product_stats.avg_cost y el costo de cada línea de venta
+    reproduciendo stock_movements en orden. Las compras entran a su costo
+    (promedio de las líneas del producto en esa compra), el inventario
+    inicial al costo importado y los demás ingresos al promedio vigente; las
+    ventas toman el promedio del momento. El costo del inventario inicial se
+    lee del propio movimiento (last_purchase_cost cambia con cada compra). Es O(historial): solo para
+    backfill o correcciones, el camino normal se mantiene al registrar compras.
+    Devuelve {"products", "sale_lines", "seconds"}.
+    """
+    started = time.perf_counter()
+    purchase_costs = (
+        select(
+            PurchaseItem.purchase_id,
+            PurchaseItem.product_id,
+            (func.sum(PurchaseItem.unit_cost * PurchaseItem.quantity) / func.sum(PurchaseItem.quantity)).label("unit_cost"),
+        )
+        .group_by(PurchaseItem.purchase_id, PurchaseItem.product_id)
+        .subquery()
+    )
+    stmt = (
+        select(
+            StockMovement.product_id,
+            StockMovement.movement_type,
+            StockMovement.quantity_change,
+            StockMovement.reference_id,
+            func.coalesce(purchase_costs.c.unit_cost, StockMovement.unit_cost),
+        )
+        .outerjoin(purchase_costs, and_(
+            StockMovement.reference_type == "purchase",
+            purchase_costs.c.purchase_id == StockMovement.reference_id,
+            purchase_costs.c.product_id == StockMovement.product_id,
+        ))
+        .where(StockMovement.product_id.is_not(None))
+        .order_by(StockMovement.created_at.asc(), StockMovement.id.asc())
+    )
+    state = {}  # product_id -> [existencias, promedio]
+    pending = {kind: [] for kind in SALE_ITEM_MODELS}
+    sale_lines = 0
+    for product_id, movement_type, change, reference_id, unit_cost in db.execute(stmt, execution_options={"yield_per": AVG_COST_REBUILD_BATCH}):
+        entry = state.setdefault(product_id, [0, None])
+        change = int(change or 0)
+        if change > 0 and unit_cost is not None:
+            entry[1] = weighted_average_cost(entry[0], entry[1], change, Decimal(str(unit_cost)))
+        elif change < 0 and movement_type in SALE_ITEM_MODELS and reference_id is not None:
+            pending[movement_type].append((reference_id, product_id, entry[1]))
+            sale_lines += 1
+            if sale_lines % AVG_COST_REBUILD_BATCH == 0:
+                _write_sale_line_costs(db, pending)
+        entry[0] += change
+    _write_sale_line_costs(db, pending)
+
+    db.execute(update(ProductStats).values(avg_cost=None), execution_options={"synchronize_session": False})
+    averages = {pid: avg for pid, (_, avg) in state.items() if avg is not None}
+    if averages:
+        ensure_product_stats_rows(db, list(averages))
+        stats = ProductStats.__table__
+        db.execute(
+            update(stats).where(stats.c.product_id == bindparam("b_pid")).values(avg_cost=bindparam("b_cost")),
+            [{"b_pid": pid, "b_cost": avg} for pid, avg in averages.items()],
+        )
+    db.expire_all()
+    return {"products": len(averages), "sale_lines": sale_lines, "seconds": round(time.perf_counter() - started, 3)}
+
+def inventory_valuation(db):
+    """
+    Existencias valorizadas al costo promedio: una sola consulta sobre
+    productos + product_stats, O(productos). Las existencias negativas
+    valen 0; los productos sin costo se cuentan aparte.
+    """
+    stmt = (
+        select(Product.id, Product.sku, Product.name, Product.current_stock, ProductStats.avg_cost)
+        .outerjoin(ProductStats, ProductStats.product_id == Product.id)
+        .order_by(Product.name.asc(), Product.id.asc())
+    )
+    items = []
+    total_units = 0
+    total_value = Decimal("0.00")
+    without_cost = 0
+    for product_id, sku, name, stock, avg_cost in db.execute(stmt):
+        stock = int(stock or 0)
+        value = money(Decimal(avg_cost) * max(stock, 0)) if avg_cost is not None else None
+        if avg_cost is None and stock > 0:
+            without_cost += 1
+        total_units += max(stock, 0)
+        total_value += value or Decimal("0.00")
+        items.append({
+            "product_id": product_id,
+            "sku": sku,
+            "name": name,
+            "stock": stock,
+            "avg_cost": float(avg_cost) if avg_cost is not None else None,
+            "value": float(value) if value is not None else None,
+        })
     return {
-        "id": s.id, "name": s.name, "phone": s.phone, "email": s.email, "address": s.address
+        "items": items,
+        "total_units": total_units,
+        "total_value": float(money(total_value)),
+        "products_without_cost": without_cost,
     }
 
-def customer_to_dict(c: Customer):
+def _document_margin_select(kind, start, end):
+    model, fk = SALE_ITEM_MODELS[kind]
+    document = Invoice if kind == "invoice" else Remission
+    cost = model.unit_cost * model.quantity
+    return (
+        select(
+            literal(kind).label("kind"),
+            document.id,
+            document.number,
+            document.date,
+            func.sum(model.total_excl_vat).label("revenue"),
+            func.sum(cost).label("cost"),
+            func.sum(case((model.unit_cost.is_(None), 1), else_=0)).label("lines_without_cost"),
+        )
+        .join(document, document.id == getattr(model, fk))
+        .where(document.date >= start, document.date < end)
+        .group_by(document.id, document.number, document.date)
+    )
+
+def sales_margins(db, start, end):
+    """
+    Margen bruto por venta (facturas y remisiones) entre start y end
+    (datetime, end excluido) con el costo guardado en cada línea al vender:
+    no relee compras ni movimientos. Las líneas sin costo no suman costo y
+    se reportan en lines_without_cost.
+    """
+    union = union_all(_document_margin_select("invoice", start, end), _document_margin_select("remission", start, end)).subquery()
+    rows = db.execute(select(union).order_by(union.c.date.desc(), union.c.id.desc())).all()
+    documents = []
+    revenue_total = Decimal("0.00")
+    cost_total = Decimal("0.00")
+    for row in rows:
+        revenue = money(row.revenue or 0)
+        cost = money(row.cost or 0)
+        revenue_total += revenue
+        cost_total += cost
+        documents.append({
+            "kind": row.kind,
+            "id": row.id,
+            "number": row.number,
+            "date": row.date.isoformat() if row.date else None,
+            "revenue": float(revenue),
+            "cost": float(cost),
+            "margin": float(revenue - cost),
+            "margin_pct": round(float((revenue - cost) / revenue * 100), 2) if revenue else None,
+            "lines_without_cost": int(row.lines_without_cost or 0),
+        })
     return {
-        "id": c.id,
-        "name": c.name,
-        "document_number": c.document_number,
-        "phone": c.phone,
-        "email": (getattr(c, "email", None) or ""),
-        "address": c.address
+        "documents": documents,
+        "revenue": float(revenue_total),
+        "cost": float(cost_total),
+        "margin": float(revenue_total - cost_total),
+        "margin_pct": round(float((revenue_total - cost_total) / revenue_total * 100), 2) if revenue_total else None,
+    }
+
+# --------------------
+# Resúmenes diarios de ventas
+# --------------------
+SALES_ROLLUP_MEASURES = ("documents", "lines", "units", "revenue", "vat", "total", "cost")
+SALES_REPORT_GROUPS = {"day": "day", "product": "product_id", "payment_method": "payment_method"}
+# Fila de un documento antes de sumar sus líneas; se copia con dict(), los Decimal son inmutables
+SALES_ROLLUP_BASE = {"documents": 1, "lines": 0, "units": 0, "revenue": Decimal("0"), "vat": Decimal("0"), "total": Decimal("0"), "cost": Decimal("0")}
+
+def _upsert_sales_rollup(db, model, keys, rows):
+    if not rows:
+        return
+    stmt = sqlite_insert(model)
+    table = model.__table__
+    stmt = stmt.on_conflict_do_update(
+        index_elements=list(keys),
+        set_={name: table.c[name] + stmt.excluded[name] for name in SALES_ROLLUP_MEASURES},
+    )
+    db.execute(stmt, rows)
+
+def record_sales_rollup(db, kind:str, document, lines):
+    """
+    Suma una venta a los resúmenes dentro de su transacción: una fila por
+    producto (del día y del mes) y una por método de pago, con INSERT ... ON
+    CONFLICT DO UPDATE para que dos ventas del mismo día no compitan por leer
+    y reescribir la fila.
+    """
+    day = (document.date or datetime.utcnow()).date()
+    payment = dict(SALES_ROLLUP_BASE, day=day, kind=kind, payment_method=document.payment_method or "")
+    by_product = {}
+    for line in lines:
+        row = by_product.setdefault(line["product_id"], dict(SALES_ROLLUP_BASE, day=day, kind=kind, product_id=line["product_id"]))
+        cost = Decimal(line["unit_cost"]) * line["quantity"] if line.get("unit_cost") is not None else Decimal("0")
+        for target in (row, payment):
+            target["lines"] += 1
+            target["units"] += line["quantity"]
+            target["revenue"] += line["total_excl_vat"]
+            target["vat"] += line["vat_amount"]
+            target["total"] += line["total_incl_vat"]
+            target["cost"] += cost
+    _upsert_sales_rollup(db, SalesDailyProduct, ("day", "kind", "product_id"), list(by_product.values()))
+    month = day.replace(day=1)
+    _upsert_sales_rollup(db, SalesMonthlyProduct, ("day", "kind", "product_id"), [dict(row, day=month) for row in by_product.values()])
+    _upsert_sales_rollup(db, SalesDailyPayment, ("day", "kind", "payment_method"), [payment])
+
+def _sales_history_select(kind:str, by, start=None, end=None):
+    """
+    Agregado directo sobre facturas/remisiones y sus líneas agrupado por las
+    columnas de `by` (day, month, product_id, payment_method); start/end son
+    datetime (end excluido). Es lo que reemplazan los resúmenes: recorre
+    todas las líneas del rango.
+    """
+    model, fk = SALE_ITEM_MODELS[kind]
+    document = Invoice if kind == "invoice" else Remission
+    keys = {
+        "day": func.date(document.date, type_=Date),
+        "month": func.date(document.date, "start of month", type_=Date),
+        "product_id": model.product_id,
+        "payment_method": func.coalesce(document.payment_method, ""),
+    }
+    measures = {
+        "documents": func.count(func.distinct(document.id)),
+        "lines": func.count(model.id),
+        "units": func.coalesce(func.sum(model.quantity), 0),
+        "revenue": func.coalesce(func.sum(model.total_excl_vat), 0, type_=Float),
+        "vat": func.coalesce(func.sum(model.vat_amount), 0, type_=Float),
+        "total": func.coalesce(func.sum(model.total_incl_vat), 0, type_=Float),
+        "cost": func.coalesce(func.sum(model.unit_cost * model.quantity), 0, type_=Float),
+    }
+    stmt = (
+        select(*[keys[name].label(name) for name in by], literal(kind).label("kind"), *[measures[name].label(name) for name in SALES_ROLLUP_MEASURES])
+        .select_from(document)
+        .outerjoin(model, getattr(model, fk) == document.id)
+        .group_by(*[keys[name] for name in by])
+    )
+    if "product_id" in by:
+        stmt = stmt.where(model.product_id.is_not(None))
+    if start is not None:
+        stmt = stmt.where(document.date >= start)
+    if end is not None:
+        stmt = stmt.where(document.date < end)
+    return stmt
+
+def rebuild_sales_rollups(db, start=None, end=None):
+    """
+    Reescribe los resúmenes entre start y end (date, incluidos; sin ellos,
+    todo el historial) con INSERT ... SELECT agrupado. El rango se amplía a
+    meses completos para que el resumen mensual quede entero. Devuelve las filas escritas.
+    """
+    start = month_start(start).date() if start else None
+    end = (next_month_start(end) - timedelta(days=1)).date() if end else None
+    start_at = datetime.combine(start, datetime.min.time()) if start else None
+    end_at = datetime.combine(end + timedelta(days=1), datetime.min.time()) if end else None
+    written = 0
+    targets = (
+        (SalesDailyProduct, ("day", "product_id")),
+        (SalesMonthlyProduct, ("month", "product_id")),
+        (SalesDailyPayment, ("day", "payment_method")),
+    )
+    for model, by in targets:
+        stmt = delete(model)
+        if start:
+            stmt = stmt.where(model.day >= start)
+        if end:
+            stmt = stmt.where(model.day <= end)
+        db.execute(stmt)
+        for kind in SALE_ITEM_MODELS:
+            result = db.execute(insert(model).from_select(
+                ["day", by[1], "kind", *SALES_ROLLUP_MEASURES],
+                _sales_history_select(kind, by, start_at, end_at),
+            ))
+            written += max(result.rowcount or 0, 0)
+    return written
+
+def _sales_report_rows(rows, group):
+    """Da formato a las filas agregadas; los montos van como float redondeado (solo para el JSON)."""
+    items = []
+    for key, kind, documents, lines, units, revenue, vat, total, cost in rows:
+        revenue, cost = round(float(revenue or 0), 2), round(float(cost or 0), 2)
+        items.append({
+            group: key.isoformat() if isinstance(key, date) else key,
+            "kind": kind,
+            "documents": int(documents or 0),
+            "lines": int(lines or 0),
+            "units": int(units or 0),
+            "revenue": revenue,
+            "vat": round(float(vat or 0), 2),
+            "total": round(float(total or 0), 2),
+            "cost": cost,
+            "margin": round(revenue - cost, 2),
+        })
+    totals = {}
+    for bucket in sorted({item["kind"] for item in items}) + (["all"] if items else []):
+        selected = [item for item in items if bucket in ("all", item["kind"])]
+        summary = {name: sum(item[name] for item in selected) for name in ("lines", "units")}
+        summary.update({name: round(sum(item[name] for item in selected), 2) for name in ("revenue", "vat", "total", "cost")})
+        summary["margin"] = round(summary["revenue"] - summary["cost"], 2)
+        totals[bucket] = summary
+    return {"items": items, "totals": totals}
+
+def _rollup_select(model, group, start, end, kind):
+    """Filas de un resumen con day en [start, end) (date)."""
+    stmt = select(getattr(model, group).label(group), model.kind, *[getattr(model, name) for name in SALES_ROLLUP_MEASURES])
+    stmt = stmt.where(model.day >= start, model.day < end)
+    if kind:
+        stmt = stmt.where(model.kind == kind)
+    return stmt
+
+def sales_report(db, start, end, group:str="day", kind:str|None=None):
+    """
+    Ventas entre start y end (date, incluidos) agrupadas por día, producto
+    (product_id) o método de pago, separadas por tipo de documento. Lee solo
+    los resúmenes; por producto toma los meses completos del resumen mensual
+    y los días sueltos de los extremos del diario.
+    """
+    end_excl = end + timedelta(days=1)
+    if group != "product_id":
+        parts = [_rollup_select(SalesDailyPayment, group, start, end_excl, kind)]
+    else:
+        first_month = start if start.day == 1 else next_month_start(start).date()
+        last_month = month_start(end_excl).date()  # inicio del mes que end no completa
+        if first_month < last_month:
+            parts = [
+                _rollup_select(SalesMonthlyProduct, group, first_month, last_month, kind),
+                _rollup_select(SalesDailyProduct, group, start, first_month, kind),
+                _rollup_select(SalesDailyProduct, group, last_month, end_excl, kind),
+            ]
+        else:
+            parts = [_rollup_select(SalesDailyProduct, group, start, end_excl, kind)]
+    rows = union_all(*parts).subquery() if len(parts) > 1 else parts[0].subquery()
+    stmt = (
+        select(rows.c[group], rows.c.kind, *[func.sum(rows.c[name], type_=Float).label(name) for name in SALES_ROLLUP_MEASURES])
+        .group_by(rows.c[group], rows.c.kind)
+        .order_by(rows.c[group], rows.c.kind)
+    )
+    return _sales_report_rows(db.execute(stmt).all(), group)
+
+def sales_report_from_history(db, start, end, group:str="day", kind:str|None=None):
+    """El mismo informe calculado sobre las líneas de venta (para comparar en bench-sales-report)."""
+    start_at = datetime.combine(start, datetime.min.time())
+    end_at = datetime.combine(end + timedelta(days=1), datetime.min.time())
+    kinds = [kind] if kind else list(SALE_ITEM_MODELS)
+    union = union_all(*[_sales_history_select(k, (group,), start_at, end_at) for k in kinds]).subquery()
+    stmt = select(union).order_by(union.c[group], union.c.kind)
+    return _sales_report_rows(db.execute(stmt).all(), group)
+
+# --------------------
+# Archivo y borrado definitivo de productos
+# --------------------
+PRODUCT_PURGE_STEPS = (
+    ("purchase_items", PurchaseItem, Purchase, "purchase_id"),
+    ("invoice_items", InvoiceItem, Invoice, "invoice_id"),
+    ("remission_items", RemissionItem, Remission, "remission_id"),
+)
+
+_product_purge_wakeup = threading.Event()
+_product_purge_lock = threading.Lock()
+_product_purge_threads = []
+
+def archive_product(db, product):
+    """Saca el producto del catálogo, la búsqueda y las ventas nuevas sin tocar su historial."""
+    if product.archived_at is None:
+        product.archived_at = datetime.utcnow()
+        bump_product_index_version(db)
+    return product.archived_at
+
+def active_product_purge(db, product_id:int):
+    return db.query(ProductPurgeJob).filter(
+        ProductPurgeJob.product_id == product_id,
+        ProductPurgeJob.status.in_(("pending", "running")),
+    ).first()
+
+def cancel_pending_product_purges(db, product_ids):
+    """
+    Cancela los borrados que aún no empezaron; devuelve los productos cuyo
+    borrado ya está en curso (esos no se pueden restaurar). El UPDATE toma
+    el candado de escritura antes de leer, así un worker no los reclama entre tanto.
+    """
+    if not product_ids:
+        return set()
+    db.execute(
+        update(ProductPurgeJob)
+        .where(ProductPurgeJob.product_id.in_(product_ids), ProductPurgeJob.status == "pending")
+        .values(status="cancelled", finished_at=datetime.utcnow())
+    )
+    return set(db.execute(
+        select(ProductPurgeJob.product_id)
+        .where(ProductPurgeJob.product_id.in_(product_ids), ProductPurgeJob.status == "running")
+    ).scalars())
+
+def request_product_purge(db, product):
+    """Archiva el producto y encola su borrado definitivo (uno activo por producto)."""
+    archive_product(db, product)
+    job = active_product_purge(db, product.id)
+    if job is None:
+        job = ProductPurgeJob(product_id=product.id, sku=product.sku)
+        db.add(job)
+        db.flush()
+    return job
+
+def product_purge_job_to_dict(job):
+    return {
+        "id": job.id,
+        "product_id": job.product_id,
+        "sku": job.sku,
+        "status": job.status,
+        "step": job.step,
+        "total": job.total or 0,
+        "done": job.done or 0,
+        "progress": round((job.done or 0) / job.total, 3) if job.total else (1.0 if job.status == "done" else 0.0),
+        "documents_updated": job.documents_updated or 0,
+        "error": job.error or "",
+        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "finished_at": job.finished_at.isoformat() if job.finished_at else None,
+    }
+
+def _purge_claimable_filter(now):
+    stale_before = now - timedelta(seconds=PRODUCT_PURGE_JOB_TIMEOUT)
+    return or_(
+        ProductPurgeJob.status == "pending",
+        and_(ProductPurgeJob.status == "running", ProductPurgeJob.claimed_at < stale_before),
+    )
+
+def claim_product_purge_job(db):
+    """Mismo reclamo condicional que la cola de PDFs; un trabajo retomado sigue donde quedó."""
+    while True:
+        now = datetime.utcnow()
+        job_id = db.execute(
+            select(ProductPurgeJob.id).where(_purge_claimable_filter(now)).order_by(ProductPurgeJob.id).limit(1)
+        ).scalar()
+        if job_id is None:
+            db.commit()
+            return None
+        claimed = db.execute(
+            update(ProductPurgeJob)
+            .where(ProductPurgeJob.id == job_id, _purge_claimable_filter(now))
+            .values(status="running", claimed_at=now)
+        ).rowcount
+        db.commit()
+        if claimed:
+            return db.get(ProductPurgeJob, job_id)
+
+def _purge_sale_dates(db, job):
+    """Amplía el rango de días de venta afectados con las líneas que aún quedan."""
+    for kind, (item, fk) in SALE_ITEM_MODELS.items():
+        document = Invoice if kind == "invoice" else Remission
+        first, last = db.execute(
+            select(func.min(document.date), func.max(document.date))
+            .join(item, getattr(item, fk) == document.id)
+            .where(item.product_id == job.product_id)
+        ).one()
+        if first is not None:
+            job.first_sale_date = min(filter(None, (job.first_sale_date, first.date())))
+            job.last_sale_date = max(filter(None, (job.last_sale_date, last.date())))
+
+def _subtract_payment_rollups(db, kind, document, rows):
+    """
+    Resta de sales_daily_payments las líneas de venta borradas en un lote
+    (rows: documento, cantidad, subtotal, IVA, total, costo unitario). Los
+    documentos siguen existiendo, así que su conteo no cambia.
+    """
+    doc_ids = {row[0] for row in rows}
+    documents = {
+        doc_id: ((doc_date or datetime.utcnow()).date(), method or "")
+        for doc_id, doc_date, method in db.execute(
+            select(document.id, document.date, document.payment_method).where(document.id.in_(doc_ids))
+        )
     }
+    totals = {}
+    for doc_id, quantity, revenue, vat, total, unit_cost in rows:
+        target = totals.setdefault(documents[doc_id], dict(SALES_ROLLUP_BASE, documents=0))
+        target["lines"] += 1
+        target["units"] += int(quantity or 0)
+        target["revenue"] += Decimal(revenue or 0)
+        target["vat"] += Decimal(vat or 0)
+        target["total"] += Decimal(total or 0)
+        target["cost"] += Decimal(unit_cost) * int(quantity or 0) if unit_cost is not None else Decimal("0")
+    table = SalesDailyPayment.__table__
+    db.execute(
+        update(table)
+        .where(table.c.day == bindparam("b_day"), table.c.kind == kind, table.c.payment_method == bindparam("b_method"))
+        .values(**{name: table.c[name] - bindparam(f"b_{name}") for name in SALES_ROLLUP_MEASURES if name != "documents"}),
+        [
+            {"b_day": day, "b_method": method, **{f"b_{name}": value for name, value in measures.items() if name != "documents"}}
+            for (day, method), measures in totals.items()
+        ],
+    )
+
+def run_product_purge_job(db, job, batch_size=None):
+    """
+    Borra un producto archivado y todo lo que lo referencia con SQL por
+    conjuntos: cada lote es un DELETE ... RETURNING de líneas, un solo
+    UPDATE que recalcula los totales de los documentos tocados y la resta
+    de esas líneas en el resumen por método de pago, en su propia
+    transacción para no retener el candado de escritura. Los resúmenes por
+    producto se borran de a un mes por transacción. El avance queda en el
+    trabajo; si el proceso muere, otro worker lo retoma donde iba.
+    """
+    batch_size = batch_size or PRODUCT_PURGE_BATCH_SIZE
+    product_id = job.product_id
+    product = db.get(Product, product_id)
+    if product is not None and product.archived_at is None:
+        job.status = "cancelled"
+        job.error = "El producto fue restaurado antes del borrado."
+        job.finished_at = datetime.utcnow()
+        db.commit()
+        return
+    if product is not None:
+        if not job.total:
+            job.total = sum(
+                db.scalar(select(func.count(item.id)).where(item.product_id == product_id)) or 0
+                for _, item, _, _ in PRODUCT_PURGE_STEPS
+            ) + (db.scalar(select(func.count(StockMovement.id)).where(StockMovement.product_id == product_id)) or 0)
+        _purge_sale_dates(db, job)
+        db.commit()
+
+        for step, item, document, fk in PRODUCT_PURGE_STEPS:
+            job.step = step
+            sale_kind = {Invoice: "invoice", Remission: "remission"}.get(document)
+            returned = [getattr(item, fk)]
+            if sale_kind:
+                returned += [item.quantity, item.total_excl_vat, item.vat_amount, item.total_incl_vat, item.unit_cost]
+            while True:
+                batch = select(item.id).where(item.product_id == product_id).limit(batch_size).scalar_subquery()
+                rows = db.execute(
+                    delete(item).where(item.id.in_(batch)).returning(*returned),
+                    execution_options={"synchronize_session": False},
+                ).all()
+                if not rows:
+                    break
+                touched = {row[0] for row in rows if row[0] is not None}
+                if touched:
+                    db.execute(
+                        update(document).where(document.id.in_(touched)).values(**document_totals_from_items(item, fk, document)),
+                        execution_options={"synchronize_session": False},
+                    )
+                    if sale_kind:
+                        _subtract_payment_rollups(db, sale_kind, document, [row for row in rows if row[0] is not None])
+                job.done += len(rows)
+                job.documents_updated += len(touched)
+                job.claimed_at = datetime.utcnow()
+                db.commit()
+
+        job.step = "stock_movements"
+        while True:
+            batch = select(StockMovement.id).where(StockMovement.product_id == product_id).limit(batch_size).scalar_subquery()
+            removed = db.execute(delete(StockMovement).where(StockMovement.id.in_(batch)), execution_options={"synchronize_session": False}).rowcount
+            if not removed:
+                break
+            job.done += removed
+            job.claimed_at = datetime.utcnow()
+            db.commit()
+
+        # un mes por transacción; first_sale_date avanza y sirve de punto de reanudación
+        job.step = "sales_rollups"
+        while job.first_sale_date and job.first_sale_date <= job.last_sale_date:
+            month = job.first_sale_date.replace(day=1)
+            following = (month + timedelta(days=32)).replace(day=1)
+            for model in (SalesDailyProduct, SalesMonthlyProduct):
+                db.execute(delete(model).where(model.day >= month, model.day < following, model.product_id == product_id))
+            job.first_sale_date = following
+            job.claimed_at = datetime.utcnow()
+            db.commit()
+
+        job.step = "product"
+        db.execute(delete(StockCheckpoint).where(StockCheckpoint.product_id == product_id))
+        db.execute(delete(ProductStats).where(ProductStats.product_id == product_id))
+        db.execute(delete(Product).where(Product.id == product_id), execution_options={"synchronize_session": False})
+        bump_product_index_version(db)
+    job.status = "done"
+    job.step = ""
+    job.finished_at = datetime.utcnow()
+    db.commit()
+
+def run_pending_product_purges(limit=None):
+    """Procesa los borrados pendientes (o hasta limit). Devuelve cuántos procesó."""
+    processed = 0
+    db = SessionLocal()
+    try:
+        while limit is None or processed < limit:
+            job = claim_product_purge_job(db)
+            if job is None:
+                break
+            try:
+                run_product_purge_job(db, job)
+                if product_autocomplete:
+                    product_autocomplete.remove(job.product_id)
+            except Exception as exc:
+                db.rollback()
+                job = db.get(ProductPurgeJob, job.id)
+                if job is not None:
+                    job.status = "failed"
+                    job.error = str(exc)
+                    job.finished_at = datetime.utcnow()
+                    db.commit()
+                print(f"Error borrando producto archivado: {exc}")
+            processed += 1
+    finally:
+        db.close()
+    return processed
+
+def _product_purge_loop(poll_seconds=PRODUCT_PURGE_POLL_SECONDS):
+    while True:
+        try:
+            processed = run_pending_product_purges()
+        except Exception as exc:
+            print(f"Error en la cola de borrado de productos: {exc}")
+            processed = 0
+        if not processed:
+            _product_purge_wakeup.wait(poll_seconds)
+            _product_purge_wakeup.clear()
+
+def ensure_product_purge_worker():
+    """Un hilo por proceso; el reclamo condicional evita que dos workers borren el mismo producto."""
+    if _product_purge_threads and _product_purge_threads[0].is_alive():
+        return
+    with _product_purge_lock:
+        _product_purge_threads[:] = [t for t in _product_purge_threads if t.is_alive()]
+        if not _product_purge_threads:
+            worker = threading.Thread(target=_product_purge_loop, name="product-purge", daemon=True)
+            worker.start()
+            _product_purge_threads.append(worker)
+
+def notify_product_purge():
+    ensure_product_purge_worker()
+    _product_purge_wakeup.set()
+
+# --------------------
+# Datos derivados
+# --------------------
+def backfill_product_stats():
+    """Llena product_stats desde el historial en bases creadas antes de que existiera la tabla."""
+    db = SessionLocal()
+    try:
+        if db.query(ProductStats.product_id).first() is None and db.query(Product.id).first() is not None:
+            rebuild_product_stats(db)
+            db.commit()
+    except OperationalError as exc:
+        db.rollback()
+        print(f"No fue posible reconstruir product_stats: {exc}")
+    finally:
+        db.close()
+
+backfill_product_stats()
+
+def backfill_opening_costs():
+    """
+    La primera vez que aparece stock_movements.unit_cost copia el costo
+    importado a los movimientos "initial" anteriores. Solo es recuperable
+    mientras el producto no tenga compras: después last_purchase_cost ya es
+    el de la última compra y esos movimientos quedan sin costo.
+    """
+    if "stock_movements.unit_cost" not in schema_upgrades:
+        return
+    purchase = aliased(StockMovement)
+    later_purchase = (
+        select(purchase.id)
+        .where(purchase.product_id == ProductStats.product_id, purchase.movement_type == "purchase")
+        .exists()
+    )
+    opening_cost = (
+        select(ProductStats.last_purchase_cost)
+        .where(ProductStats.product_id == StockMovement.product_id, ~later_purchase)
+        .scalar_subquery()
+    )
+    db = SessionLocal()
+    try:
+        db.execute(
+            update(StockMovement)
+            .where(StockMovement.movement_type == "initial", StockMovement.unit_cost.is_(None))
+            .values(unit_cost=opening_cost)
+        )
+        db.commit()
+    except OperationalError as exc:
+        db.rollback()
+        print(f"No fue posible registrar el costo del inventario inicial: {exc}")
+    finally:
+        db.close()
+
+backfill_opening_costs()
+
+def backfill_average_costs():
+    """
+    Calcula avg_cost y el costo de las ventas anteriores cuando hay productos
+    con compras y sin costo promedio (bases anteriores al costo promedio:
+    create_all pudo crear product_stats ya con la columna vacía), y rehace
+    los resúmenes de ventas (guardan el costo de cada venta).
+    """
+    db = SessionLocal()
+    try:
+        missing = db.execute(
+            select(ProductStats.product_id)
+            .join(StockMovement, StockMovement.product_id == ProductStats.product_id)
+            .where(ProductStats.avg_cost.is_(None), StockMovement.movement_type == "purchase")
+            .limit(1)
+        ).first()
+        if missing is None:
+            return
+        summary = rebuild_average_costs(db)
+        rebuild_sales_rollups(db)
+        db.commit()
+        print(f"Costo promedio calculado para {summary['products']} productos ({summary['seconds']} s)")
+    except OperationalError as exc:
+        db.rollback()
+        print(f"No fue posible calcular el costo promedio: {exc}")
+    finally:
+        db.close()
+
+backfill_average_costs()
+
+def backfill_sales_rollups():
+    """Llena los resúmenes diarios de ventas en bases que ya tenían facturas o remisiones."""
+    db = SessionLocal()
+    try:
+        if db.query(SalesDailyPayment.id).first() is None and (
+            db.query(Invoice.id).first() is not None or db.query(Remission.id).first() is not None
+        ):
+            written = rebuild_sales_rollups(db)
+            db.commit()
+            print(f"Resúmenes de ventas calculados ({written} filas)")
+    except OperationalError as exc:
+        db.rollback()
+        print(f"No fue posible calcular los resúmenes de ventas: {exc}")
+    finally:
+        db.close()
+
+backfill_sales_rollups()
+
+product_autocomplete = None
+if PRODUCT_AUTOCOMPLETE:
+    product_autocomplete = ProductAutocompleteIndex(engine, max_age=PRODUCT_AUTOCOMPLETE_MAX_AGE)
+    product_autocomplete.sync()
 
 # --------------
 # Rutas de páginas
 # --------------
+@app.before_request
+def start_background_workers():
+    # Los hilos no sobreviven al fork de gunicorn; se arrancan en la primera petición de cada worker
+    ensure_pdf_prerender_workers()
+    ensure_notification_dispatchers()
+    ensure_maintenance_scheduler()
+    ensure_stock_checkpoint_scheduler()
+    ensure_product_purge_worker()
+
 @app.get("/")
 def index():
     return render_template("index.html")
@@ -1204,14 +4345,14 @@ def invoice_view(invoice_id:int):
         db.expunge_all()
         context = build_invoice_template_context(inv)
         context["is_pdf"] = False
-        context["whatsapp_enabled"] = twilio_configured()
+        context["whatsapp_enabled"] = notification_channel_ready("whatsapp")
         return render_template("invoice.html", **context)
     finally:
         db.close()
 
 @app.post("/invoice/<int:invoice_id>/send_email")
 def invoice_send_email(invoice_id:int):
-    if not smtp_configured():
+    if not notification_channel_ready("email"):
         return jsonify({"error": "No hay configuración SMTP. Define SMTP_HOST, SMTP_USERNAME, SMTP_PASSWORD y SMTP_FROM_EMAIL."}), 500
 
     payload = request.get_json(silent=True) or {}
@@ -1232,10 +4373,6 @@ def invoice_send_email(invoice_id:int):
         _ = inv.customer.phone
         db.expunge_all()
 
-        pdf_bytes = generate_invoice_pdf(inv)
-        if not pdf_bytes:
-            return jsonify({"error": "No fue posible generar el PDF de la factura."}), 500
-
         context = build_invoice_template_context(inv)
         total_display = f"${context['total_to_pay']:,.0f}"
         subject = f"Factura {inv.number} - {SMTP_FROM_NAME}"
@@ -1247,24 +4384,22 @@ def invoice_send_email(invoice_id:int):
             f"{SMTP_FROM_NAME}"
         )
 
-        try:
-            send_email_with_pdf(
-                to_email=to_email,
-                subject=subject,
-                body=body,
-                pdf_bytes=pdf_bytes,
-                filename=f"factura_{inv.number}.pdf",
-            )
-        except Exception as exc:
-            return jsonify({"error": f"No se pudo enviar el correo: {exc}"}), 500
-
-        return jsonify({"success": True})
+        message, created = enqueue_notification(
+            db, "email", to_email,
+            idempotency_key=request_idempotency_key(payload),
+            subject=subject,
+            body=body,
+            document_kind="invoice",
+            document_id=invoice_id,
+            attachment_name=f"factura_{inv.number}.pdf",
+        )
+        return notification_accepted_response(message, created)
     finally:
         db.close()
 
 @app.post("/invoice/<int:invoice_id>/send_whatsapp")
 def invoice_send_whatsapp(invoice_id:int):
-    if not twilio_configured():
+    if not notification_channel_ready("whatsapp"):
         return jsonify({"error": "No hay configuración de Twilio para WhatsApp."}), 500
 
     payload = request.get_json(silent=True) or {}
@@ -1300,16 +4435,13 @@ def invoice_send_whatsapp(invoice_id:int):
             f"{SMTP_FROM_NAME}"
         )
 
-        try:
-            send_whatsapp_message(
-                to_phone=normalized_phone,
-                body=body,
-                media_url=pdf_url if TWILIO_SEND_MEDIA else None,
-            )
-        except Exception as exc:
-            return jsonify({"error": f"No se pudo enviar el mensaje: {exc}"}), 500
-
-        return jsonify({"success": True})
+        message, created = enqueue_notification(
+            db, "whatsapp", normalized_phone,
+            idempotency_key=request_idempotency_key(payload),
+            body=body,
+            media_url=pdf_url if TWILIO_SEND_MEDIA else "",
+        )
+        return notification_accepted_response(message, created)
     finally:
         db.close()
 
@@ -1329,14 +4461,14 @@ def remission_view(remission_id:int):
         db.expunge_all()
         context = build_remission_template_context(rem)
         context["is_pdf"] = False
-        context["whatsapp_enabled"] = twilio_configured()
+        context["whatsapp_enabled"] = notification_channel_ready("whatsapp")
         return render_template("remission.html", **context)
     finally:
         db.close()
 
 @app.post("/remission/<int:remission_id>/send_email")
 def remission_send_email(remission_id:int):
-    if not smtp_configured():
+    if not notification_channel_ready("email"):
         return jsonify({"error": "No hay configuración SMTP. Define SMTP_HOST, SMTP_USERNAME, SMTP_PASSWORD y SMTP_FROM_EMAIL."}), 500
 
     payload = request.get_json(silent=True) or {}
@@ -1357,10 +4489,6 @@ def remission_send_email(remission_id:int):
         _ = rem.customer.phone
         db.expunge_all()
 
-        pdf_bytes = generate_remission_pdf(rem)
-        if not pdf_bytes:
-            return jsonify({"error": "No fue posible generar el PDF de la remisión."}), 500
-
         context = build_remission_template_context(rem)
         total_display = f"${context['total_to_pay']:,.0f}"
         subject = f"Remisión {rem.number} - {SMTP_FROM_NAME}"
@@ -1372,24 +4500,22 @@ def remission_send_email(remission_id:int):
             f"{SMTP_FROM_NAME}"
         )
 
-        try:
-            send_email_with_pdf(
-                to_email=to_email,
-                subject=subject,
-                body=body,
-                pdf_bytes=pdf_bytes,
-                filename=f"remision_{rem.number}.pdf",
-            )
-        except Exception as exc:
-            return jsonify({"error": f"No se pudo enviar el correo: {exc}"}), 500
-
-        return jsonify({"success": True})
+        message, created = enqueue_notification(
+            db, "email", to_email,
+            idempotency_key=request_idempotency_key(payload),
+            subject=subject,
+            body=body,
+            document_kind="remission",
+            document_id=remission_id,
+            attachment_name=f"remision_{rem.number}.pdf",
+        )
+        return notification_accepted_response(message, created)
     finally:
         db.close()
 
 @app.post("/remission/<int:remission_id>/send_whatsapp")
 def remission_send_whatsapp(remission_id:int):
-    if not twilio_configured():
+    if not notification_channel_ready("whatsapp"):
         return jsonify({"error": "No hay configuración de Twilio para WhatsApp."}), 500
 
     payload = request.get_json(silent=True) or {}
@@ -1425,19 +4551,52 @@ def remission_send_whatsapp(remission_id:int):
             f"{SMTP_FROM_NAME}"
         )
 
-        try:
-            send_whatsapp_message(
-                to_phone=normalized_phone,
-                body=body,
-                media_url=pdf_url if TWILIO_SEND_MEDIA else None,
-            )
-        except Exception as exc:
-            return jsonify({"error": f"No se pudo enviar el mensaje: {exc}"}), 500
+        message, created = enqueue_notification(
+            db, "whatsapp", normalized_phone,
+            idempotency_key=request_idempotency_key(payload),
+            body=body,
+            media_url=pdf_url if TWILIO_SEND_MEDIA else "",
+        )
+        return notification_accepted_response(message, created)
+    finally:
+        db.close()
 
-        return jsonify({"success": True})
+def request_idempotency_key(payload):
+    return (request.headers.get("Idempotency-Key") or payload.get("idempotency_key") or "").strip() or None
+
+def notification_accepted_response(message, created):
+    """202: el envío queda en la bandeja de salida; el estado se consulta en status_url."""
+    if created:
+        notify_dispatchers()
+    data = outbound_message_to_dict(message)
+    data["success"] = True
+    data["status_url"] = url_for("api_notification_status", message_id=message.id)
+    response = jsonify(data)
+    response.status_code = 202
+    response.headers["Location"] = data["status_url"]
+    return response
+
+@app.get("/api/notifications/<int:message_id>")
+def api_notification_status(message_id:int):
+    """Estado de entrega de un correo o WhatsApp encolado."""
+    db = SessionLocal()
+    try:
+        message = db.get(OutboundMessage, message_id)
+        if not message:
+            return jsonify({"error": "Mensaje no encontrado"}), 404
+        return jsonify(outbound_message_to_dict(message))
     finally:
         db.close()
 
+def pdf_pending_response(exc, status):
+    """Respuesta cuando el servicio renderizador aún no termina; el navegador reintenta solo."""
+    retry_after = max(1, int(PDF_RENDER_WAIT_SECONDS // 3) or 1)
+    response = jsonify({"status": "pending", "message": str(exc), "retry_after": retry_after})
+    response.status_code = status
+    response.headers["Retry-After"] = str(retry_after)
+    response.headers["Refresh"] = str(retry_after)
+    return response
+
 @app.get("/invoice/<int:invoice_id>/pdf")
 def invoice_pdf(invoice_id:int):
     """Genera y descarga PDF de la factura"""
@@ -1456,7 +4615,10 @@ def invoice_pdf(invoice_id:int):
         db.expunge_all()
         
         # Generar PDF
-        pdf_bytes = generate_invoice_pdf(inv)
+        try:
+            pdf_bytes = cached_invoice_pdf(inv)
+        except PdfRenderPending as exc:
+            return pdf_pending_response(exc, 202)
         
         if not pdf_bytes:
             abort(500)
@@ -1488,7 +4650,10 @@ def remission_pdf(remission_id:int):
         db.expunge_all()
         
         # Generar PDF
-        pdf_bytes = generate_remission_pdf(rem)
+        try:
+            pdf_bytes = cached_remission_pdf(rem)
+        except PdfRenderPending as exc:
+            return pdf_pending_response(exc, 202)
         
         if not pdf_bytes:
             abort(500)
@@ -1502,6 +4667,21 @@ def remission_pdf(remission_id:int):
     finally:
         db.close()
 
+@app.get("/api/pdf-cache/stats")
+def api_pdf_cache_stats():
+    """Contadores de la caché de PDFs (aciertos/fallos son por proceso) y estado de la cola."""
+    out = pdf_cache.summary()
+    if pdf_render_pool is not None:
+        out["render_pool"] = pdf_render_pool.summary()
+    db = SessionLocal()
+    try:
+        out["render_jobs"] = dict(
+            db.query(PdfRenderJob.status, func.count(PdfRenderJob.id)).group_by(PdfRenderJob.status).all()
+        )
+    finally:
+        db.close()
+    return jsonify(out)
+
 @app.get("/history/invoices")
 def invoices_history_view():
     """Página de historial de facturas"""
@@ -1522,10 +4702,55 @@ def purchases_history_view():
 # --------------
 @app.get("/api/products")
 def api_products_list():
+    """
+    Lista el catálogo. Parámetros opcionales:
+    - fields=id,sku,name  → solo esas llaves (evita las columnas de detalle).
+    - limit=N&cursor=...  → paginación por cursor (name, id); el siguiente
+      cursor viaja en la cabecera X-Next-Cursor y en Link rel="next".
+    - archived=1          → lista los productos archivados.
+    Responde 304 si el If-None-Match coincide con la versión del catálogo.
+    """
+    fields = [f.strip() for f in request.args.get("fields", "").split(",") if f.strip()]
+    unknown = [f for f in fields if f not in PRODUCT_FIELDS]
+    if unknown:
+        return jsonify({"error": f"Campos no válidos: {', '.join(unknown)}"}), 400
+    limit = request.args.get("limit", type=int)
+    if limit is not None:
+        limit = max(1, min(limit, 1000))
+    cursor = request.args.get("cursor", "").strip()
+    try:
+        after = decode_product_cursor(cursor) if cursor else None
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+
     db = SessionLocal()
     try:
-        items = db.query(Product).order_by(Product.name.asc()).all()
-        return jsonify([product_to_dict_with_details(p, db) for p in items])
+        version = get_catalog_version(db)
+        etag = f"products-{version}-{hashlib.sha1(request.query_string).hexdigest()[:12]}"
+        if request.if_none_match.contains(etag):
+            response = make_response("", 304)
+            response.set_etag(etag)
+            return response
+
+        query_fields = fields
+        if fields and limit is not None:
+            # El cursor necesita name e id aunque no se hayan pedido
+            query_fields = list(dict.fromkeys(fields + ["name", "id"]))
+        archived = request.args.get("archived", "").strip().lower() in ("1", "true", "yes")
+        items = products_with_details(db, fields=query_fields or None, after=after, limit=limit, archived=archived)
+        next_cursor = None
+        if limit is not None and len(items) == limit:
+            next_cursor = encode_product_cursor(items[-1]["name"], items[-1]["id"])
+        if query_fields != fields:
+            items = [{key: value for key, value in item.items() if key in fields} for item in items]
+
+        response = jsonify(items)
+        response.set_etag(etag)
+        response.headers["Cache-Control"] = "no-cache"
+        if next_cursor:
+            response.headers["X-Next-Cursor"] = next_cursor
+            response.headers["Link"] = f'<{url_for("api_products_list", **dict(request.args, cursor=next_cursor))}>; rel="next"'
+        return response
     finally:
         db.close()
 
@@ -1545,39 +4770,111 @@ def api_products_create():
     try:
         p = Product(name=name, sku=sku, price=price, vat_rate=vat_rate, low_stock_threshold=low_stock_threshold, current_stock=0)
         db.add(p)
+        db.flush()
+        db.add(ProductStats(product_id=p.id, units_sold=0))
+        bump_product_index_version(db)
         db.commit()
-        return jsonify(product_to_dict(p)), 201
+        out = product_to_dict(p)
+        if product_autocomplete:
+            product_autocomplete.add(out)
+        return jsonify(out), 201
     except IntegrityError:
         db.rollback()
         return jsonify({"error":"SKU ya existe"}), 400
     finally:
         db.close()
 
+@app.post("/api/products/import")
+def api_products_import():
+    """
+    Importa productos desde el cuerpo de la petición (CSV o JSONL, leído por
+    partes). Columnas: sku, name, price, vat_rate, low_stock_threshold,
+    stock, supplier, cost. Parámetros: format, batch_size, dry_run.
+    """
+    fmt = import_format_for(request.args.get("format", ""), request.content_type)
+    try:
+        batch_size = int(request.args.get("batch_size") or PRODUCT_IMPORT_BATCH_SIZE)
+    except ValueError:
+        return jsonify({"error": "batch_size debe ser un número"}), 400
+    dry_run = request.args.get("dry_run", "").lower() in ("1", "true", "yes")
+    stream = request.files["file"].stream if "file" in request.files else request.stream
+    db = SessionLocal()
+    try:
+        summary = ProductImporter(db, batch_size=batch_size, dry_run=dry_run).run(iter_import_rows(stream, fmt))
+    finally:
+        db.close()
+    if product_autocomplete and not dry_run:
+        product_autocomplete.ensure_fresh(force=True)
+    summary["dry_run"] = dry_run
+    return jsonify(summary), 200
+
 @app.delete("/api/products/<int:product_id>")
 def api_products_delete(product_id):
+    """
+    Archiva el producto: deja de aparecer en el catálogo, la búsqueda y las
+    alertas, y no se puede vender ni comprar; sus documentos no cambian.
+    Con purge=true además encola el borrado definitivo (líneas de compras,
+    facturas y remisiones, movimientos y el producto) y responde 202 con la
+    URL del avance.
+    """
+    purge = request.args.get("purge", "").strip().lower() in ("1", "true", "yes")
     db = SessionLocal()
     try:
         product = db.get(Product, product_id)
         if not product:
             return jsonify({"error": "Producto no encontrado"}), 404
-        
-        # Elimina registros asociados y recalcula totales
-        association_summary = delete_product_associations(db, product.id)
-
-        # Eliminar movimientos de stock asociados al producto
-        stock_movements_deleted = db.query(StockMovement).filter(StockMovement.product_id == product_id).delete()
-        
-        # Eliminar el producto
-        db.delete(product)
+        if not purge:
+            archived_at = archive_product(db, product)
+            db.commit()
+            if product_autocomplete:
+                product_autocomplete.remove(product_id)
+            return jsonify({
+                "message": "Producto archivado. Sus compras y ventas se conservan.",
+                "archived_at": archived_at.isoformat(),
+            }), 200
+        job = request_product_purge(db, product)
         db.commit()
+        if product_autocomplete:
+            product_autocomplete.remove(product_id)
+        notify_product_purge()
         return jsonify({
-            "message": "Producto eliminado junto con registros relacionados.",
-            "removed": association_summary,
-            "stock_movements_removed": stock_movements_deleted or 0
-        }), 200
-    except Exception as e:
-        db.rollback()
-        return jsonify({"error": str(e)}), 500
+            "message": "Producto archivado; el borrado definitivo continúa en segundo plano.",
+            "job": product_purge_job_to_dict(job),
+            "status_url": url_for("api_product_purge_status", job_id=job.id),
+        }), 202
+    finally:
+        db.close()
+
+@app.post("/api/products/<int:product_id>/restore")
+def api_products_restore(product_id):
+    """Devuelve un producto archivado al catálogo (cancela su borrado si aún no empezó)."""
+    db = SessionLocal()
+    try:
+        product = db.get(Product, product_id)
+        if not product:
+            return jsonify({"error": "Producto no encontrado"}), 404
+        if cancel_pending_product_purges(db, [product_id]):
+            db.rollback()
+            return jsonify({"error": "El borrado definitivo ya está en curso"}), 409
+        if product.archived_at is not None:
+            product.archived_at = None
+            bump_product_index_version(db)
+        db.commit()
+        out = product_to_dict(product)
+        if product_autocomplete:
+            product_autocomplete.add(out)
+        return jsonify(out), 200
+    finally:
+        db.close()
+
+@app.get("/api/products/purge-jobs/<int:job_id>")
+def api_product_purge_status(job_id):
+    db = SessionLocal()
+    try:
+        job = db.get(ProductPurgeJob, job_id)
+        if job is None:
+            return jsonify({"error": "Trabajo no encontrado"}), 404
+        return jsonify(product_purge_job_to_dict(job))
     finally:
         db.close()
 
@@ -1599,6 +4896,112 @@ def api_inventory_adjust():
     finally:
         db.close()
 
+@app.get("/api/stock/at")
+def api_stock_at():
+    """
+    Stock de cada producto al cierre de un día según el ledger.
+    Parámetros: date=AAAA-MM-DD (incluido) e ids=1,2,3 opcional.
+    """
+    try:
+        day = date.fromisoformat(request.args.get("date", "").strip())
+        ids = [int(part) for part in request.args.get("ids", "").split(",") if part.strip()]
+    except ValueError:
+        return jsonify({"error": "date debe ser AAAA-MM-DD e ids una lista de números"}), 400
+    at = datetime.combine(day + timedelta(days=1), datetime.min.time())
+    db = SessionLocal()
+    try:
+        rows = db.execute(ledger_balance_select(at, ids or None)).all()
+        return jsonify({
+            "date": day.isoformat(),
+            "items": [{"product_id": row.id, "sku": row.sku, "name": row.name, "stock": int(row.ledger)} for row in rows],
+        })
+    finally:
+        db.close()
+
+@app.get("/api/stock/reconcile")
+def api_stock_reconcile():
+    """Compara current_stock con el ledger desde el último cierre mensual de cada producto."""
+    started = time.perf_counter()
+    db = SessionLocal()
+    try:
+        checked, mismatches = reconcile_stock(db)
+        closed = last_closed_month(db)
+        return jsonify({
+            "checked": checked,
+            "mismatches": mismatches,
+            "closed_until": closed.date().isoformat() if closed else None,
+            "seconds": round(time.perf_counter() - started, 3),
+        })
+    finally:
+        db.close()
+
+@app.get("/api/reports/valuation")
+def api_reports_valuation():
+    """Inventario valorizado al costo promedio ponderado de cada producto."""
+    db = SessionLocal()
+    try:
+        return jsonify(inventory_valuation(db))
+    finally:
+        db.close()
+
+@app.get("/api/reports/margins")
+def api_reports_margins():
+    """
+    Margen bruto por venta. Parámetros: start y end (AAAA-MM-DD, incluidos);
+    por defecto los últimos 30 días.
+    """
+    try:
+        end = request.args.get("end", "").strip()
+        end = date.fromisoformat(end) if end else date.today()
+        start = request.args.get("start", "").strip()
+        start = date.fromisoformat(start) if start else end - timedelta(days=29)
+    except ValueError:
+        return jsonify({"error": "start y end deben ser AAAA-MM-DD"}), 400
+    db = SessionLocal()
+    try:
+        report = sales_margins(
+            db,
+            datetime.combine(start, datetime.min.time()),
+            datetime.combine(end + timedelta(days=1), datetime.min.time()),
+        )
+        return jsonify(dict(report, start=start.isoformat(), end=end.isoformat()))
+    finally:
+        db.close()
+
+@app.get("/api/reports/sales")
+def api_reports_sales():
+    """
+    Ventas por día, producto o método de pago desde los resúmenes diarios.
+    Parámetros: start y end (AAAA-MM-DD, incluidos; por defecto los últimos
+    30 días), group=day|product|payment_method y kind=invoice|remission opcional.
+    """
+    group = SALES_REPORT_GROUPS.get(request.args.get("group", "day").strip())
+    kind = request.args.get("kind", "").strip() or None
+    if group is None or (kind and kind not in SALE_ITEM_MODELS):
+        return jsonify({"error": "group debe ser day, product o payment_method y kind invoice o remission"}), 400
+    try:
+        end = request.args.get("end", "").strip()
+        end = date.fromisoformat(end) if end else date.today()
+        start = request.args.get("start", "").strip()
+        start = date.fromisoformat(start) if start else end - timedelta(days=29)
+    except ValueError:
+        return jsonify({"error": "start y end deben ser AAAA-MM-DD"}), 400
+    db = SessionLocal()
+    try:
+        report = sales_report(db, start, end, group, kind)
+        if group == "product_id" and report["items"]:
+            names = {
+                row.id: row for row in
+                db.execute(select(Product.id, Product.sku, Product.name).where(Product.id.in_({item["product_id"] for item in report["items"]})))
+            }
+            for item in report["items"]:
+                row = names.get(item["product_id"])
+                item["sku"] = row.sku if row else None
+                item["name"] = row.name if row else None
+        return jsonify(dict(report, start=start.isoformat(), end=end.isoformat(), group=request.args.get("group", "day")))
+    finally:
+        db.close()
+
 @app.get("/api/suppliers")
 def api_suppliers_list():
     db = SessionLocal()
@@ -1661,54 +5064,31 @@ def api_purchases_create():
             db.add(supplier)
             db.flush()
 
-        code = f"COMP-{datetime.utcnow().strftime('%Y%m%d')}-{next_sequence('purchase', start_at=1001)}"
+        code = f"COMP-{datetime.utcnow().strftime('%Y%m%d')}-{next_purchase_number(db)}"
 
         purchase = Purchase(code=code, supplier_id=supplier.id, notes=(payload.get("notes") or "").strip())
         db.add(purchase)
         db.flush()
 
-        subtotal = Decimal("0.00")
-        vat_total = Decimal("0.00")
-        total = Decimal("0.00")
-
         items = payload.get("items") or []
         if not items:
             return jsonify({"error":"Debes incluir items en la compra"}), 400
 
-        for it in items:
-            product_id = int(it.get("product_id"))
-            qty = int(it.get("quantity"))
-            unit_cost = money(it.get("unit_cost"))
-            vat_rate = D(it.get("vat_rate") or Decimal("0.19"))
-            if qty <= 0:
-                return jsonify({"error":"Cantidad debe ser > 0"}), 400
-            product = db.get(Product, product_id)
-            if not product:
-                return jsonify({"error":f"Producto {product_id} no existe"}), 400
-
-            total_excl = money(unit_cost * qty)
-            vat_amount = money(total_excl * vat_rate)
-            total_incl = money(total_excl + vat_amount)
-
-            pi = PurchaseItem(
-                purchase_id=purchase.id, product_id=product_id,
-                quantity=qty, unit_cost=unit_cost, vat_rate=vat_rate,
-                total_excl_vat=total_excl, vat_amount=vat_amount, total_incl_vat=total_incl
-            )
-            db.add(pi)
-
-            subtotal += total_excl
-            vat_total += vat_amount
-            total += total_incl
-
-            # Ingreso a inventario
-            # Nota: un movimiento por item mantiene el historial
-            db.flush()
-            adjust_stock(db, product.id, qty, "purchase", f"Compra {code}", "purchase", purchase.id)
-
-        purchase.subtotal_excl_vat = money(subtotal)
-        purchase.vat_total = money(vat_total)
-        purchase.total = money(total)
+        lines = build_document_lines(
+            db, items, "unit_cost",
+            vat_rate_for=lambda it: D(it.get("vat_rate") or Decimal("0.19")),
+        )
+        db.execute(insert(PurchaseItem), [dict(line, purchase_id=purchase.id) for line in lines])
+        sum_document_lines(purchase, lines)
+        apply_purchase_average_cost(db, lines)
+
+        # Ingreso a inventario
+        # Nota: un movimiento por item mantiene el historial
+        apply_stock_deltas(
+            db, [(line["product_id"], line["quantity"]) for line in lines],
+            "purchase", f"Compra {code}", "purchase", purchase.id,
+        )
+        record_purchase_stats_bulk(db, supplier.id, {line["product_id"]: line["unit_cost"] for line in lines})
 
         db.commit()
         return jsonify({
@@ -1756,50 +5136,25 @@ def api_remissions_create():
         db.refresh(customer)
         customer_data = customer_to_dict(customer)  # Serializar inmediatamente
 
-        remission_seq = next_sequence("remission", start_at=1)
+        remission_seq = next_sequence(db, "remission", start_at=1)
         number = f"REM-{datetime.utcnow().strftime('%Y%m%d')}-{remission_seq:03d}"
         payment_method = (payload.get("payment_method") or "EFECTIVO").strip()
         remission = Remission(number=number, customer_id=customer_id, payment_method=payment_method)
         db.add(remission)
         db.flush()
 
-        subtotal = Decimal("0.00")
-        vat_total = Decimal("0.00")
-        total = Decimal("0.00")
-
-        for it in (payload.get("items") or []):
-            product_id = int(it.get("product_id"))
-            qty = int(it.get("quantity"))
-            unit_price = money(it.get("unit_price"))
-            vat_rate = Decimal("0.00")
-            if qty <= 0:
-                return jsonify({"error":"Cantidad debe ser > 0"}), 400
-            product = db.get(Product, product_id)
-            if not product:
-                return jsonify({"error":f"Producto {product_id} no existe"}), 400
-            if product.current_stock < qty:
-                return jsonify({"error":f"Stock insuficiente para {product.name}"}), 400
-
-            total_excl = money(unit_price * qty)
-            vat_amount = money(0)
-            total_incl = total_excl
-
-            ri = RemissionItem(
-                remission_id=remission.id, product_id=product_id,
-                quantity=qty, unit_price=unit_price, vat_rate=vat_rate,
-                total_excl_vat=total_excl, vat_amount=vat_amount, total_incl_vat=total_incl
-            )
-            db.add(ri)
-
-            subtotal += total_excl
-            vat_total += vat_amount
-            total += total_incl
-
-            adjust_stock(db, product.id, -qty, "remission", f"Remisión {number}", "remission", remission.id)
-
-        remission.subtotal_excl_vat = money(subtotal)
-        remission.vat_total = money(vat_total)
-        remission.total = money(total)
+        lines = build_document_lines(
+            db, payload.get("items") or [], "unit_price",
+            vat_rate_for=lambda it: Decimal("0.00"), with_cost=True,
+        )
+        if lines:
+            db.execute(insert(RemissionItem), [dict(line, remission_id=remission.id) for line in lines])
+        sum_document_lines(remission, lines)
+        apply_stock_deltas(
+            db, [(line["product_id"], -line["quantity"]) for line in lines],
+            "remission", f"Remisión {number}", "remission", remission.id, guard=True, sold_at=remission.date,
+        )
+        record_sales_rollup(db, "remission", remission, lines)
 
         # Recordatorio de mantenimiento
         days = int(payload.get("maintenance_days") or 0)
@@ -1813,8 +5168,11 @@ def api_remissions_create():
                 reference_id=remission.id
             )
             db.add(rem)
+            bump_version(db, MAINTENANCE_VERSION_KEY)
 
+        enqueue_pdf_render(db, "remission", remission.id)
         db.commit()
+        notify_pdf_prerender()
         return jsonify({
             "id": remission.id,
             "number": remission.number,
@@ -1829,6 +5187,55 @@ def api_remissions_create():
     finally:
         db.close()
 
+def create_invoice(db, payload):
+    """Registra la factura, sus líneas, el stock y el recordatorio en la sesión (sin commit).
+
+    Devuelve (invoice, customer_data).
+    """
+    customer_payload = payload.get("customer") or {}
+    customer = ensure_customer(db, customer_payload)
+    customer_id = customer.id  # Guardar el ID antes de cualquier otra operación
+    # Refrescar el objeto para asegurar que esté vinculado antes de serializar
+    db.refresh(customer)
+    customer_data = customer_to_dict(customer)  # Serializar inmediatamente
+
+    invoice_seq = next_sequence(db, "invoice", start_at=1)
+    number = f"FAC-{invoice_seq:03d}"
+    payment_method = (payload.get("payment_method") or "EFECTIVO").strip()
+    invoice = Invoice(number=number, customer_id=customer_id, payment_method=payment_method)
+    db.add(invoice)
+    db.flush()
+
+    lines = build_document_lines(
+        db, payload.get("items") or [], "unit_price",
+        vat_rate_for=lambda it: Decimal("0.00"), with_cost=True,
+    )
+    if lines:
+        db.execute(insert(InvoiceItem), [dict(line, invoice_id=invoice.id) for line in lines])
+    sum_document_lines(invoice, lines)
+    apply_stock_deltas(
+        db, [(line["product_id"], -line["quantity"]) for line in lines],
+        "invoice", f"Factura {number}", "invoice", invoice.id, guard=True, sold_at=invoice.date,
+    )
+    record_sales_rollup(db, "invoice", invoice, lines)
+
+    # Recordatorio de mantenimiento si aplica
+    days = int(payload.get("maintenance_days") or 0)
+    if days > 0:
+        due = (datetime.utcnow() + timedelta(days=days)).date()
+        rem = MaintenanceReminder(
+            customer_id=customer_id,
+            due_date=due,
+            notes=f"Recordatorio por factura {number}",
+            reference_type="invoice",
+            reference_id=invoice.id
+        )
+        db.add(rem)
+        bump_version(db, MAINTENANCE_VERSION_KEY)
+
+    enqueue_pdf_render(db, "invoice", invoice.id)
+    return invoice, customer_data
+
 @app.post("/api/invoices")
 def api_invoices_create():
     """
@@ -1843,72 +5250,9 @@ def api_invoices_create():
     payload = request.get_json(force=True)
     db = SessionLocal()
     try:
-        customer_payload = payload.get("customer") or {}
-        customer = ensure_customer(db, customer_payload)
-        customer_id = customer.id  # Guardar el ID antes de cualquier otra operación
-        # Refrescar el objeto para asegurar que esté vinculado antes de serializar
-        db.refresh(customer)
-        customer_data = customer_to_dict(customer)  # Serializar inmediatamente
-
-        invoice_seq = next_sequence("invoice", start_at=1)
-        number = f"FAC-{invoice_seq:03d}"
-        payment_method = (payload.get("payment_method") or "EFECTIVO").strip()
-        invoice = Invoice(number=number, customer_id=customer_id, payment_method=payment_method)
-        db.add(invoice)
-        db.flush()
-
-        subtotal = Decimal("0.00")
-        vat_total = Decimal("0.00")
-        total = Decimal("0.00")
-
-        for it in (payload.get("items") or []):
-            product_id = int(it.get("product_id"))
-            qty = int(it.get("quantity"))
-            unit_price = money(it.get("unit_price"))
-            vat_rate = Decimal("0.00")
-            if qty <= 0:
-                return jsonify({"error":"Cantidad debe ser > 0"}), 400
-            product = db.get(Product, product_id)
-            if not product:
-                return jsonify({"error":f"Producto {product_id} no existe"}), 400
-            if product.current_stock < qty:
-                return jsonify({"error":f"Stock insuficiente para {product.name}"}), 400
-
-            total_excl = money(unit_price * qty)
-            vat_amount = money(0)
-            total_incl = total_excl
-
-            ii = InvoiceItem(
-                invoice_id=invoice.id, product_id=product_id,
-                quantity=qty, unit_price=unit_price, vat_rate=vat_rate,
-                total_excl_vat=total_excl, vat_amount=vat_amount, total_incl_vat=total_incl
-            )
-            db.add(ii)
-
-            subtotal += total_excl
-            vat_total += vat_amount
-            total += total_incl
-
-            adjust_stock(db, product.id, -qty, "invoice", f"Factura {number}", "invoice", invoice.id)
-
-        invoice.subtotal_excl_vat = money(subtotal)
-        invoice.vat_total = money(vat_total)
-        invoice.total = money(total)
-
-        # Recordatorio de mantenimiento si aplica
-        days = int(payload.get("maintenance_days") or 0)
-        if days > 0:
-            due = (datetime.utcnow() + timedelta(days=days)).date()
-            rem = MaintenanceReminder(
-                customer_id=customer_id,
-                due_date=due,
-                notes=f"Recordatorio por factura {number}",
-                reference_type="invoice",
-                reference_id=invoice.id
-            )
-            db.add(rem)
-
+        invoice, customer_data = create_invoice(db, payload)
         db.commit()
+        notify_pdf_prerender()
         return jsonify({
             "id": invoice.id,
             "number": invoice.number,
@@ -1923,37 +5267,82 @@ def api_invoices_create():
     finally:
         db.close()
 
-@app.get("/api/alerts/low-stock")
-def api_alerts_low_stock():
+class AlertsSnapshot:
+    """
+    Respuestas de /api/alerts/* ya serializadas en este proceso.
+
+    Cada entrada guarda las versiones con que se calculó. Las transacciones
+    que cambian stock o recordatorios incrementan esas versiones al hacer
+    commit, así que mientras no cambien basta una lectura por llave primaria
+    para responder (o un 304 si el navegador ya tiene el mismo ETag).
+    """
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, db, name, version_keys, build):
+        """Devuelve (cuerpo JSON, etag), recalculando con build(db) solo si cambió alguna versión o el día."""
+        key = (get_versions(db, version_keys), date.today().isoformat())
+        entry = self._entries.get(name)
+        if entry and entry[0] == key:
+            self.hits += 1
+            return entry[1], entry[2]
+        # Las versiones se leen antes que los datos: en el peor caso se guarda
+        # un resultado más nuevo que su llave y se recalcula en la siguiente consulta.
+        body = app.json.dumps(build(db))
+        etag = f"{name}-{hashlib.sha1(repr(key).encode()).hexdigest()[:16]}"
+        with self._lock:
+            self._entries[name] = (key, body, etag)
+            self.misses += 1
+        return body, etag
+
+alerts_snapshot = AlertsSnapshot()
+
+def low_stock_alerts(db):
+    products = db.query(Product).filter(text(LOW_STOCK_SQL), Product.archived_at.is_(None)).order_by(Product.id.asc()).all()
+    return [product_to_dict(p) for p in products]
+
+def maintenance_alerts(db):
+    # próximas 2 semanas
+    horizon = date.today() + timedelta(days=14)
+    items = (
+        db.query(MaintenanceReminder)
+        .options(joinedload(MaintenanceReminder.customer))
+        .filter(MaintenanceReminder.due_date <= horizon)
+        .order_by(MaintenanceReminder.due_date.asc(), MaintenanceReminder.id.asc())
+        .all()
+    )
+    return [{
+        "id": m.id,
+        "customer": customer_to_dict(m.customer),
+        "due_date": m.due_date.isoformat(),
+        "notes": m.notes,
+        "notified": bool(m.notified),
+    } for m in items]
+
+def alerts_response(name, version_keys, build):
     db = SessionLocal()
     try:
-        items = db.query(Product).all()
-        low = [product_to_dict(p) for p in items if (p.current_stock or 0) <= (p.low_stock_threshold or 0)]
-        return jsonify(low)
+        body, etag = alerts_snapshot.get(db, name, version_keys, build)
     finally:
         db.close()
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+    else:
+        response = Response(body, mimetype="application/json")
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = "no-cache"
+    return response
+
+@app.get("/api/alerts/low-stock")
+def api_alerts_low_stock():
+    return alerts_response("low-stock", (CATALOG_VERSION_KEY,), low_stock_alerts)
 
 @app.get("/api/alerts/maintenance")
 def api_alerts_maintenance():
-    # próximas 2 semanas
-    today = date.today()
-    horizon = today + timedelta(days=14)
-    db = SessionLocal()
-    try:
-        items = db.query(MaintenanceReminder).filter(MaintenanceReminder.due_date <= horizon).order_by(MaintenanceReminder.due_date.asc()).all()
-        out = []
-        for m in items:
-            # Serializar el cliente mientras la sesión está activa
-            customer_data = customer_to_dict(m.customer)
-            out.append({
-                "id": m.id,
-                "customer": customer_data,
-                "due_date": m.due_date.isoformat(),
-                "notes": m.notes
-            })
-        return jsonify(out)
-    finally:
-        db.close()
+    return alerts_response("maintenance", (MAINTENANCE_VERSION_KEY,), maintenance_alerts)
 
 def _complete_maintenance(reminder_id: int):
     db = SessionLocal()
@@ -1963,6 +5352,7 @@ def _complete_maintenance(reminder_id: int):
             return jsonify({"error": "Recordatorio no encontrado"}), 404
         app.logger.info("Marcando mantenimiento completado: %s", reminder_id)
         db.delete(reminder)
+        bump_version(db, MAINTENANCE_VERSION_KEY)
         db.commit()
         return jsonify({"status": "ok"})
     except Exception as exc:
@@ -1997,15 +5387,106 @@ def api_alerts_maintenance_complete_post(reminder_id: int):
     """Compatibilidad para clientes que no permitan DELETE desde el frontend."""
     return _complete_maintenance(reminder_id)
 
+@app.post("/api/alerts/maintenance/send-emails")
+def api_alerts_maintenance_send_emails():
+    """
+    Encola por correo todos los recordatorios pendientes que vencen pronto
+    (days, dry_run opcionales) y responde 202; el envío lo hacen los
+    despachadores de la bandeja de salida (idempotency_keys identifica cada mensaje).
+    """
+    if not notification_channel_ready("email"):
+        return jsonify({"error": "No hay configuración SMTP. Define SMTP_HOST, SMTP_USERNAME, SMTP_PASSWORD y SMTP_FROM_EMAIL."}), 500
+    payload = request.get_json(silent=True) or {}
+    try:
+        lead_days = int(payload.get("days", MAINTENANCE_REMINDER_LEAD_DAYS))
+    except (TypeError, ValueError):
+        return jsonify({"error": "days debe ser un número"}), 400
+    dry_run = bool(payload.get("dry_run"))
+    result = queue_due_maintenance_emails(lead_days, dry_run=dry_run)
+    if dry_run:
+        return jsonify(result)
+    if result["queued"]:
+        notify_dispatchers()
+    return jsonify(result), 202
+
+# --------------
+# Historial de documentos (paginación por cursor sobre (date, id))
+# --------------
+HISTORY_PAGE_SIZE = 50
+HISTORY_MAX_PAGE_SIZE = 500
+
+def encode_history_cursor(doc_date, doc_id):
+    raw = json.dumps([doc_date.isoformat(), doc_id]).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+def decode_history_cursor(cursor):
+    """Devuelve (date, id) a partir del cursor opaco; ValueError si no es válido."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        doc_date, doc_id = json.loads(base64.urlsafe_b64decode(padded.encode("ascii")))
+        return datetime.fromisoformat(doc_date), int(doc_id)
+    except (TypeError, ValueError, UnicodeError):
+        raise ValueError("cursor inválido")
+
+def document_history_page(db, model, number_column, party_column, party_relation, payment_filter=True):
+    """
+    Lee una página del historial, de la más reciente a la más antigua.
+
+    Filtros de la petición: customer_id/supplier_id (según party_column),
+    start/end (AAAA-MM-DD, end incluido), payment_method y number (prefijo,
+    distingue mayúsculas). limit (50 por defecto) y cursor paginan sobre
+    (date, id), así que una página profunda cuesta lo mismo que la primera.
+    Devuelve (documentos, siguiente cursor o None); ValueError si un
+    parámetro no es válido.
+    """
+    args = request.args
+    limit = max(1, min(int(args.get("limit") or HISTORY_PAGE_SIZE), HISTORY_MAX_PAGE_SIZE))
+    stmt = select(model).options(selectinload(party_relation))
+    party_id = args.get(party_column.key, "").strip()
+    if party_id:
+        stmt = stmt.where(party_column == int(party_id))
+    start = args.get("start", "").strip()
+    end = args.get("end", "").strip()
+    if start:
+        stmt = stmt.where(model.date >= datetime.combine(date.fromisoformat(start), datetime.min.time()))
+    if end:
+        stmt = stmt.where(model.date < datetime.combine(date.fromisoformat(end) + timedelta(days=1), datetime.min.time()))
+    payment_method = args.get("payment_method", "").strip()
+    if payment_filter and payment_method:
+        stmt = stmt.where(model.payment_method == payment_method.upper())
+    prefix = args.get("number", "").strip()
+    if prefix:
+        # rango en vez de LIKE para que SQLite use el índice único del número
+        stmt = stmt.where(number_column >= prefix, number_column < prefix + "\uffff")
+    cursor = args.get("cursor", "").strip()
+    if cursor:
+        stmt = stmt.where(tuple_(model.date, model.id) < tuple_(*decode_history_cursor(cursor)))
+    stmt = stmt.order_by(model.date.desc(), model.id.desc()).limit(limit)
+
+    documents = list(db.scalars(stmt))
+    next_cursor = None
+    if len(documents) == limit:
+        next_cursor = encode_history_cursor(documents[-1].date, documents[-1].id)
+    return documents, next_cursor
+
+def history_response(items, next_cursor, endpoint):
+    response = jsonify(items)
+    if next_cursor:
+        response.headers["X-Next-Cursor"] = next_cursor
+        response.headers["Link"] = f'<{url_for(endpoint, **dict(request.args, cursor=next_cursor))}>; rel="next"'
+    return response
+
 @app.get("/api/invoices/history")
 def api_invoices_history():
-    """Obtiene el historial de facturas"""
+    """Obtiene el historial de facturas (filtros y cursor en document_history_page)"""
     db = SessionLocal()
     try:
-        invoices = db.query(Invoice).order_by(Invoice.date.desc()).limit(50).all()
+        try:
+            invoices, next_cursor = document_history_page(db, Invoice, Invoice.number, Invoice.customer_id, Invoice.customer)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
         out = []
         for inv in invoices:
-            # Eager load customer
             customer_data = customer_to_dict(inv.customer)
             out.append({
                 "id": inv.id,
@@ -2016,19 +5497,21 @@ def api_invoices_history():
                 "vat_total": float(inv.vat_total),
                 "total": float(inv.total)
             })
-        return jsonify(out)
+        return history_response(out, next_cursor, "api_invoices_history")
     finally:
         db.close()
 
 @app.get("/api/remissions/history")
 def api_remissions_history():
-    """Obtiene el historial de remisiones"""
+    """Obtiene el historial de remisiones (filtros y cursor en document_history_page)"""
     db = SessionLocal()
     try:
-        remissions = db.query(Remission).order_by(Remission.date.desc()).limit(50).all()
+        try:
+            remissions, next_cursor = document_history_page(db, Remission, Remission.number, Remission.customer_id, Remission.customer)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
         out = []
         for rem in remissions:
-            # Eager load customer
             customer_data = customer_to_dict(rem.customer)
             out.append({
                 "id": rem.id,
@@ -2039,7 +5522,7 @@ def api_remissions_history():
                 "vat_total": float(rem.vat_total),
                 "total": float(rem.total)
             })
-        return jsonify(out)
+        return history_response(out, next_cursor, "api_remissions_history")
     finally:
         db.close()
 
@@ -2049,28 +5532,439 @@ def api_products_search():
     query = request.args.get('q', '').strip()
     if not query:
         return jsonify([])
-    
+
+    if product_autocomplete:
+        return jsonify(product_autocomplete.search(query, limit=20))
+
     db = SessionLocal()
     try:
-        # Buscar por nombre o SKU
-        products = db.query(Product).filter(
-            (Product.name.ilike(f'%{query}%')) | 
-            (Product.sku.ilike(f'%{query}%'))
-        ).limit(20).all()
-        
+        products = search_products(db, query, limit=20)
         return jsonify([product_to_dict(p) for p in products])
     finally:
         db.close()
 
+# --------------
+# Exportación masiva de PDFs
+# --------------
+EXPORT_FILE_PREFIX = {"invoice": "factura", "remission": "remision"}
+
+class _ChunkSink:
+    """Destino no posicionable para zipfile/pyarrow: acumula lo escrito hasta que el generador lo envía."""
+    closed = False
+
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def drain(self):
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+def _export_document_pdf(kind, document_id):
+    """PDF de un documento para la exportación: caché, pool de procesos o servicio renderizador; None si no se pudo."""
+    try:
+        return render_document_pdf(kind, document_id, delegate=PDF_RENDER_SERVICE)
+    except PdfRenderPending:
+        return None
+
+def iter_document_pdfs(kind, documents, workers):
+    """Genera los PDFs en paralelo manteniendo el orden y como máximo 2*workers en vuelo."""
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pdf-export") as executor:
+        remaining = iter(documents)
+        in_flight = deque()
+        for doc_id, number in remaining:
+            in_flight.append((number, executor.submit(_export_document_pdf, kind, doc_id)))
+            if len(in_flight) >= workers * 2:
+                break
+        while in_flight:
+            number, future = in_flight.popleft()
+            following = next(remaining, None)
+            if following is not None:
+                in_flight.append((following[1], executor.submit(_export_document_pdf, kind, following[0])))
+            yield number, future.result()
+
+def update_export_job(export_id, **values):
+    db = SessionLocal.session_factory()
+    try:
+        db.execute(update(ExportJob).where(ExportJob.id == export_id).values(**values))
+        db.commit()
+    finally:
+        db.close()
+
+def export_job_to_dict(job):
+    end = job.finished_at or datetime.utcnow()
+    elapsed = max((end - job.started_at).total_seconds(), 0.001)
+    return {
+        "id": job.id,
+        "kind": job.kind,
+        "format": job.export_format,
+        "status": job.status,
+        "total": job.total,
+        "done": job.done,
+        "percent": round(100.0 * job.done / job.total, 1) if job.total else 100.0,
+        "bytes_sent": job.bytes_sent,
+        "elapsed_seconds": round(elapsed, 2),
+        "documents_per_second": round(job.done / elapsed, 2),
+        "error": job.error or "",
+    }
+
+def select_export_documents(db, model):
+    """Lee ids=1,2,3 o start/end (AAAA-MM-DD, end incluido) de la petición."""
+    query = db.query(model.id, model.number)
+    raw_ids = request.args.get("ids", "").strip()
+    start = request.args.get("start", "").strip()
+    end = request.args.get("end", "").strip()
+    if raw_ids:
+        ids = [int(part) for part in raw_ids.split(",") if part.strip()]
+        query = query.filter(model.id.in_(ids))
+    elif start or end:
+        if start:
+            query = query.filter(model.date >= datetime.combine(date.fromisoformat(start), datetime.min.time()))
+        if end:
+            query = query.filter(model.date < datetime.combine(date.fromisoformat(end) + timedelta(days=1), datetime.min.time()))
+    else:
+        raise ValueError("Indica ids=1,2,3 o un rango start/end (AAAA-MM-DD).")
+    return query.order_by(model.date.asc(), model.id.asc()).all()
+
+def export_documents_response(kind):
+    model = PDF_DOCUMENT_TYPES[kind][0]
+    export_format = request.args.get("format", "zip").lower()
+    if export_format not in ("zip", "pdf"):
+        return jsonify({"error": "format debe ser zip o pdf"}), 400
+    db = SessionLocal()
+    try:
+        documents = select_export_documents(db, model)
+    except ValueError as exc:
+        return jsonify({"error": str(exc)}), 400
+    finally:
+        db.close()
+    if not documents:
+        return jsonify({"error": "No hay documentos para exportar."}), 404
+    if export_format == "pdf":
+        if not PYPDF_AVAILABLE:
+            return jsonify({"error": "El PDF unido requiere pypdf; usa format=zip."}), 400
+        if len(documents) > PDF_EXPORT_MERGE_MAX:
+            return jsonify({"error": f"El PDF unido admite hasta {PDF_EXPORT_MERGE_MAX} documentos; usa format=zip."}), 400
+
+    export_id = uuid.uuid4().hex
+    db = SessionLocal.session_factory()
+    try:
+        db.add(ExportJob(id=export_id, kind=kind, export_format=export_format, total=len(documents)))
+        db.commit()
+    finally:
+        db.close()
+
+    prefix = EXPORT_FILE_PREFIX[kind]
+    stream = _stream_zip_export if export_format == "zip" else _stream_merged_export
+    response = Response(
+        stream_with_context(stream(export_id, kind, documents, prefix)),
+        mimetype="application/zip" if export_format == "zip" else "application/pdf",
+    )
+    filename = f"{prefix}s_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.{export_format}"
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    response.headers["X-Export-Id"] = export_id
+    response.headers["X-Export-Progress"] = url_for("api_exports_progress", export_id=export_id)
+    return response
+
+def _track_export(export_id, produce):
+    """Envuelve el generador de bytes registrando avance, throughput y cancelaciones."""
+    done = sent = 0
+    last_update = time.monotonic()
+    started = time.monotonic()
+    try:
+        for chunk, finished_doc in produce():
+            sent += len(chunk)
+            done += 1 if finished_doc else 0
+            if chunk:
+                yield chunk
+            if time.monotonic() - last_update >= 1.0:
+                update_export_job(export_id, done=done, bytes_sent=sent)
+                last_update = time.monotonic()
+    except GeneratorExit:
+        update_export_job(export_id, done=done, bytes_sent=sent, status="cancelled", finished_at=datetime.utcnow())
+        raise
+    except Exception as exc:
+        update_export_job(export_id, done=done, bytes_sent=sent, status="failed", error=str(exc), finished_at=datetime.utcnow())
+        raise
+    update_export_job(export_id, done=done, bytes_sent=sent, status="done", finished_at=datetime.utcnow())
+    elapsed = max(time.monotonic() - started, 0.001)
+    print(f"[export] {export_id}: {done} documentos, {done / elapsed:.1f} docs/s, {sent / 1e6:.1f} MB")
+
+def _stream_zip_export(export_id, kind, documents, prefix):
+    def produce():
+        sink = _ChunkSink()
+        with zipfile.ZipFile(sink, mode="w", compression=zipfile.ZIP_STORED) as archive:
+            for number, pdf_bytes in iter_document_pdfs(kind, documents, PDF_EXPORT_WORKERS):
+                if pdf_bytes:
+                    archive.writestr(f"{prefix}_{number}.pdf", pdf_bytes)
+                else:
+                    archive.writestr(f"{prefix}_{number}.error.txt", "No fue posible generar el PDF.")
+                yield sink.drain(), True
+        yield sink.drain(), False  # directorio central del ZIP
+    return _track_export(export_id, produce)
+
+def _stream_merged_export(export_id, kind, documents, prefix):
+    """
+    Une los PDFs de cada documento (los mismos del ZIP: caché y render en
+    paralelo) a medida que llegan. La tabla de referencias del PDF necesita
+    todos los objetos, así que el archivo unido se escribe completo a un
+    temporal antes del primer byte; por eso el límite PDF_EXPORT_MERGE_MAX.
+    """
+    def produce():
+        writer = PdfWriter()
+        for number, pdf_bytes in iter_document_pdfs(kind, documents, PDF_EXPORT_WORKERS):
+            if not pdf_bytes:
+                raise RuntimeError(f"No fue posible generar el PDF de {prefix} {number}.")
+            writer.append(BytesIO(pdf_bytes))
+            yield b"", True
+        with tempfile.SpooledTemporaryFile(max_size=PDF_EXPORT_SPOOL_BYTES) as merged:
+            writer.write(merged)
+            writer.close()
+            merged.seek(0)
+            while True:
+                chunk = merged.read(256 * 1024)
+                if not chunk:
+                    break
+                yield chunk, False
+    return _track_export(export_id, produce)
+
+@app.get("/api/invoices/export")
+def api_invoices_export():
+    """Exporta facturas (ids=... o start/end) como ZIP en streaming o un solo PDF (format=pdf)."""
+    return export_documents_response("invoice")
+
+@app.get("/api/remissions/export")
+def api_remissions_export():
+    """Exporta remisiones (ids=... o start/end) como ZIP en streaming o un solo PDF (format=pdf)."""
+    return export_documents_response("remission")
+
+@app.get("/api/exports/<export_id>")
+def api_exports_progress(export_id):
+    """Avance y throughput de una exportación en curso o terminada."""
+    db = SessionLocal()
+    try:
+        job = db.get(ExportJob, export_id)
+        if not job:
+            return jsonify({"error": "Exportación no encontrada"}), 404
+        return jsonify(export_job_to_dict(job))
+    finally:
+        db.close()
+
+# --------------
+# Exportación de historial en streaming
+# --------------
+def _document_items_export(item_model, document_model, document_fk, number_column, party_column, price_column, extra=()):
+    return select(
+        item_model.id,
+        document_model.id.label("document_id"),
+        number_column.label("document_number"),
+        document_model.date.label("date"),
+        party_column,
+        *extra,
+        item_model.product_id,
+        Product.sku,
+        Product.name.label("product_name"),
+        item_model.quantity,
+        price_column,
+        item_model.vat_rate,
+        item_model.total_excl_vat,
+        item_model.vat_amount,
+        item_model.total_incl_vat,
+    ).join(document_model, document_model.id == document_fk).outerjoin(Product, Product.id == item_model.product_id)
+
+# entidad -> (consulta, columna id para ordenar/reanudar, columna de fecha para start/end)
+DATA_EXPORT_ENTITIES = {
+    "stock_movements": (
+        select(
+            StockMovement.id,
+            StockMovement.created_at.label("date"),
+            StockMovement.product_id,
+            Product.sku,
+            Product.name.label("product_name"),
+            StockMovement.movement_type,
+            StockMovement.quantity_change,
+            StockMovement.reference_type,
+            StockMovement.reference_id,
+            StockMovement.note,
+        ).outerjoin(Product, Product.id == StockMovement.product_id),
+        StockMovement.id,
+        StockMovement.created_at,
+    ),
+    "invoice_items": (
+        _document_items_export(InvoiceItem, Invoice, InvoiceItem.invoice_id, Invoice.number, Invoice.customer_id,
+                               InvoiceItem.unit_price, extra=(Invoice.payment_method,)),
+        InvoiceItem.id,
+        Invoice.date,
+    ),
+    "remission_items": (
+        _document_items_export(RemissionItem, Remission, RemissionItem.remission_id, Remission.number, Remission.customer_id,
+                               RemissionItem.unit_price, extra=(Remission.payment_method,)),
+        RemissionItem.id,
+        Remission.date,
+    ),
+    "purchase_items": (
+        _document_items_export(PurchaseItem, Purchase, PurchaseItem.purchase_id, Purchase.code, Purchase.supplier_id,
+                               PurchaseItem.unit_cost),
+        PurchaseItem.id,
+        Purchase.date,
+    ),
+}
+DATA_EXPORT_FORMATS = {
+    "csv": "text/csv",
+    "jsonl": "application/x-ndjson",
+    "columnar": "application/x-ndjson",
+    "parquet": "application/vnd.apache.parquet",
+}
+
+def data_export_statement(entity, start=None, end=None, after_id=None):
+    """Consulta de la entidad filtrada por fecha (end incluido) y reanudable con after_id."""
+    stmt, id_column, date_column = DATA_EXPORT_ENTITIES[entity]
+    if start:
+        stmt = stmt.where(date_column >= datetime.combine(start, datetime.min.time()))
+    if end:
+        stmt = stmt.where(date_column < datetime.combine(end + timedelta(days=1), datetime.min.time()))
+    if after_id:
+        stmt = stmt.where(id_column > after_id)
+    return stmt.order_by(id_column.asc())
+
+def _export_cell(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return value
+
+def _encode_csv_batch(columns, rows, header):
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    if header:
+        writer.writerow(columns)
+    for row in rows:
+        writer.writerow(["" if value is None else _export_cell(value) for value in row])
+    return buffer.getvalue().encode("utf-8")
+
+def _encode_jsonl_batch(columns, rows, header):
+    lines = [json.dumps(dict(zip(columns, map(_export_cell, row))), ensure_ascii=False) for row in rows]
+    return ("\n".join(lines) + "\n").encode("utf-8") if lines else b""
+
+def _encode_columnar_batch(columns, rows, header):
+    """Un objeto JSON por lote con los valores agrupados por columna."""
+    data = {name: [_export_cell(value) for value in values] for name, values in zip(columns, zip(*rows))}
+    return (json.dumps({"count": len(rows), "columns": data}, ensure_ascii=False) + "\n").encode("utf-8")
+
+def _parquet_schema(stmt):
+    types = {int: pyarrow.int64(), Decimal: pyarrow.float64(), float: pyarrow.float64(),
+             datetime: pyarrow.timestamp("us"), date: pyarrow.date32()}
+    fields = []
+    for column in stmt.selected_columns:
+        try:
+            arrow_type = types.get(column.type.python_type, pyarrow.string())
+        except NotImplementedError:
+            arrow_type = pyarrow.string()
+        fields.append(pyarrow.field(column.name, arrow_type))
+    return pyarrow.schema(fields)
+
+def iter_data_export(stmt, export_format, batch_size):
+    """Recorre la consulta con un cursor en streaming y genera el archivo por lotes.
+
+    El cursor se mantiene abierto toda la exportación: en SQLite (WAL) la
+    lectura ve una foto consistente sin bloquear las ventas que entran mientras
+    tanto, y la memoria queda acotada a un lote.
+    """
+    started = time.monotonic()
+    rows_sent = bytes_sent = 0
+    with engine.connect() as conn:
+        result = conn.execution_options(stream_results=True, yield_per=batch_size).execute(stmt)
+        columns = list(result.keys())
+        if export_format == "parquet":
+            sink = _ChunkSink()
+            schema = _parquet_schema(stmt)
+            writer = pyarrow.parquet.ParquetWriter(sink, schema)
+            for rows in result.partitions():
+                data = {name: [float(v) if isinstance(v, Decimal) else v for v in values]
+                        for name, values in zip(columns, zip(*rows))}
+                writer.write_table(pyarrow.Table.from_pydict(data, schema=schema))  # un row group por lote
+                rows_sent += len(rows)
+                chunk = sink.drain()
+                bytes_sent += len(chunk)
+                yield chunk
+            writer.close()
+            chunk = sink.drain()
+        else:
+            encode = {"csv": _encode_csv_batch, "jsonl": _encode_jsonl_batch, "columnar": _encode_columnar_batch}[export_format]
+            header = True
+            for rows in result.partitions():
+                chunk = encode(columns, rows, header)
+                header = False
+                rows_sent += len(rows)
+                bytes_sent += len(chunk)
+                yield chunk
+            chunk = _encode_csv_batch(columns, [], True) if export_format == "csv" and header else b""
+        bytes_sent += len(chunk)
+        if chunk:
+            yield chunk
+    elapsed = max(time.monotonic() - started, 0.001)
+    print(f"[export] {rows_sent} filas ({export_format}) en {elapsed:.1f}s, {rows_sent / elapsed:.0f} filas/s, {bytes_sent / 1e6:.1f} MB")
+
+@app.get("/api/export/<entity>")
+def api_data_export(entity):
+    """Exporta stock_movements, invoice_items, remission_items o purchase_items en streaming.
+
+    Parámetros: format=csv|jsonl|columnar|parquet, start/end (AAAA-MM-DD, end
+    incluido), after_id para reanudar una descarga cortada y batch_size.
+    """
+    if entity not in DATA_EXPORT_ENTITIES:
+        return jsonify({"error": f"Entidad desconocida. Usa: {', '.join(DATA_EXPORT_ENTITIES)}"}), 404
+    export_format = request.args.get("format", "csv").lower()
+    if export_format not in DATA_EXPORT_FORMATS:
+        return jsonify({"error": "format debe ser csv, jsonl, columnar o parquet"}), 400
+    if export_format == "parquet" and not PYARROW_AVAILABLE:
+        return jsonify({"error": "format=parquet requiere pyarrow; usa csv, jsonl o columnar."}), 400
+    try:
+        start = request.args.get("start", "").strip()
+        end = request.args.get("end", "").strip()
+        start = date.fromisoformat(start) if start else None
+        end = date.fromisoformat(end) if end else None
+        after_id = int(request.args.get("after_id") or 0)
+        batch_size = min(max(int(request.args.get("batch_size") or DATA_EXPORT_BATCH_SIZE), 1), 50000)
+    except ValueError:
+        return jsonify({"error": "start/end deben ser AAAA-MM-DD y after_id/batch_size enteros"}), 400
+
+    stmt = data_export_statement(entity, start, end, after_id)
+    response = Response(
+        stream_with_context(iter_data_export(stmt, export_format, batch_size)),
+        mimetype=DATA_EXPORT_FORMATS[export_format],
+    )
+    extension = "jsonl" if export_format == "columnar" else export_format
+    filename = f"{entity}_{datetime.utcnow().strftime('%Y%m%d%H%M%S')}.{extension}"
+    response.headers["Content-Disposition"] = f"attachment; filename={filename}"
+    response.headers["X-Accel-Buffering"] = "no"  # que un proxy no acumule toda la respuesta
+    return response
+
 @app.get("/api/purchases/history")
 def api_purchases_history():
-    """Obtiene el historial de compras"""
+    """Obtiene el historial de compras (filtros y cursor en document_history_page)"""
     db = SessionLocal()
     try:
-        purchases = db.query(Purchase).order_by(Purchase.date.desc()).limit(50).all()
+        try:
+            purchases, next_cursor = document_history_page(db, Purchase, Purchase.code, Purchase.supplier_id, Purchase.supplier,
+                                                           payment_filter=False)
+        except ValueError as exc:
+            return jsonify({"error": str(exc)}), 400
         out = []
         for purchase in purchases:
-            # Eager load supplier
             supplier_data = supplier_to_dict(purchase.supplier)
             out.append({
                 "id": purchase.id,
@@ -2082,7 +5976,7 @@ def api_purchases_history():
                 "total": float(purchase.total),
                 "notes": purchase.notes
             })
-        return jsonify(out)
+        return history_response(out, next_cursor, "api_purchases_history")
     finally:
         db.close()
 
@@ -2131,6 +6025,655 @@ def api_purchase_details(purchase_id):
 def send_static(path):
     return send_from_directory(os.path.join(BASE_DIR, 'static'), path)
 
+# --------------
+# Comandos CLI y benchmarks (flask --app app <comando>)
+# --------------
+@contextmanager
+def benchmark_session():
+    """Abre una sesión sobre una base SQLite temporal con el esquema completo."""
+    tmp_dir = tempfile.mkdtemp(prefix="inventario-bench-")
+    bench_engine = create_engine(f"sqlite:///{os.path.join(tmp_dir, 'bench.db')}", future=True)
+    Base.metadata.create_all(bind=bench_engine)
+    db = sessionmaker(bind=bench_engine, autoflush=False, future=True)()
+    try:
+        yield db
+    finally:
+        db.close()
+        bench_engine.dispose()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+class QueryCounter:
+    """Cuenta las sentencias SQL enviadas a la base mientras está activo."""
+    def __init__(self, bind):
+        self.bind = bind
+        self.count = 0
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+    def __enter__(self):
+        event.listen(self.bind, "before_cursor_execute", self._on_execute)
+        return self
+
+    def __exit__(self, *exc):
+        event.remove(self.bind, "before_cursor_execute", self._on_execute)
+
+BENCH_PRODUCT_WORDS = (
+    "Bicicleta", "Cadena", "Piñón", "Llanta", "Neumático", "Freno", "Pedal", "Sillín",
+    "Manubrio", "Rin", "Tensor", "Cárter", "Guaya", "Pastilla", "Rodamiento", "Casco",
+)
+BENCH_PRODUCT_BRANDS = ("Shimano", "GW", "Specialized", "Trek", "SRAM", "Óptimus", "Kenda", "Maxxis")
+
+def benchmark_product_name(i):
+    word = BENCH_PRODUCT_WORDS[i % len(BENCH_PRODUCT_WORDS)]
+    brand = BENCH_PRODUCT_BRANDS[(i // len(BENCH_PRODUCT_WORDS)) % len(BENCH_PRODUCT_BRANDS)]
+    return f"{word} {brand} {i:06d}"
+
+def seed_benchmark_catalog(db, n_products, sales_per_product=3, n_suppliers=20):
+    """Carga un catálogo sintético con compras y ventas para las pruebas de rendimiento."""
+    now = datetime.utcnow()
+    db.execute(insert(Supplier), [{"name": f"Proveedor {i}"} for i in range(1, n_suppliers + 1)])
+    db.execute(insert(Customer), [{"name": "Cliente benchmark", "document_number": "1"}])
+    db.execute(insert(Product), [
+        {"name": benchmark_product_name(i), "sku": f"SKU-{i:06d}", "price": 10000, "current_stock": 100, "created_at": now}
+        for i in range(1, n_products + 1)
+    ])
+    db.execute(insert(Purchase), [
+        {"id": i, "code": f"COMP-BENCH-{i}", "supplier_id": (i % n_suppliers) + 1, "date": now}
+        for i in range(1, n_products + 1)
+    ])
+    db.execute(insert(PurchaseItem), [
+        {"purchase_id": i, "product_id": i, "quantity": 10, "unit_cost": 5000,
+         "total_excl_vat": 50000, "vat_amount": 9500, "total_incl_vat": 59500}
+        for i in range(1, n_products + 1)
+    ])
+    db.execute(insert(Invoice), [{"id": 1, "number": "FAC-BENCH", "customer_id": 1, "date": now}])
+    db.execute(insert(Remission), [{"id": 1, "number": "REM-BENCH", "customer_id": 1, "date": now}])
+    sale_rows = [
+        {"product_id": i, "quantity": 1, "unit_price": 10000,
+         "total_excl_vat": 10000, "vat_amount": 0, "total_incl_vat": 10000}
+        for i in range(1, n_products + 1)
+        for _ in range(sales_per_product)
+    ]
+    db.execute(insert(InvoiceItem), [dict(row, invoice_id=1) for row in sale_rows[0::2]])
+    db.execute(insert(RemissionItem), [dict(row, remission_id=1) for row in sale_rows[1::2]])
+    rebuild_product_stats(db)
+    db.commit()
+
+@app.cli.command("rebuild-product-stats")
+@click.option("--check", is_flag=True, help="Solo reporta diferencias, sin reescribir la tabla.")
+def rebuild_product_stats_command(check):
+    """Recalcula product_stats desde el historial y reporta diferencias."""
+    db = SessionLocal()
+    try:
+        drift = rebuild_product_stats(db, apply=not check)
+        for entry in drift:
+            click.echo(f"producto {entry['product_id']}: {entry['fields']}")
+        if check:
+            db.rollback()
+            click.echo(f"{len(drift)} productos con diferencias.")
+        else:
+            db.commit()
+            click.echo(f"product_stats reconstruida ({len(drift)} productos corregidos).")
+    finally:
+        db.close()
+
+@app.cli.command("close-stock-checkpoints")
+@click.option("--rebuild", is_flag=True, help="Borra los cierres y los recalcula desde el primer movimiento.")
+def close_stock_checkpoints_command(rebuild):
+    """Escribe los cierres mensuales de stock pendientes."""
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        written = rebuild_stock_checkpoints(db) if rebuild else close_stock_checkpoints(db)
+        closed = last_closed_month(db)
+        click.echo(f"{written} cierres escritos en {time.perf_counter() - started:.2f} s; "
+                   f"ledger cerrado hasta {closed.date().isoformat() if closed else '-'}.")
+    finally:
+        db.close()
+
+@app.cli.command("reconcile-stock")
+def reconcile_stock_command():
+    """Compara current_stock con el ledger (último cierre + movimientos posteriores)."""
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        checked, mismatches = reconcile_stock(db)
+        for entry in mismatches:
+            click.echo(f"producto {entry['product_id']} ({entry['sku']}): stock {entry['current_stock']}, ledger {entry['ledger']}")
+        click.echo(f"{checked} productos revisados, {len(mismatches)} con diferencias ({time.perf_counter() - started:.2f} s).")
+    finally:
+        db.close()
+
+@app.cli.command("rebuild-average-costs")
+def rebuild_average_costs_command():
+    """
+    Recalcula el costo promedio de cada producto y el costo de las ventas
+    desde stock_movements, y rehace los resúmenes de ventas con esos costos.
+    """
+    db = SessionLocal()
+    try:
+        summary = rebuild_average_costs(db)
+        # rebuild_average_costs reescribe el costo de todas las líneas de venta
+        written = rebuild_sales_rollups(db)
+        db.commit()
+        click.echo(f"Costo promedio de {summary['products']} productos y {summary['sale_lines']} líneas de venta "
+                   f"recalculado en {summary['seconds']:.2f} s; {written} filas de resúmenes de ventas reescritas.")
+    finally:
+        db.close()
+
+@app.cli.command("rebuild-sales-rollups")
+@click.option("--start", default=None, help="Primer día (AAAA-MM-DD); por defecto todo el historial.")
+@click.option("--end", default=None, help="Último día (AAAA-MM-DD), incluido.")
+def rebuild_sales_rollups_command(start, end):
+    """Reescribe los resúmenes diarios de ventas desde las facturas y remisiones."""
+    try:
+        start = date.fromisoformat(start) if start else None
+        end = date.fromisoformat(end) if end else None
+    except ValueError:
+        raise click.BadParameter("las fechas deben ser AAAA-MM-DD")
+    db = SessionLocal()
+    try:
+        started = time.perf_counter()
+        written = rebuild_sales_rollups(db, start, end)
+        db.commit()
+        click.echo(f"{written} filas de resumen escritas en {time.perf_counter() - started:.2f} s.")
+    finally:
+        db.close()
+
+@app.cli.command("run-product-purges")
+def run_product_purges_command():
+    """Procesa de inmediato los borrados definitivos de productos archivados que estén pendientes."""
+    started = time.perf_counter()
+    processed = run_pending_product_purges()
+    click.echo(f"{processed} borrados procesados en {time.perf_counter() - started:.2f} s.")
+
+@app.cli.command("render-pending-pdfs")
+def render_pending_pdfs_command():
+    """Genera ahora los PDFs pendientes en la cola (p.ej. tras una caída)."""
+    processed = run_pending_pdf_render_jobs()
+    click.echo(f"{processed} trabajos procesados.")
+
+@app.cli.command("send-pending-notifications")
+def send_pending_notifications_command():
+    """Envía ahora los correos y WhatsApp vencidos de la bandeja de salida."""
+    processed = run_pending_notifications()
+    click.echo(f"{processed} mensajes procesados.")
+
+@app.cli.command("send-maintenance-reminders")
+@click.option("--days", default=MAINTENANCE_REMINDER_LEAD_DAYS, show_default=True, help="Incluye los que vencen en los próximos N días.")
+@click.option("--limit", default=0, help="Máximo de recordatorios (0 = todos).")
+@click.option("--dry-run", is_flag=True, help="Solo cuenta los recordatorios, no envía.")
+def send_maintenance_reminders_command(days, limit, dry_run):
+    """Encola por correo los recordatorios de mantenimiento pendientes, los marca notificados y vacía la bandeja."""
+    summary = send_due_maintenance_reminders(days, limit=limit or None, dry_run=dry_run)
+    click.echo(f"Pendientes: {summary['due']}  enviados: {summary['sent']}  fallidos: {summary['failed']}  "
+               f"en cola: {summary['queued']}")
+    for error in summary["errors"][:20]:
+        click.echo(f"  {error['email']} ({error['status']}): {error['error']}")
+
+@app.cli.command("dispatch-maintenance-reminders")
+@click.option("--days", default=MAINTENANCE_REMINDER_LEAD_DAYS, show_default=True, help="Incluye los que vencen en los próximos N días.")
+@click.option("--batch", default=MAINTENANCE_REMINDER_BATCH, show_default=True, help="Recordatorios reclamados por transacción.")
+def dispatch_maintenance_reminders_command(days, batch):
+    """Encola por correo/WhatsApp los recordatorios pendientes y los envía."""
+    queued = dispatch_due_maintenance_reminders(days, batch)
+    sent = run_pending_notifications()
+    click.echo(f"{queued} recordatorios encolados, {sent} mensajes procesados.")
+
+def _sequence_stress_worker(args):
+    """Un proceso del stress test: reserva números e inserta filas con UNIQUE, revirtiendo algunas."""
+    db_url, count, block_size, rollback_rate, seed = args
+    stress_engine = create_engine(db_url, future=True, connect_args={"timeout": 60})
+    make_session = sessionmaker(bind=stress_engine, autoflush=False, future=True)
+    allocator = SequenceBlockAllocator("stress", block_size, bind=stress_engine) if block_size else None
+    rng = random.Random(seed)
+    committed, rolled_back, conflicts = [], 0, 0
+    for _ in range(count):
+        db = make_session()
+        try:
+            value = allocator.next() if allocator else next_sequence(db, "stress")
+            db.execute(text("INSERT INTO sequence_stress (value, pid) VALUES (:value, :pid)"), {"value": value, "pid": os.getpid()})
+            if rng.random() < rollback_rate:
+                db.rollback()
+                rolled_back += 1
+            else:
+                db.commit()
+                committed.append(value)
+        except IntegrityError:
+            db.rollback()
+            conflicts += 1
+        finally:
+            db.close()
+    stress_engine.dispose()
+    return committed, rolled_back, conflicts
+
+@app.cli.command("stress-sequences")
+@click.option("--processes", default=8, show_default=True, help="Procesos compitiendo por la secuencia.")
+@click.option("--per-process", default=200, show_default=True, help="Números que pide cada proceso.")
+@click.option("--rollback-rate", default=0.1, show_default=True, help="Fracción de transacciones que se revierten.")
+@click.option("--block", default=0, show_default=True, help="Tamaño de bloque por proceso (0 = UPDATE ... RETURNING por documento).")
+def stress_sequences_command(processes, per_process, rollback_rate, block):
+    """
+    Prueba de concurrencia del asignador de números sobre una base temporal:
+    varios procesos piden números a la vez y se verifica que no haya
+    duplicados ni (sin bloques) huecos.
+    """
+    tmp_dir = tempfile.mkdtemp(prefix="inventario-seq-")
+    db_url = f"sqlite:///{os.path.join(tmp_dir, 'stress.db')}"
+    try:
+        stress_engine = create_engine(db_url, future=True)
+        Sequence.__table__.create(bind=stress_engine)
+        with stress_engine.begin() as conn:
+            conn.execute(text("CREATE TABLE sequence_stress (value INTEGER PRIMARY KEY, pid INTEGER)"))
+        method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        jobs = [(db_url, per_process, block, rollback_rate, seed) for seed in range(processes)]
+        started = time.perf_counter()
+        with multiprocessing.get_context(method).Pool(processes) as pool:
+            results = pool.map(_sequence_stress_worker, jobs)
+        elapsed = time.perf_counter() - started
+
+        handed_out = [value for committed, _, _ in results for value in committed]
+        rolled_back = sum(r for _, r, _ in results)
+        conflicts = sum(c for _, _, c in results)
+        with stress_engine.connect() as conn:
+            stored = [row[0] for row in conn.execute(text("SELECT value FROM sequence_stress ORDER BY value"))]
+            next_value = conn.execute(select(Sequence.next_value).where(Sequence.name == "stress")).scalar()
+        stress_engine.dispose()
+
+        duplicates = conflicts + (len(handed_out) - len(set(handed_out)))
+        gaps = (stored[-1] - stored[0] + 1 - len(stored)) if stored else 0
+        click.echo(f"{len(stored)} documentos en {elapsed:.2f} s ({len(stored) / elapsed:.0f}/s) con {processes} procesos; "
+                   f"{rolled_back} revertidos.")
+        click.echo(f"Duplicados: {duplicates}  huecos: {gaps}  rango: {stored[0] if stored else '-'}..{stored[-1] if stored else '-'}  "
+                   f"siguiente: {next_value}")
+        if duplicates:
+            raise click.ClickException("Se asignó el mismo número más de una vez.")
+        if not block and (gaps or stored[0] != 1 or next_value != len(stored) + 1):
+            raise click.ClickException("La numeración transaccional dejó huecos.")
+        if block:
+            click.echo("Con bloques los huecos son esperados (transacciones revertidas y restos de bloque).")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+def _stock_hammer_worker(args):
+    """Un proceso del stress de stock: intenta vender de a una unidad del mismo producto."""
+    db_url, attempts, naive, seed = args
+    hammer_engine = create_app_engine(db_url)
+    make_session = sessionmaker(bind=hammer_engine, autoflush=False, future=True)
+    sold = rejected = errors = 0
+    for _ in range(attempts):
+        db = make_session()
+        try:
+            if naive:
+                # Patrón anterior: leer, validar en Python y escribir el valor calculado
+                product = db.get(Product, 1)
+                if product.current_stock < 1:
+                    rejected += 1
+                    continue
+                time.sleep(0.001)
+                product.current_stock = product.current_stock - 1
+                db.add(StockMovement(product_id=1, movement_type="invoice", quantity_change=-1))
+            else:
+                apply_stock_deltas(db, [(1, -1)], "invoice", "stress", "invoice", None, guard=True)
+            db.commit()
+            sold += 1
+        except InsufficientStockError:
+            db.rollback()
+            rejected += 1
+        except OperationalError:
+            db.rollback()
+            errors += 1
+        finally:
+            db.close()
+    hammer_engine.dispose()
+    return sold, rejected, errors
+
+@app.cli.command("stress-stock")
+@click.option("--processes", default=8, show_default=True, help="Procesos vendiendo a la vez.")
+@click.option("--stock", default=50, show_default=True, help="Unidades iniciales del producto.")
+@click.option("--attempts", default=20, show_default=True, help="Ventas que intenta cada proceso.")
+@click.option("--compare/--no-compare", default=True, show_default=True, help="Corre también el patrón leer-validar-escribir anterior.")
+def stress_stock_command(processes, stock, attempts, compare):
+    """
+    Varios procesos venden el mismo producto a la vez sobre una base
+    temporal; falla si el descuento condicional vende más de lo que hay.
+    """
+    method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+    modes = [("condicional", False)] + ([("leer+escribir", True)] if compare else [])
+    click.echo(f"{processes} procesos x {attempts} intentos sobre {stock} unidades")
+    click.echo(f"{'modo':>14} {'vendidas':>9} {'rechazadas':>11} {'errores':>8} {'stock final':>12} {'movimientos':>12}")
+    for label, naive in modes:
+        tmp_dir = tempfile.mkdtemp(prefix="inventario-stock-")
+        try:
+            db_url = f"sqlite:///{os.path.join(tmp_dir, 'stock.db')}"
+            setup_engine = create_app_engine(db_url)
+            Base.metadata.create_all(bind=setup_engine)
+            with setup_engine.begin() as conn:
+                conn.execute(insert(Product).values(id=1, name="Bicicleta única", sku="STRESS-1", current_stock=stock))
+            jobs = [(db_url, attempts, naive, seed) for seed in range(processes)]
+            with multiprocessing.get_context(method).Pool(processes) as pool:
+                results = pool.map(_stock_hammer_worker, jobs)
+            with setup_engine.connect() as conn:
+                final_stock = conn.execute(select(Product.current_stock).where(Product.id == 1)).scalar()
+                movements = -(conn.execute(select(func.sum(StockMovement.quantity_change))).scalar() or 0)
+            setup_engine.dispose()
+            sold = sum(r[0] for r in results)
+            click.echo(f"{label:>14} {sold:>9} {sum(r[1] for r in results):>11} {sum(r[2] for r in results):>8} "
+                       f"{final_stock:>12} {movements:>12}")
+            if not naive and (final_stock < 0 or sold > stock or movements != stock - final_stock):
+                raise click.ClickException("El descuento condicional vendió más unidades de las disponibles.")
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+
+@app.cli.command("import-products")
+@click.argument("path", type=click.Path(exists=True, dir_okay=False))
+@click.option("--format", "fmt", type=click.Choice(["csv", "jsonl"]), default=None, help="Por defecto según la extensión.")
+@click.option("--batch-size", default=PRODUCT_IMPORT_BATCH_SIZE, show_default=True, help="Filas por transacción.")
+@click.option("--dry-run", is_flag=True, help="Valida y simula sin guardar.")
+def import_products_command(path, fmt, batch_size, dry_run):
+    """Importa productos (upsert por sku) y su stock inicial desde un CSV o JSONL."""
+    def progress(summary):
+        click.echo(f"  lote {summary['batches']}: {summary['rows']} filas, {summary['created']} nuevos, "
+                   f"{summary['updated']} actualizados, {summary['error_count']} errores")
+
+    db = SessionLocal()
+    try:
+        with open(path, "rb") as handle:
+            importer = ProductImporter(db, batch_size=batch_size, dry_run=dry_run, on_batch=progress)
+            summary = importer.run(iter_import_rows(handle, fmt or import_format_for(path)))
+    finally:
+        db.close()
+    for error in summary["errors"][:50]:
+        click.echo(f"  línea {error['line']} ({error['sku'] or '-'}): {error['error']}")
+    click.echo(f"{summary['rows']} filas en {summary['seconds']:.2f} s ({summary['rows_per_second'] or 0:.0f}/s): "
+               f"{summary['created']} nuevos, {summary['updated']} actualizados, {summary['error_count']} errores"
+               + (" (simulación)" if dry_run else ""))
+
+@app.cli.command("pdf-renderer")
+@click.option("--processes", default=PDF_RENDER_POOL_SIZE or (os.cpu_count() or 2), show_default=True, help="Procesos renderizadores.")
+@click.option("--poll", default=0.5, show_default=True, help="Segundos entre revisiones de la cola vacía.")
+def pdf_renderer_command(processes, poll):
+    """
+    Servicio renderizador: atiende la cola pdf_render_jobs con un pool de
+    procesos propio, aislado de los workers de gunicorn. Debe correr en el
+    mismo equipo que la web (comparten PDF_CACHE_DIR); en la web se activa
+    PDF_RENDER_SERVICE=true.
+    """
+    global pdf_render_pool
+    if not WEASYPRINT_AVAILABLE:
+        click.echo("WeasyPrint no está disponible; se usará ReportLab dentro de cada hilo.")
+    else:
+        pdf_render_pool = PdfRenderPool(processes, PDF_RENDER_TIMEOUT)
+    for _ in range(processes):
+        threading.Thread(target=_pdf_prerender_loop, args=(poll,), name="pdf-renderer", daemon=True).start()
+    click.echo(f"Renderizador de PDFs activo con {processes} procesos. Ctrl+C para salir.")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if pdf_render_pool is not None:
+            pdf_render_pool.restart()
+
+@app.cli.command("bench-products")
+@click.option("--sizes", default="100,1000,10000,50000", show_default=True, help="Tamaños de catálogo separados por coma.")
+@click.option("--legacy-max", default=10000, show_default=True, help="Tamaño máximo en el que se mide el camino N+1 anterior.")
+def bench_products_command(sizes, legacy_max):
+    """Compara consultas y latencia de /api/products: product_stats, agregado sobre historial y N+1."""
+    click.echo(f"{'productos':>10} {'modo':>10} {'consultas':>10} {'segundos':>10}")
+    for size in [int(x) for x in sizes.split(",") if x.strip()]:
+        with benchmark_session() as db:
+            seed_benchmark_catalog(db, size)
+            modes = [
+                ("resumen", lambda: products_with_details(db)),
+                ("historial", lambda: product_stats_from_history(db)),
+            ]
+            if size <= legacy_max:
+                modes.append(("n+1", lambda: [
+                    product_to_dict_with_details(p, db)
+                    for p in db.query(Product).order_by(Product.name.asc()).all()
+                ]))
+            for label, run in modes:
+                db.expire_all()
+                with QueryCounter(db.get_bind()) as counter:
+                    started = time.perf_counter()
+                    run()
+                    elapsed = time.perf_counter() - started
+                click.echo(f"{size:>10} {label:>10} {counter.count:>10} {elapsed:>10.3f}")
+
+def latency_percentiles(samples):
+    """Devuelve (p50, p99) en milisegundos."""
+    ordered = sorted(samples)
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))] * 1000
+    return pick(0.50), pick(0.99)
+
+@app.cli.command("bench-search")
+@click.option("--products", "n_products", default=100000, show_default=True, help="Tamaño del catálogo sintético.")
+@click.option("--queries", "n_queries", default=300, show_default=True, help="Búsquedas a medir por modo.")
+def bench_search_command(n_products, n_queries):
+    """Mide latencia p50/p99 de /api/products/search: LIKE '%q%', índice en memoria y FTS5."""
+    with benchmark_session() as db:
+        seed_benchmark_catalog(db, n_products, sales_per_product=0)
+        fts_ready = ensure_product_search_index(db.get_bind())
+        rng = random.Random(42)
+        queries = []
+        for _ in range(n_queries):
+            i = rng.randint(1, n_products)
+            if rng.random() < 0.3:
+                queries.append(f"SKU-{i:06d}")
+            else:
+                name = benchmark_product_name(i)
+                start = rng.randint(0, len(name) - 4)
+                queries.append(name[start:start + rng.randint(3, 8)].strip() or name[:4])
+        memory_index = ProductAutocompleteIndex(db.get_bind(), max_age=float("inf"))
+        started = time.perf_counter()
+        memory_index.sync()
+        click.echo(f"{n_products} productos, {len(queries)} búsquedas "
+                   f"(índice en memoria construido en {time.perf_counter() - started:.2f} s)")
+        modes = [
+            ("like", lambda q: search_products(db, q, limit=20, use_fts=False)),
+            ("memoria", lambda q: memory_index.search(q, limit=20)),
+        ]
+        if fts_ready:
+            modes.append(("fts5", lambda q: search_products(db, q, limit=20, use_fts=True)))
+        click.echo(f"{'modo':>8} {'p50 ms':>10} {'p99 ms':>10}")
+        for label, run in modes:
+            samples = []
+            for q in queries:
+                started = time.perf_counter()
+                run(q)
+                samples.append(time.perf_counter() - started)
+                db.expunge_all()
+            p50, p99 = latency_percentiles(samples)
+            click.echo(f"{label:>8} {p50:>10.2f} {p99:>10.2f}")
+
+def _sqlite_load_worker(args):
+    """Un worker del benchmark de carga: mezcla lecturas del catálogo y ventas durante `seconds`."""
+    db_url, tuned, seconds, write_ratio, seed, n_products = args
+    load_engine = create_app_engine(db_url, tuned=tuned)
+    make_session = sessionmaker(bind=load_engine, autoflush=False, future=True)
+    rng = random.Random(seed)
+    read_samples, write_samples, locked = [], [], 0
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        db = make_session()
+        started = time.perf_counter()
+        try:
+            if rng.random() < write_ratio:
+                for _ in range(3):
+                    adjust_stock(db, rng.randint(1, n_products), -1, "invoice", "benchmark", "invoice", 1)
+                db.commit()
+                write_samples.append(time.perf_counter() - started)
+            else:
+                products_with_details(db, limit=50, after=(benchmark_product_name(rng.randint(1, n_products)), 0))
+                db.get(Product, rng.randint(1, n_products))
+                read_samples.append(time.perf_counter() - started)
+        except OperationalError:
+            db.rollback()
+            locked += 1
+        finally:
+            db.close()
+    load_engine.dispose()
+    return read_samples, write_samples, locked
+
+@app.cli.command("bench-sqlite")
+@click.option("--processes", default=4, show_default=True, help="Workers concurrentes (como gunicorn -w).")
+@click.option("--seconds", default=5.0, show_default=True, help="Duración de cada corrida.")
+@click.option("--write-ratio", default=0.2, show_default=True, help="Fracción de operaciones que son ventas.")
+@click.option("--products", "n_products", default=5000, show_default=True, help="Tamaño del catálogo sintético.")
+def bench_sqlite_command(processes, seconds, write_ratio, n_products):
+    """Compara throughput de lectura/escritura con los valores por defecto de SQLite y con el ajuste de la app."""
+    tmp_dir = tempfile.mkdtemp(prefix="inventario-load-")
+    try:
+        template = os.path.join(tmp_dir, "template.db")
+        seed_engine = create_engine(f"sqlite:///{template}", future=True)
+        Base.metadata.create_all(bind=seed_engine)
+        db = sessionmaker(bind=seed_engine, autoflush=False, future=True)()
+        try:
+            seed_benchmark_catalog(db, n_products, sales_per_product=1)
+        finally:
+            db.close()
+            seed_engine.dispose()
+
+        method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        click.echo(f"{processes} procesos, {seconds:.0f} s, {write_ratio:.0%} ventas, {n_products} productos")
+        click.echo(f"{'config':>10} {'lect/s':>9} {'vent/s':>9} {'locked':>7} {'lect p50':>9} {'lect p99':>9} {'vent p50':>9} {'vent p99':>9}")
+        for label, tuned in (("default", False), ("ajustada", True)):
+            path = os.path.join(tmp_dir, f"{label}.db")
+            shutil.copyfile(template, path)
+            jobs = [(f"sqlite:///{path}", tuned, seconds, write_ratio, seed, n_products) for seed in range(processes)]
+            with multiprocessing.get_context(method).Pool(processes) as pool:
+                results = pool.map(_sqlite_load_worker, jobs)
+            reads = [x for r, _, _ in results for x in r]
+            writes = [x for _, w, _ in results for x in w]
+            locked = sum(l for _, _, l in results)
+            r50, r99 = latency_percentiles(reads) if reads else (0, 0)
+            w50, w99 = latency_percentiles(writes) if writes else (0, 0)
+            click.echo(f"{label:>10} {len(reads) / seconds:>9.0f} {len(writes) / seconds:>9.0f} {locked:>7} "
+                       f"{r50:>9.2f} {r99:>9.2f} {w50:>9.2f} {w99:>9.2f}")
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+@app.cli.command("bench-sales")
+@click.option("--customers", "sizes", default="1000,10000,100000", show_default=True, help="Tamaños de la tabla de clientes separados por coma.")
+@click.option("--sales", default=200, show_default=True, help="Ventas a registrar por corrida.")
+def bench_sales_command(sizes, sales):
+    """Latencia de registrar una venta (y de leer sus líneas) según crece la tabla de clientes, sin y con índices."""
+    click.echo(f"{'clientes':>10} {'índices':>8} {'venta p50':>10} {'venta p99':>10} {'detalle p50':>12}")
+    for size in [int(x) for x in sizes.split(",") if x.strip()]:
+        for label, indexed in (("no", False), ("sí", True)):
+            with benchmark_session() as db:
+                bind = db.get_bind()
+                if not indexed:
+                    for table in Base.metadata.sorted_tables:
+                        for index in table.indexes:
+                            index.drop(bind=bind)
+                seed_benchmark_catalog(db, 200, sales_per_product=1)
+                db.execute(insert(Customer), [
+                    {"name": f"Cliente {i}", "document_number": str(10_000_000 + i), "phone": f"3{i:09d}"}
+                    for i in range(size)
+                ])
+                db.execute(insert(Invoice), [
+                    {"id": 1000 + i, "number": f"HIST-{i}", "customer_id": 2 + i, "date": datetime.utcnow()}
+                    for i in range(size)
+                ])
+                db.execute(insert(InvoiceItem), [
+                    {"invoice_id": 1000 + i, "product_id": 1 + (i + k) % 200, "quantity": 1, "unit_price": 10000,
+                     "total_excl_vat": 10000, "vat_amount": 0, "total_incl_vat": 10000}
+                    for i in range(size) for k in range(2)
+                ])
+                db.commit()
+                with bind.begin() as conn:
+                    conn.exec_driver_sql("ANALYZE")
+
+                rng = random.Random(size)
+                sale_samples, detail_samples = [], []
+                for _ in range(sales):
+                    i = rng.randrange(size)
+                    payload = {
+                        "customer": {"name": f"Cliente {i}", "document_number": str(10_000_000 + i), "phone": f"3{i:09d}"},
+                        "items": [{"product_id": rng.randint(1, 200), "quantity": 1, "unit_price": 10000}],
+                    }
+                    started = time.perf_counter()
+                    create_invoice(db, payload)
+                    db.commit()
+                    sale_samples.append(time.perf_counter() - started)
+                    db.expunge_all()
+
+                    started = time.perf_counter()
+                    db.query(InvoiceItem).filter(InvoiceItem.invoice_id == 1000 + rng.randrange(size)).all()
+                    detail_samples.append(time.perf_counter() - started)
+                    db.expunge_all()
+                s50, s99 = latency_percentiles(sale_samples)
+                d50, _ = latency_percentiles(detail_samples)
+                click.echo(f"{size:>10} {label:>8} {s50:>10.2f} {s99:>10.2f} {d50:>12.2f}")
+
+@app.cli.command("bench-sales-report")
+@click.option("--lines", "n_lines", default=2_000_000, show_default=True, help="Líneas de venta sintéticas (facturas + remisiones).")
+@click.option("--days", default=730, show_default=True, help="Días de historial.")
+@click.option("--products", "n_products", default=2000, show_default=True, help="Tamaño del catálogo.")
+@click.option("--repeat", default=5, show_default=True, help="Repeticiones por consulta.")
+def bench_sales_report_command(n_lines, days, n_products, repeat):
+    """Compara /api/reports/sales sobre los resúmenes diarios contra el agregado directo sobre las líneas."""
+    with benchmark_session() as db:
+        rng = random.Random(24)
+        first_day = date.today() - timedelta(days=days - 1)
+        payments = ("EFECTIVO", "TARJETA", "TRANSFERENCIA", "NEQUI")
+        db.execute(insert(Product), [
+            {"name": benchmark_product_name(i), "sku": f"SKU-{i:06d}", "price": 10000, "current_stock": 0}
+            for i in range(1, n_products + 1)
+        ])
+        lines_per_document = 3
+        n_documents = max(n_lines // lines_per_document, 1)
+        started = time.perf_counter()
+        for kind, document, (item, fk) in (("invoice", Invoice, SALE_ITEM_MODELS["invoice"]), ("remission", Remission, SALE_ITEM_MODELS["remission"])):
+            share = n_documents // 2 if kind == "invoice" else n_documents - n_documents // 2
+            for offset in range(0, share, 20000):
+                ids = range(offset + 1, min(offset + 20000, share) + 1)
+                db.execute(insert(document.__table__), [{
+                    "id": doc_id, "number": f"{kind}-{doc_id}", "payment_method": rng.choice(payments),
+                    "date": datetime.combine(first_day, datetime.min.time()) + timedelta(days=rng.randrange(days), seconds=rng.randrange(86400)),
+                } for doc_id in ids])
+                rows = []
+                for doc_id in ids:
+                    for _ in range(lines_per_document):
+                        qty = rng.randint(1, 4)
+                        price = rng.choice((5000, 12000, 35000, 80000))
+                        rows.append({fk: doc_id, "product_id": rng.randint(1, n_products), "quantity": qty, "unit_price": price,
+                                     "unit_cost": price * 0.6, "total_excl_vat": price * qty, "vat_amount": 0, "total_incl_vat": price * qty})
+                db.execute(insert(item.__table__), rows)
+        db.commit()
+        click.echo(f"{n_documents * lines_per_document} líneas sintéticas en {days} días ({time.perf_counter() - started:.1f} s)")
+
+        started = time.perf_counter()
+        written = rebuild_sales_rollups(db)
+        db.commit()
+        with db.get_bind().begin() as conn:
+            conn.exec_driver_sql("ANALYZE")
+        click.echo(f"rebuild-sales-rollups: {written} filas de resumen en {time.perf_counter() - started:.1f} s")
+
+        last_day = first_day + timedelta(days=days - 1)
+        click.echo(f"{'rango':>7} {'grupo':>15} {'líneas ms':>10} {'resumen ms':>11} {'x':>7}")
+        for span in (7, 30, 365, days):
+            start = max(first_day, last_day - timedelta(days=span - 1))
+            for group in ("day", "product_id", "payment_method"):
+                timings = {}
+                for label, report in (("naive", sales_report_from_history), ("rollup", sales_report)):
+                    samples = []
+                    for _ in range(repeat):
+                        t0 = time.perf_counter()
+                        result = report(db, start, last_day, group)
+                        samples.append(time.perf_counter() - t0)
+                    timings[label] = (latency_percentiles(samples)[0], result["totals"].get("all", {}))
+                naive_ms, naive_totals = timings["naive"]
+                rollup_ms, rollup_totals = timings["rollup"]
+                if abs(naive_totals.get("total", 0) - rollup_totals.get("total", 0)) > 0.01 * max(1, naive_totals.get("lines", 1)):
+                    click.echo(f"  diferencia en totales: {naive_totals} != {rollup_totals}")
+                click.echo(f"{span:>6}d {group:>15} {naive_ms:>10.1f} {rollup_ms:>11.2f} {naive_ms / max(rollup_ms, 1e-6):>7.0f}")
+
 # --------------
 # Plantillas Jinja
 # --------------
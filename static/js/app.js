@@ -142,7 +142,7 @@ async function refreshProducts(){
       <td>${p.current_stock}</td>
       <td>${p.low_stock_threshold}</td>
       <td style="text-align:center">
-        <button class="btn btn-sm btn-link text-danger" title="Eliminar" onclick="deleteProduct(${p.id}, this)">
+        <button class="btn btn-sm btn-link text-danger" title="Archivar" onclick="deleteProduct(${p.id}, this)">
           <svg xmlns='http://www.w3.org/2000/svg' width='18' height='18' fill='currentColor' viewBox='0 0 16 16'><path d='M5.5 5.5a.5.5 0 0 1 .5.5v6a.5.5 0 0 1-1 0v-6a.5.5 0 0 1 .5-.5zm2.5.5a.5.5 0 0 0-1 0v6a.5.5 0 0 0 1 0v-6zm3 .5a.5.5 0 0 1 .5.5v6a.5.5 0 0 1-1 0v-6a.5.5 0 0 1 .5-.5z'/><path fill-rule='evenodd' d='M14.5 3a1 1 0 0 1-1 1H13v9a2 2 0 0 1-2 2H5a2 2 0 0 1-2-2V4h-.5a1 1 0 0 1-1-1V2a1 1 0 0 1 1-1h3.5a1 1 0 0 1 1-1h2a1 1 0 0 1 1 1H13a1 1 0 0 1 1 1v1zM4.118 4 4 4.059V13a1 1 0 0 0 1 1h6a1 1 0 0 0 1-1V4.059L11.882 4H4.118zM2.5 3V2h11v1h-11z'/></svg>
         </button>
       </td>
@@ -152,7 +152,7 @@ async function refreshProducts(){
 }
 
 async function deleteProduct(id, btn){
-  if (!confirm('¿Seguro que deseas eliminar este producto?')) return;
+  if (!confirm('¿Seguro que deseas archivar este producto? Sus compras y ventas se conservan.')) return;
   btn.disabled = true;
   try {
     let res = await fetch(`/api/products/${id}`, {method:'DELETE'});
@@ -163,7 +163,7 @@ async function deleteProduct(id, btn){
       return;
     }
     let data = await res.json();
-    alert(data.message || 'Producto eliminado correctamente');
+    alert(data.message || 'Producto archivado correctamente');
     await refreshProducts();
     await refreshAlerts();
   } catch(e){
@@ -272,7 +272,8 @@ function addPurchaseRow(){
 }
 
 async function populateProductSelect(selectEl){
-  let products = await fetchJSON('/api/products');
+  // Solo se necesitan id, sku y nombre; el servidor omite las columnas de detalle
+  let products = await fetchJSON('/api/products?fields=id,sku,name');
   selectEl.innerHTML = '';
   products.forEach(p => {
     const opt = document.createElement('option');